@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Daynix Computing LTD (www.daynix.com)
+# All rights reserved.
+#
+# Maintained by oss@daynix.com
+#
+# For documentation please refer to README.md available at https://github.com/daynix/NetMeter
+#
+# This code is licensed under standard 3-clause BSD license.
+# See file LICENSE supplied with this package for the full license text.
+
+import numpy as np
+import sys
+import json
+import platform
+from datetime import datetime
+from time import perf_counter
+from subprocess import Popen, PIPE
+from os import makedirs
+from os.path import isdir, isfile, join, dirname, abspath
+import NetMeter as nm
+from NM_synth import write_iperf, write_iperf3, write_rr, write_mpstat, write_cpustat
+
+# The data sizes: (name, streams, duration (s), interval (s)). The last one is a 4-hour,
+# 128-stream run, and is only benchmarked with --full.
+data_sizes = [
+              ('1st_60s', 1, 60, 1.0),
+              ('8st_600s', 8, 600, 1.0),
+              ('32st_1h', 32, 3600, 1.0),
+              ('8st_600s_0.1s', 8, 600, 0.1),
+              ('128st_4h', 128, 14400, 1.0)
+             ]
+num_cpu = 16
+summary_sizes = 20       # The sizes in the summary of a direction
+repeats = 3              # Every benchmark is run this many times, the best time counts
+regression_threshold = 1.25   # Slower than the previous run by this factor is flagged,
+regression_min_time = 0.005   # ... if it is also slower by this many seconds (the short ones are noisy)
+results_name = 'NM_bench_results.jsonl'
+
+
+class NoPlotter(object):
+    '''
+    Takes the plots of export_summary(), so that only the export itself is timed.
+    '''
+    def render(self, script, workdir):
+        pass
+
+
+def best_time(func):
+    times = []
+    for i in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+
+def make_data(data_dir, name, streams, duration, interval):
+    '''
+    The synthetic raw files of one data size (generated once, with fixed seeds).
+    '''
+    prefix = join(data_dir, name)
+    repetitions = int(duration / interval + 1e-6)
+    if not isfile(prefix + '_tcp.dat'):
+        write_iperf(prefix + '_tcp.dat', 'TCP', streams, repetitions, interval, garbled = 0.001,
+                    negative = 0.001, seed = 1)
+        write_iperf(prefix + '_udp.dat', 'UDP', streams, repetitions, interval, missing_rows = 0.001,
+                    seed = 2)
+        write_mpstat(prefix + '_mpstat.dat', num_cpu, int(duration / max(1, round(interval))),
+                     max(1, round(interval)), seed = 3)
+        write_cpustat(prefix + '_cpustat.npz', num_cpu, repetitions, interval, seed = 4)
+
+    if not isfile(prefix + '_tcp3.json'):
+        write_iperf3(prefix + '_tcp3.json', 'TCP', streams, repetitions, interval, seed = 6)
+
+    if not isfile(prefix + '_rr.out'):
+        write_rr(prefix + '_rr.out', 'TCP', streams, repetitions, interval, 1024, seed = 7)
+
+    return prefix, repetitions
+
+
+def run_benchmarks(work_dir, full):
+    data_dir = join(work_dir, 'data')
+    out_dir = join(work_dir, 'out')
+    for d in [data_dir, out_dir]:
+        if not isdir(d):
+            makedirs(d)
+
+    results = {}
+    for (name, streams, duration, interval) in data_sizes[:None if full else -1]:
+        print('Generating the ' + name + ' data...')
+        prefix, repetitions = make_data(data_dir, name, streams, duration, interval)
+        iperf_array = nm.get_iperf_data_single(prefix + '_tcp.dat', 'TCP', streams, repetitions, interval)[0]
+        out = join(out_dir, name)
+
+        def export_test():
+            nm.export_single_data(iperf_array, out + '_iperf_processed.dat')
+            nm.export_plot_data(iperf_array, out + '_iperf_processed.dat', out + '_iperf_plot.dat')
+
+        benchmarks = [
+                      ('parse_iperf_tcp', lambda: nm.get_iperf_data_single(prefix + '_tcp.dat', 'TCP', streams,
+                                                                           repetitions, interval)),
+                      ('parse_iperf_udp', lambda: nm.get_iperf_data_single(prefix + '_udp.dat', 'UDP', streams,
+                                                                           repetitions, interval)),
+                      ('parse_iperf3_tcp', lambda: nm.get_iperf_data_single(prefix + '_tcp3.json', 'TCP', streams,
+                                                                            repetitions, interval)),
+                      ('parse_rr_tcp', lambda: nm.get_rr_data_single(prefix + '_rr.out', streams, repetitions)),
+                      ('parse_mpstat', lambda: nm.get_mpstat_data_single(prefix + '_mpstat.dat')),
+                      ('parse_cpustat', lambda: nm.get_mpstat_data_single(prefix + '_cpustat.npz')),
+                      ('export_test', export_test),
+                      ('write_gp', lambda: nm.write_gp(out + '.plt', out + '_iperf_processed.dat',
+                                                       [(out + '_mpstat_processed.dat', 'local machine')],
+                                                       out + '.png', iperf_array[:,1].mean(), 'TCP', streams,
+                                                       'Buffer', 'cl1', 'cl2', packet_size = 65536))
+                     ]
+        for (bench, func) in benchmarks:
+            results[bench + '/' + name] = best_time(func)
+            print(format(bench + '/' + name, '<32') + format(results[bench + '/' + name] * 1000, '12.2f') + ' ms')
+
+    # The summary export does not depend on the data size
+    rng = np.random.RandomState(5)
+    sizes = 2 ** np.arange(summary_sizes)
+    iperf_tot = [[1, s, r, r / 20, r / 1e9, 60, 0.01] for (s, r) in zip(sizes, rng.uniform(1e8, 1e10, summary_sizes))]
+    mpstat_tot = {'': [[s, c, c / 10] for (s, c) in zip(sizes, rng.uniform(0.1, 0.9, summary_sizes))]}
+    results['export_summary'] = best_time(lambda: nm.export_summary(join(out_dir, 'summary'), 'one2two', iperf_tot,
+                                                                     mpstat_tot, 'TCP', 8, 'Buffer', 'Gbits',
+                                                                     'cl1', 'cl2', None, NoPlotter()))
+    print(format('export_summary', '<32') + format(results['export_summary'] * 1000, '12.2f') + ' ms')
+    return results
+
+
+def git_commit():
+    try:
+        p = Popen(['git', '-C', dirname(abspath(__file__)), 'rev-parse', '--short', 'HEAD'],
+                  stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        return out.decode().strip() or None
+    except OSError:
+        return None
+
+
+def compare(previous, results):
+    '''
+    Print the benchmarks that are slower than in the previous run by regression_threshold
+    and by regression_min_time or more.
+    '''
+    regressions = 0
+    print('Compared to ' + previous['date'] + ' (' + str(previous['commit']) + '):')
+    for bench in sorted(results):
+        if bench not in previous['results']:
+            continue
+
+        ratio = results[bench] / previous['results'][bench]
+        if ratio >= regression_threshold and results[bench] - previous['results'][bench] >= regression_min_time:
+            regressions += 1
+            print('  \033[91m' + format(bench, '<30') + format(ratio, '8.2f') + 'x slower\033[0m')
+
+    if not regressions:
+        print('  \033[92mNo regressions.\033[0m')
+
+
+def main():
+    full = '--full' in sys.argv
+    args = [a for a in sys.argv[1:] if a != '--full']
+    if len(args) != 1:
+        print('Usage: ' + sys.argv[0] + ' [--full] <WORK DIR>')
+        sys.exit(1)
+
+    work_dir = args[0]
+    results = run_benchmarks(work_dir, full)
+    entry = {'date': datetime.now().strftime('%Y_%m_%d_%H-%M-%S'), 'commit': git_commit(),
+             'python': platform.python_version(), 'numpy': np.__version__, 'full': full,
+             'results': results}
+    results_file = join(work_dir, results_name)
+    previous = []
+    if isfile(results_file):
+        with open(results_file) as inputfile:
+            previous = [json.loads(l) for l in inputfile if l.strip()]
+
+    if previous:
+        compare(previous[-1], results)
+
+    with open(results_file, 'a') as outfile:
+        outfile.write(json.dumps(entry) + '\n')
+
+    print('The results were added to ' + results_file + '.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Daynix Computing LTD (www.daynix.com)
+# All rights reserved.
+#
+# Maintained by oss@daynix.com
+#
+# For documentation please refer to README.md available at https://github.com/daynix/NetMeter
+#
+# This code is licensed under standard 3-clause BSD license.
+# See file LICENSE supplied with this package for the full license text.
+
+# The helpers shared by NetMeter and NM_compare.
+
+from subprocess import Popen, PIPE
+
+
+def t_quantile_975(df):
+    '''
+    The 97.5% quantile of the Student's t-distribution with df degrees of freedom
+    (Cornish-Fisher expansion, accurate to 1% for df >= 3).
+    '''
+    z = 1.959964
+    return (z + (z**3 + z) / (4 * df) + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * df**2)
+            + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * df**3))
+
+
+def run_gnuplot(gnuplot_bin, script, cwd = None):
+    '''
+    Render a gnuplot script. Returns the exit status of gnuplot (-1 if it could not be started)
+    and its error output.
+    '''
+    try:
+        p = Popen([gnuplot_bin, script], cwd = cwd, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        return -1, str(e)
+
+    out, err = p.communicate()
+    return p.returncode, err.decode('ascii', errors='ignore').strip()
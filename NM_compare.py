@@ -12,15 +12,24 @@
 
 import numpy as np
 import sys
-from re import sub
-from os.path import isdir, join
+import json
+from re import sub, search
+from os.path import isdir, isfile, join, dirname, basename, normpath
 from os import makedirs, listdir
 from datetime import datetime
-from subprocess import Popen
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from NM_store import ResultStore, open_store, store_location
+from NM_common import t_quantile_975, run_gnuplot
 
 ########### May requires changing  #############
 gnuplot_path = r'gnuplot'
+gnuplot_workers = 4
+trend_window = 10        # Runs on each side of a possible change point, in the trend mode
+trend_threshold = 0.05   # The relative change of the mean that is flagged, in the trend mode
+trend_noise = 4.0        # ... if it is also this many standard errors of the difference
+gate_bw_threshold = 0.05  # The relative bandwidth drop that fails the gate
+gate_cpu_threshold = 0.10 # The relative CPU usage increase that fails the gate
 ######### Don't change unless needed ###########
 iperf_datacolumn = 2
 logo_background = '{/=30 [}&{/:Bold=22 DayniX}{/=30 ]}'
@@ -34,12 +43,49 @@ logo_name_location = 'screen 0.94, screen 0.945'
 ################################################
 
 rundate = datetime.now().strftime('%Y_%m_%d_%H-%M-%S')
+# The CPU usage of the receiving client (measured over ssh), used if the local machine's is missing
+receiver_mpstat = {'one2two': 'mpstat_cl2', 'two2one': 'mpstat_cl1'}
+# The rate summaries: of the bandwidth (Iperf) tests, and of the request/response tests, that have
+# the same columns, with the transaction rate instead of the bandwidth (and the latencies after them)
+rate_summaries = ['iperf', 'rr']
+
+def findfiles_store(d):
+    '''
+    Look the summary files of a campaign up in the results store, instead of listing the directory.
+    Returns None if the campaign is not in the store.
+    '''
+    store, campaign = open_store(dirname(d))
+    if store == None:
+        return None
+
+    info = store.campaign_info(campaign)
+    store.close()
+    if info == None:
+        return None
+
+    timestamp, protocol, streams, directions = info
+    common_filename = join(d, protocol + '_' + str(streams) + '_st_' + timestamp)
+    filelist = []
+    for direction in ['one2two', 'two2one']:
+        for kinds in [['rr' if protocol.endswith('_RR') else 'iperf'], ['mpstat', receiver_mpstat[direction]]]:
+            found = [f for f in [common_filename + '_' + direction + '_' + k + '_summary.dat' for k in kinds]
+                     if isfile(f)]
+            filelist.append(found[0] if direction in directions and found else False)
+
+    return filelist, protocol, str(streams)
+
 
 def findfiles(d):
-    one2two_iperf = [f for f in listdir(d) if f.endswith('one2two_iperf_summary.dat')]
-    one2two_mpstat = [f for f in listdir(d) if f.endswith('one2two_mpstat_summary.dat')]
-    two2one_iperf = [f for f in listdir(d) if f.endswith('two2one_iperf_summary.dat')]
-    two2one_mpstat = [f for f in listdir(d) if f.endswith('two2one_mpstat_summary.dat')]
+    found = findfiles_store(d)
+    if found != None:
+        return found
+
+    one2two_iperf = [f for f in listdir(d) for k in rate_summaries if f.endswith('one2two_' + k + '_summary.dat')]
+    one2two_mpstat = ([f for f in listdir(d) if f.endswith('one2two_mpstat_summary.dat')] or
+                      [f for f in listdir(d) if f.endswith('one2two_' + receiver_mpstat['one2two'] + '_summary.dat')])
+    two2one_iperf = [f for f in listdir(d) for k in rate_summaries if f.endswith('two2one_' + k + '_summary.dat')]
+    two2one_mpstat = ([f for f in listdir(d) if f.endswith('two2one_mpstat_summary.dat')] or
+                      [f for f in listdir(d) if f.endswith('two2one_' + receiver_mpstat['two2one'] + '_summary.dat')])
     filelist = [one2two_iperf, one2two_mpstat, two2one_iperf, two2one_mpstat]
     protocols = [False for i in range(4)]
     streams = [False for i in range(4)]
@@ -54,10 +100,10 @@ def findfiles(d):
         elif not len(filelist[i]):
             filelist[i] = False
         else:
-            params = filelist[i][0].split('_')
+            params = search(r'^((?:TCP|UDP)(?:_RR)?)_(\d+)_st_', filelist[i][0])
             filelist[i] = join(d, filelist[i][0])
-            protocols[i] = params[0]
-            streams[i] = params[1]
+            protocols[i] = params.group(1)
+            streams[i] = params.group(2)
 
     protoset = set([p for p in protocols if p])
     if len(protoset) > 1:
@@ -69,6 +115,15 @@ def findfiles(d):
         print('Error! Found tests using different stream numbers in ' + d + '.')
         sys.exit(1)
 
+    if not protoset:
+        # No summaries at all (all the tests failed): take the test from the campaign directory name
+        test = search(r'_((?:TCP|UDP)(?:_RR)?)_(\d+)_st$', basename(normpath(dirname(normpath(d)))))
+        if test == None:
+            print('Error! No NetMeter summaries found in ' + d + '.')
+            sys.exit(1)
+
+        protoset, streamset = set([test.group(1)]), set([test.group(2)])
+
     (protocols,) = protoset
     (streams,) = streamset
 
@@ -87,6 +142,31 @@ def get_rate_factor(n):
     return 'Tb/s', factor
 
 
+def is_rr_summary(f):
+    return f.endswith('_rr_summary.dat')
+
+
+def check_same_kind(old_proto, new_proto):
+    '''
+    Exit if one of the compared runs is of request/response tests and the other one is not:
+    their rates (transactions and bits per second) can not be compared.
+    '''
+    if old_proto.endswith('_RR') != new_proto.endswith('_RR'):
+        print('Error! Can not compare ' + old_proto + ' tests with ' + new_proto + ' tests.')
+        sys.exit(1)
+
+
+def get_store_rate_factor(protocol, n):
+    '''
+    The units of the rates in the store: the bandwidth, or the transaction rate of the
+    request/response tests (TCP_RR and UDP_RR).
+    '''
+    if protocol.endswith('_RR'):
+        return 'trans/s', 1.0
+
+    return get_rate_factor(n)
+
+
 def get_iperf_metadata(f):
     data = np.loadtxt(f)
     datamax = np.amax(data[:,iperf_datacolumn])
@@ -104,6 +184,104 @@ def get_iperf_metadata(f):
     return datamax, status
 
 
+def get_run_info(f):
+    '''
+    The mean measurement duration and confidence interval of the tests that did not fail.
+    Only the summaries of NetMeter versions that record them have these columns.
+    '''
+    data = np.loadtxt(f, ndmin=2)
+    if data.shape[1] < 7:
+        return ''
+
+    data = data[(data[:,0] >= 0).nonzero()]
+    ci = data[np.isfinite(data[:,6]), 6]
+    if not data.shape[0]:
+        return ''
+
+    info = format(data[:,5].mean(), '.0f') + ' s'
+    if ci.size:
+        info += ', CI +-' + format(100 * ci.mean(), '.1f') + '%'
+
+    return info
+
+
+def get_interval_series(summary_file, sizes):
+    '''
+    The per-interval rates of the tests of an Iperf (or request/response) summary, as a
+    (sizes x intervals) matrix, padded with NaN. Taken from the results store if the campaign
+    is there, and otherwise from the _iperf_processed.dat (_rr_processed.dat) files.
+    '''
+    kind = 'rr' if is_rr_summary(summary_file) else 'iperf'
+    prefix = summary_file[:-len('_' + kind + '_summary.dat')]
+    direction = prefix.rsplit('_', 1)[1]
+    store, campaign = open_store(dirname(dirname(summary_file)))
+    series = []
+    for size in sizes:
+        data = None
+        if store != None:
+            data, _ = store.series(campaign, direction, size)
+
+        processed = prefix + '_' + format(int(size), '05d') + 'B_' + kind + '_processed.dat'
+        if data is None and isfile(processed):
+            data = np.loadtxt(processed, ndmin=2)
+
+        series.append(data[:,1] if data is not None and data.size else np.empty(0))
+
+    if store != None:
+        store.close()
+
+    matrix = np.full((len(sizes), max([r.size for r in series] + [0])), np.nan)
+    for (i, rates) in enumerate(series):
+        matrix[i,:rates.size] = rates
+
+    return matrix
+
+
+def welch_test(old, new):
+    '''
+    Welch's t-test of the difference of the mean bandwidths, for every row (size) of the
+    old and the new interval matrices. Returns the relative change of the mean, the relative
+    half-width of its 95% confidence interval, and the verdict (1: significant improvement,
+    -1: significant regression, 0: not significant, NaN: too few intervals).
+    '''
+    n_old = np.isfinite(old).sum(axis=1)
+    n_new = np.isfinite(new).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_old = np.nansum(old, axis=1) / n_old
+        mean_new = np.nansum(new, axis=1) / n_new
+        se2_old = np.nansum((old - mean_old[:,None])**2, axis=1) / (n_old - 1) / n_old
+        se2_new = np.nansum((new - mean_new[:,None])**2, axis=1) / (n_new - 1) / n_new
+        se = np.sqrt(se2_old + se2_new)
+        df = se**4 / (se2_old**2 / (n_old - 1) + se2_new**2 / (n_new - 1))
+        half_width = t_quantile_975(df) * se
+        change = mean_new / mean_old - 1
+        verdict = np.where(np.abs(mean_new - mean_old) > half_width, np.sign(change), 0.0)
+        ci = half_width / mean_old
+
+    verdict[(n_old < 2) | (n_new < 2)] = np.nan
+    return change, ci, verdict
+
+
+def export_significance(old_datfile, new_datfile, sig_datfile):
+    '''
+    Test the significance of the bandwidth changes of the sizes that did not fail in both runs,
+    and write them to sig_datfile. Returns the number of significant improvements and regressions.
+    '''
+    old = np.loadtxt(old_datfile, ndmin=2)
+    new = np.loadtxt(new_datfile, ndmin=2)
+    sizes = np.intersect1d(old[old[:,0] >= 0, 1], new[new[:,0] >= 0, 1])
+    change, ci, verdict = welch_test(get_interval_series(old_datfile, sizes),
+                                     get_interval_series(new_datfile, sizes))
+    old_order = np.argsort(old[:,1])
+    new_order = np.argsort(new[:,1])
+    old_means = old[old_order[np.searchsorted(old[old_order,1], sizes)], 2]
+    new_means = new[new_order[np.searchsorted(new[new_order,1], sizes)], 2]
+    np.savetxt(sig_datfile, np.vstack((sizes, old_means, new_means, change, ci, verdict)).T,
+               fmt='%g', header=('Size(B) OldRate(trans/s) NewRate(trans/s)' if is_rr_summary(old_datfile) else
+                                 'Size(B) OldBW(b/s) NewBW(b/s)') + ' Change(rel) CI95(rel) Verdict')
+    return int((verdict > 0).sum()), int((verdict < 0).sum())
+
+
 def gen_net_pointplots(status, type):
     if type == 'old':
         color = 'red'
@@ -128,23 +306,39 @@ def gen_net_pointplots(status, type):
     return content
 
 
-def iperf_plot_block(data_unit, dir_title, old_datfile, new_datfile):
+def iperf_plot_block(data_unit, dir_title, old_datfile, new_datfile, sig_datfile):
     old_max, old_status = get_iperf_metadata(old_datfile)
     new_max, new_status = get_iperf_metadata(new_datfile)
-    BW_units, rate_factor = get_rate_factor(max(old_max, new_max))
+    if is_rr_summary(old_datfile):
+        rate_label, (BW_units, rate_factor) = 'Transaction rate', ('trans/s', 1.0)
+    else:
+        rate_label, (BW_units, rate_factor) = 'Bandwidth', get_rate_factor(max(old_max, new_max))
+
+    old_info = get_run_info(old_datfile)
+    new_info = get_run_info(new_datfile)
+    run_info = ''
+    if old_info or new_info:
+        run_info = ('\\n{/=12 Av. run: old ' + (old_info or 'n/a') +
+                    '; new ' + (new_info or 'n/a') + '}')
+
     content = (
-               'set ylabel "Bandwidth (' + BW_units + ')"\n'
+               'set ylabel "' + rate_label + ' (' + BW_units + ')"\n'
                'set xlabel "' + data_unit + ' size"\n'
                'set yrange [0:*]\n'
                'rf = ' + str(rate_factor) + '\n'
-               'set title "{/=18 ' + dir_title + '}"\n'
+               'set title "{/=18 ' + dir_title + '}' + run_info + '"\n'
                'plot "' + old_datfile + '" using ($1 >= 0 ? $2 : 1/0):($3/rf-$4/rf):($3/rf+$4/rf) with filledcurves lc rgb "red" notitle, \\\n'
               )
     content += gen_net_pointplots(old_status, 'old')
     content += '     "" using ($1 < 0 ? $2 : 1/0):(0):(sprintf("Old failed!")) with labels offset 0.9,2.5 rotate by 90 tc rgb "red" font ",12" notitle, \\\n'
     content += '     "' + new_datfile + '" using ($1 >= 0 ? $2 : 1/0):($3/rf-$4/rf):($3/rf+$4/rf) with filledcurves lc rgb "blue" notitle, \\\n'
     content += gen_net_pointplots(new_status, 'new')
-    content += '     "" using ($1 < 0 ? $2 : 1/0):(0):(sprintf("New failed!")) with labels offset 0.9,7.0 rotate by 90 tc rgb "blue" font ",12" notitle\n'
+    content += '     "" using ($1 < 0 ? $2 : 1/0):(0):(sprintf("New failed!")) with labels offset 0.9,7.0 rotate by 90 tc rgb "blue" font ",12" notitle, \\\n'
+    # The significant changes (Welch's t-test on the per-interval data)
+    content += ('     "' + sig_datfile + '" using ($6 > 0 ? $1 : 1/0):($3/rf):(sprintf("%+.1f%%", 100*$4)) with labels point'
+                ' pt 8 ps 1.2 lc rgb "#008000" offset 0,1.2 tc rgb "#008000" font ",10" title "Signif. gain", \\\n')
+    content += ('     "" using ($6 < 0 ? $1 : 1/0):($3/rf):(sprintf("%+.1f%%", 100*$4)) with labels point'
+                ' pt 10 ps 1.2 lc rgb "#e05000" offset 0,-1.2 tc rgb "#e05000" font ",10" title "Signif. loss"\n')
     return content
 
 
@@ -173,13 +367,25 @@ def mpstat_plot_block(data_unit, dir_title, old_datfile, new_datfile):
     return content
 
 
+def report_significance(dir_title, counts):
+    gains, losses = counts
+    print('  ' + dir_title + ': ' + str(gains) + ' significant improvement(s), ' +
+          str(losses) + ' significant regression(s)')
+
+
 def write_comp_gp(old_d, new_d, out_basename):
     raw_data_subdir = "raw-data"
     old_files, old_proto, old_streams = findfiles(join(old_d, raw_data_subdir))
     new_files, new_proto, new_streams = findfiles(join(new_d, raw_data_subdir))
+    check_same_kind(old_proto, new_proto)
+    print(old_d + ' -> ' + new_d + ':')
     old_name = sub('[^0-9a-zA-Z/]+', '-', old_d)
     new_name = sub('[^0-9a-zA-Z/]+', '-', new_d)
-    if old_proto == new_proto == 'TCP':
+    rate_title = 'Bandwidth'
+    if old_proto.endswith('_RR'):
+        data_unit = 'Request'
+        rate_title = 'Transaction Rate'
+    elif old_proto == new_proto == 'TCP':
         data_unit = 'Buffer'
     elif old_proto == new_proto == 'UDP':
         data_unit = 'Datagram'
@@ -199,11 +405,12 @@ def write_comp_gp(old_d, new_d, out_basename):
                'set logscale x 2\n'
                'set xtics rotate by -30\n'
                'set style fill transparent solid 0.2 noborder\n'
-               'printxsizes(x) = x < 1024.0 ? sprintf("%.0fB", x) : (x < 1048576.0 ? sprintf("%.0fKB", x/1024.0) : sprintf("%.0fMB", x/1048576.0))\n'
+               'printxsizes(x) = x < 1024.0 ? sprintf("%.0fB", x) : (x < 1048576.0 ? sprintf(x/1024.0 == int(x/1024.0) ? "%.0fKB" : "%.1fKB", x/1024.0)'
+               ' : sprintf(x/1048576.0 == int(x/1048576.0) ? "%.0fMB" : "%.1fMB", x/1048576.0))\n'
                '\n'
                'set label "Old: {/=18 ' + old_name + ' [' + old_proto +', ' + old_streams +' st.]}\\\n'
                '       \\n\\nNew: {/=18 ' + new_name + ' [' + new_proto +', ' + new_streams +' st.]}" at screen 0.01, screen 0.99\n'
-               'set label "{/=22 Bandwidth Comparison}" at screen 0.254, screen 0.91 center\n'
+               'set label "{/=22 ' + rate_title + ' Comparison}" at screen 0.254, screen 0.91 center\n'
                'set label "{/=22 CPU Usage Comparison}" at screen 0.756,  screen 0.91 center\n'
                'set label "' + logo_background + '" at ' + logo_bg_location + ' center tc rgb "' + logo_bg_color + '"\n'
                'set label "' + logo_foreground + '" at ' + logo_fg_location + ' center tc rgb "' + logo_fg_color + '"\n'
@@ -239,15 +446,19 @@ def write_comp_gp(old_d, new_d, out_basename):
     content += '\nset multiplot\n'
     if one2two_block:
         dir_title = 'Client 1 to Client 2'
+        sig_datfile = out_basename + '_one2two_sig.dat'
+        report_significance(dir_title, export_significance(old_files[0], new_files[0], sig_datfile))
         content += 'set origin 0.0,0.45\n'
-        content += iperf_plot_block(data_unit, dir_title, old_files[0], new_files[0])
+        content += iperf_plot_block(data_unit, dir_title, old_files[0], new_files[0], sig_datfile)
         content += '\nset origin 0.495,0.45\n'
         content += mpstat_plot_block(data_unit, dir_title, old_files[1], new_files[1])
 
     if two2one_block:
         dir_title = 'Client 2 to Client 1'
+        sig_datfile = out_basename + '_two2one_sig.dat'
+        report_significance(dir_title, export_significance(old_files[2], new_files[2], sig_datfile))
         content += '\nset origin 0.0,0.0\n'
-        content += iperf_plot_block(data_unit, dir_title, old_files[2], new_files[2])
+        content += iperf_plot_block(data_unit, dir_title, old_files[2], new_files[2], sig_datfile)
         content += '\nset origin 0.495,0.0\n'
         content += mpstat_plot_block(data_unit, dir_title, old_files[3], new_files[3])
 
@@ -257,11 +468,434 @@ def write_comp_gp(old_d, new_d, out_basename):
         outfile.write(content)
 
 
+def size_name(size):
+    '''
+    The same as printxsizes() in the gnuplot scripts.
+    '''
+    for (unit, factor) in [('MB', 1048576), ('KB', 1024)]:
+        if size >= factor:
+            return format(size / float(factor), '.0f' if size % factor == 0 else '.1f') + unit
+
+    return format(size, '.0f') + 'B'
+
+
+def find_campaigns(patterns):
+    '''
+    The campaign directories (the ones with a raw-data subdirectory) matching the given globs.
+    A pattern can also match an export directory, standing for all the campaigns in it.
+    '''
+    found = set()
+    for pattern in patterns:
+        for d in glob(pattern):
+            if isdir(join(d, 'raw-data')):
+                found.add(normpath(d))
+            elif isdir(d):
+                found.update(normpath(c) for c in glob(join(d, '*')) if isdir(join(c, 'raw-data')))
+
+    return sorted(found)
+
+
+def ingest_campaign(store, d, campaign):
+    '''
+    Add the text summaries of a campaign that is not in the results store yet
+    (from an older NetMeter, or copied from elsewhere) to the store.
+    '''
+    raw_dir = join(d, 'raw-data')
+    if not [f for k in rate_summaries for f in glob(join(raw_dir, '*_' + k + '_summary.dat'))]:
+        return
+
+    files, protocol, streams = findfiles(raw_dir)
+    common_filename = sub('_(one2two|two2one)_(iperf|rr)_summary\.dat$', '', basename(files[0] or files[2]))
+    timestamp = common_filename[len(protocol + '_' + streams + '_st_'):]
+    tcpwin = ''
+    if isfile(join(d, common_filename + '.html')):
+        with open(join(d, common_filename + '.html')) as inputfile:
+            header = search(r'\[(?:TCP|UDP)(?:_RR)?, \d+ st\., w=([^\]]*)\]', inputfile.read())
+
+        tcpwin = header.group(1) if header else ''
+
+    for (direction, iperf_file, mpstat_file) in [('one2two', files[0], files[1]), ('two2one', files[2], files[3])]:
+        if not iperf_file:
+            continue
+
+        cpu = {}
+        if mpstat_file:
+            cpu = dict((row[0], row) for row in np.loadtxt(mpstat_file, ndmin=2))
+
+        for row in np.loadtxt(iperf_file, ndmin=2):
+            store.add_test(campaign, timestamp, protocol, streams, direction, tcpwin, row,
+                           cpu.get(row[1]), commit = False)
+
+
+def load_trends(dirs):
+    '''
+    The summaries of the given campaigns, from the results stores of their export directories.
+    The campaigns that are not in the stores are added to them first, so the text summaries are
+    parsed only once. Returns {(protocol, streams, tcpwin, direction): (timestamps, rows)},
+    with the runs in time order, and the rows as returned by ResultStore.query().
+    '''
+    by_store = {}
+    for d in dirs:
+        filename, campaign = store_location(d)
+        by_store.setdefault(filename, []).append((d, campaign))
+
+    parts = {}
+    for (filename, campaigns) in sorted(by_store.items()):
+        store = ResultStore(filename)
+        keys = store.campaign_keys()
+        missing = [(d, c) for (d, c) in campaigns if c not in keys]
+        if missing:
+            print('Adding ' + str(len(missing)) + ' campaign(s) to ' + filename + '...')
+            for (d, c) in missing:
+                ingest_campaign(store, d, c)
+
+            store.commit()
+            keys = store.campaign_keys()
+
+        names = [c for (d, c) in campaigns if c in keys]
+        for (protocol, streams, tcpwin) in set(keys[c][1:] for c in names):
+            for direction in ['one2two', 'two2one']:
+                found, data = store.query(protocol, streams, direction, tcpwin, names)
+                if found:
+                    parts.setdefault((protocol, streams, tcpwin, direction), []).append(
+                                     ([keys[c][0] for c in found], data))
+
+        store.close()
+
+    trends = {}
+    for (group, group_parts) in parts.items():
+        # Merge the stores: renumber the runs, and put them in time order
+        timestamps = []
+        data = []
+        for (part_timestamps, part_data) in group_parts:
+            part_data[:,0] += len(timestamps)
+            timestamps += part_timestamps
+            data.append(part_data)
+
+        order = np.argsort(timestamps, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        data = np.vstack(data)
+        data[:,0] = rank[data[:,0].astype(int)]
+        trends[group] = ([timestamps[i] for i in order], data)
+
+    return trends
+
+
+def trend_matrix(runs, data, column):
+    '''
+    A runs x sizes matrix of one column of the rows of load_trends()
+    (NaN where a test is missing or failed), and the sizes.
+    '''
+    sizes, size_index = np.unique(data[:,2], return_inverse=True)
+    matrix = np.full((runs, sizes.size), np.nan)
+    valid = data[:,1] >= 0
+    matrix[data[valid,0].astype(int), size_index[valid]] = data[valid,column]
+    return matrix, sizes
+
+
+def change_points(matrix, window, threshold):
+    '''
+    For every run (row) and size (column), compare the mean of the window of runs before the run
+    with the mean of the window from the run on, ignoring the missing values. A change point is
+    where the relative change of the mean is over the threshold and over the noise (trend_noise
+    standard errors of the difference), and is the largest one within the window around it. Returns the means before and after every run (NaN where there are
+    too few values), and the change points (boolean matrix).
+    '''
+    runs = matrix.shape[0]
+    valid = np.isfinite(matrix)
+    sums = np.vstack((np.zeros((1, matrix.shape[1])), np.cumsum(np.where(valid, matrix, 0), axis=0)))
+    squares = np.vstack((np.zeros((1, matrix.shape[1])), np.cumsum(np.where(valid, matrix, 0)**2, axis=0)))
+    counts = np.vstack((np.zeros((1, matrix.shape[1])), np.cumsum(valid, axis=0)))
+    i = np.arange(runs)
+    lo = np.maximum(i - window, 0)
+    hi = np.minimum(i + window, runs)
+    before_n = counts[i] - counts[lo]
+    after_n = counts[hi] - counts[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        before = (sums[i] - sums[lo]) / before_n
+        after = (sums[hi] - sums[i]) / after_n
+        change = after / before - 1
+        # Standard error of the difference of the means (zero for single values)
+        before_var = ((squares[i] - squares[lo]) - before_n * before**2) / (before_n - 1)
+        after_var = ((squares[hi] - squares[i]) - after_n * after**2) / (after_n - 1)
+        stderr = np.sqrt(np.where(before_n > 1, before_var / before_n, 0) +
+                         np.where(after_n > 1, after_var / after_n, 0))
+
+    min_n = max(1, (window + 1) // 2)
+    few = (before_n < min_n) | (after_n < min_n) | (np.abs(after - before) <= trend_noise * stderr)
+    before[few] = np.nan
+    after[few] = np.nan
+    magnitude = np.nan_to_num(np.abs(np.where(few, np.nan, change)), posinf=0.0)
+    padded = np.pad(magnitude, ((window, window), (0, 0)))
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1, axis=0).max(axis=-1)
+    return before, after, (magnitude > threshold) & (magnitude == local_max)
+
+
+def export_trend(out_basename, labels, matrix, sizes, rate_factor):
+    '''
+    Write a trend matrix (a row per run), and its change points, for gnuplot.
+    Returns the change points: (run label, size, mean before, mean after, relative change).
+    '''
+    label_step = max(1, len(labels) // 40)
+    cells = np.char.mod('%g', matrix / rate_factor)
+    cells[np.isnan(matrix)] = '?'
+    with open(out_basename + '.dat', 'w') as outfile:
+        outfile.write('# Run Label ' + ' '.join(size_name(s) for s in sizes) + '\n')
+        for (run, row) in enumerate(cells):
+            label = labels[run] if run % label_step == 0 else ''
+            outfile.write(str(run) + ' "' + label + '" ' + ' '.join(row) + '\n')
+
+    before, after, points = change_points(matrix, trend_window, trend_threshold)
+    run, col = points.nonzero()
+    before = before[run,col]
+    after = after[run,col]
+    np.savetxt(out_basename + '_changes.dat',
+               np.vstack((run, sizes[col], before / rate_factor, after / rate_factor, after / before - 1)).T,
+               fmt='%g', header='Run Size Before After Change(rel)')
+    return [(labels[r], sizes[c], before[k], after[k], after[k] / before[k] - 1)
+            for (k, (r, c)) in enumerate(zip(run, col))]
+
+
+def trend_plot_block(datfile, sizes, ylabel, yrange):
+    content = (
+               'set ylabel "' + ylabel + '"\n'
+               'set yrange ' + yrange + '\n'
+               'plot '
+              )
+    for (i, size) in enumerate(sizes):
+        content += ('"' + datfile + '.dat" using 1:' + str(i + 3) + (':xtic(2)' if not i else '') +
+                    ' with linespoints pt 7 ps 0.3 lw 2 title "' + size_name(size) + '", \\\n     ')
+
+    content += ('"' + datfile + '_changes.dat" using 1:4:(sprintf("%+.1f%%", 100*$5)) with labels point'
+                ' pt 6 ps 1.5 lc rgb "red" offset 0,1 tc rgb "red" font ",9" notitle\n')
+    return content
+
+
+def write_trend_gp(out_basename, group, labels, data):
+    '''
+    Export the bandwidth and the CPU trends of one campaign group (protocol, streams, TCP window and
+    direction), and write the gnuplot script for them. Returns the change points found.
+    '''
+    (protocol, streams, tcpwin, direction) = group
+    bw, sizes = trend_matrix(len(labels), data, 3)
+    cpu, _ = trend_matrix(len(labels), data, 5)
+    BW_units, rate_factor = get_store_rate_factor(protocol, np.nanmax(bw) if np.isfinite(bw).any() else 0.0)
+    found = [('BW',) + c for c in export_trend(out_basename + '_bw', labels, bw, sizes, rate_factor)]
+    found += [('CPU',) + c for c in export_trend(out_basename + '_cpu', labels, cpu, sizes, 1.0)]
+    dir_title = 'Client 1 to Client 2' if direction == 'one2two' else 'Client 2 to Client 1'
+    out_name = basename(out_basename)
+    content = (
+               'set terminal pdfcairo color enhanced rounded size 29.7cm,21.0cm font "Verdana,12"\n'
+               'set output "' + out_name + '.pdf"\n'
+               'set datafile missing "?"\n'
+               'set key outside right top vertical samplen 1\n'
+               'set xtics rotate by -60 font ",8" noenhanced\n'
+               'set grid ytics\n'
+               'set label "' + logo_background + '" at ' + logo_bg_location + ' center tc rgb "' + logo_bg_color + '"\n'
+               'set label "' + logo_foreground + '" at ' + logo_fg_location + ' center tc rgb "' + logo_fg_color + '"\n'
+               'set label "' + logo_name + '" at ' + logo_name_location + ' center\n'
+               'set multiplot layout 2,1 title "{/=18 Trend: ' + dir_title + ' [' + protocol + ', ' + str(streams) +
+               ' st.' + (', w=' + tcpwin if tcpwin else '') + ']}\\n{/=12 ' + str(len(labels)) + ' runs, ' +
+               sub('[^0-9a-zA-Z]+', '-', labels[0]) + ' to ' + sub('[^0-9a-zA-Z]+', '-', labels[-1]) + '}"\n'
+               '\n'
+              )
+    content += trend_plot_block(out_name + '_bw', sizes, ('Transaction rate' if protocol.endswith('_RR') else 'Bandwidth') +
+                                ' (' + BW_units + ')', '[0:*]')
+    content += '\n'
+    if np.isfinite(cpu).any():
+        content += trend_plot_block(out_name + '_cpu', sizes, 'CPU busy time fraction', '[0:1]')
+    else:
+        content += ('unset xtics\n'
+                    'set label 10 "{/=30 No CPU results found}" at graph 0.5, graph 0.5 center\n'
+                    'plot 1/0 notitle\n')
+
+    content += 'unset multiplot\n'
+    with open(out_basename + '.plt', 'w') as outfile:
+        outfile.write(content)
+
+    return found
+
+
+def trend(patterns, outdir):
+    '''
+    Plot the bandwidth and the CPU usage of every size over many runs, and list the change points.
+    '''
+    dirs = find_campaigns(patterns)
+    if not dirs:
+        print('No NetMeter campaign directories found.')
+        sys.exit(1)
+
+    print('Loading ' + str(len(dirs)) + ' campaign(s)...')
+    trends = load_trends(dirs)
+    jobs = []
+    with ThreadPoolExecutor(max_workers = gnuplot_workers) as executor:
+        for group in sorted(trends):
+            (protocol, streams, tcpwin, direction) = group
+            labels, data = trends[group]
+            out_basename = join(outdir, rundate + '_trend_' + protocol + '_' + str(streams) + '_st' +
+                                ('_w' + tcpwin if tcpwin else '') + '_' + direction)
+            found = write_trend_gp(out_basename, group, labels, data)
+            jobs.append((out_basename + '.plt', executor.submit(run_gnuplot, gnuplot_path, basename(out_basename + '.plt'), outdir)))
+            print('\n' + basename(out_basename) + ': ' + str(len(labels)) + ' run(s), ' +
+                  str(len(found)) + ' change point(s)')
+            for (kind, label, size, before, after, change) in found:
+                units, rate_factor = get_store_rate_factor(protocol, max(before, after)) if kind == 'BW' else ('', 1.0)
+                print('  ' + kind + ' ' + size_name(size) + ' at ' + label + ': ' +
+                      format(before / rate_factor, '.3g') + ' -> ' + format(after / rate_factor, '.3g') +
+                      (' ' + units if units else '') + ' (' + format(100 * change, '+.1f') + '%)')
+
+    failed = 0
+    for (script, job) in jobs:
+        status, err = job.result()
+        if status:
+            print('gnuplot exited with status ' + str(status) + ' for ' + script + ('\n' + err if err else ''))
+            failed += 1
+
+    if failed:
+        print(str(failed) + ' of ' + str(len(jobs)) + ' trend plot(s) failed to render.')
+        sys.exit(1)
+
+
+def gate_direction(direction, old_iperf, new_iperf, old_mpstat, new_mpstat):
+    '''
+    Compare the old and the new summaries of one direction, size by size, against the thresholds.
+    The sizes that the old run measured, but that failed (TestOK -1) or are missing in the new run,
+    are reported as "failed" or "missing", and fail the gate. The sizes that had problems (TestOK 0)
+    in either run are reported as "flaky", and those that failed or are missing in the old run as
+    "not_compared". These two do not fail the gate.
+    '''
+    old = np.loadtxt(old_iperf, ndmin=2)
+    new = np.loadtxt(new_iperf, ndmin=2)
+    old_cpu = dict((row[0], row[1]) for row in np.loadtxt(old_mpstat, ndmin=2)) if old_mpstat else {}
+    new_cpu = dict((row[0], row[1]) for row in np.loadtxt(new_mpstat, ndmin=2)) if new_mpstat else {}
+    old_rows = dict((row[1], row) for row in old)
+    new_rows = dict((row[1], row) for row in new)
+    compared = np.intersect1d(old[old[:,0] > 0, 1], new[new[:,0] > 0, 1])
+    _, ci, verdict = welch_test(get_interval_series(old_iperf, compared), get_interval_series(new_iperf, compared))
+    significance = dict(zip(compared, zip(ci, verdict)))
+    results = []
+    for size in np.union1d(old[:,1], new[:,1]):
+        result = {'direction': direction, 'size': int(size)}
+        if size not in old_rows or old_rows[size][0] < 0:
+            result['status'] = 'not_compared'
+        elif size not in new_rows:
+            result['status'] = 'missing'
+        elif new_rows[size][0] < 0:
+            result['status'] = 'failed'
+        elif min(old_rows[size][0], new_rows[size][0]) == 0:
+            result['status'] = 'flaky'
+
+        if 'status' in result:
+            results.append(result)
+            continue
+
+        result.update({'old_bw': old_rows[size][2], 'new_bw': new_rows[size][2],
+                       'bw_change': new_rows[size][2] / old_rows[size][2] - 1})
+        ci, verdict = significance[size]
+        if np.isfinite(verdict):
+            result.update({'bw_ci95': ci, 'significant': bool(verdict)})
+
+        regression = result['bw_change'] < -gate_bw_threshold
+        if size in old_cpu and size in new_cpu and old_cpu[size] > 0:
+            result.update({'old_cpu': old_cpu[size], 'new_cpu': new_cpu[size],
+                           'cpu_change': new_cpu[size] / old_cpu[size] - 1})
+            regression = regression or result['cpu_change'] > gate_cpu_threshold
+
+        result['status'] = 'regression' if regression else 'ok'
+        results.append(result)
+
+    return results
+
+
+def gate(olddirs, newdirs, outdir):
+    '''
+    Compare pairs of runs against the regression thresholds, and write a JSON report.
+    Returns the exit status: 0 if the gate passed, 2 if a regression was found, and 3 if there
+    was no regression, but results of the old runs are missing or failed in the new ones.
+    '''
+    report = {'timestamp': rundate,
+              'thresholds': {'bandwidth': gate_bw_threshold, 'cpu': gate_cpu_threshold},
+              'comparisons': []}
+    counts = {}
+    for (o,n) in zip(olddirs,newdirs):
+        old_files, old_proto, old_streams = findfiles(join(o, 'raw-data'))
+        new_files, new_proto, new_streams = findfiles(join(n, 'raw-data'))
+        check_same_kind(old_proto, new_proto)
+        comparison = {'old': o, 'new': n, 'old_test': [old_proto, int(old_streams)],
+                      'new_test': [new_proto, int(new_streams)], 'old_status': {}, 'new_status': {},
+                      'sizes': []}
+        for (i, direction) in [(0, 'one2two'), (2, 'two2one')]:
+            # NetMeter writes no summary for a direction where all the sizes failed
+            if not old_files[i]:
+                comparison['sizes'].append({'direction': direction, 'status': 'not_compared'})
+                continue
+
+            comparison['old_status'][direction] = get_iperf_metadata(old_files[i])[1]
+            if not new_files[i]:
+                comparison['new_status'][direction] = 'none_OK'
+                comparison['sizes'].append({'direction': direction, 'status': 'missing'})
+                continue
+
+            comparison['new_status'][direction] = get_iperf_metadata(new_files[i])[1]
+            comparison['sizes'] += gate_direction(direction, old_files[i], new_files[i],
+                                                  old_files[i + 1], new_files[i + 1])
+
+        print(o + ' -> ' + n + ':')
+        for result in comparison['sizes']:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] == 'regression':
+                print('  \033[91mREGRESSION:\033[0m ' + result['direction'] + ' ' + size_name(result['size']) +
+                      ': BW ' + format(100 * result['bw_change'], '+.1f') + '%' +
+                      (', CPU ' + format(100 * result['cpu_change'], '+.1f') + '%' if 'cpu_change' in result else ''))
+            elif result['status'] in ['missing', 'failed']:
+                print('  \033[91m' + result['status'].upper() + ':\033[0m ' + result['direction'] +
+                      (' ' + size_name(result['size']) if 'size' in result else '') + ' (measured in the old run)')
+            elif result['status'] != 'ok':
+                print('  ' + result['status'] + ': ' + result['direction'] +
+                      (' ' + size_name(result['size']) if 'size' in result else ''))
+
+        report['comparisons'].append(comparison)
+
+    report['counts'] = counts
+    lost = counts.get('missing', 0) + counts.get('failed', 0)
+    report['passed'] = not counts.get('regression') and not lost
+    report_name = join(outdir, rundate + '_gate.json')
+    with open(report_name, 'w') as outfile:
+        json.dump(report, outfile, indent = 1)
+
+    print('The report is: ' + report_name)
+    print('Gate ' + ('\033[92mPASSED\033[0m' if report['passed'] else '\033[91mFAILED\033[0m') + ': ' +
+          ', '.join(str(counts[k]) + ' ' + k for k in sorted(counts)))
+    if counts.get('regression'):
+        return 2
+
+    return 3 if lost else 0
+
+
 def main():
-    if len(sys.argv) != 4:
+    mode = None
+    if len(sys.argv) > 1 and sys.argv[1] in ['--trend', '--gate']:
+        mode = sys.argv.pop(1)
+
+    if len(sys.argv) != (3 if mode == '--trend' else 4):
         print('Usage: ' + sys.argv[0] + ' <OLD DIR1>,<OLD DIR2>,... <NEW DIR1>,<NEW DIR2>,... <OUTPUT DIR>')
+        print('       ' + sys.argv[0] + ' --gate <OLD DIR1>,<OLD DIR2>,... <NEW DIR1>,<NEW DIR2>,... <OUTPUT DIR>')
+        print('       ' + sys.argv[0] + ' --trend <DIR/GLOB1>,<DIR/GLOB2>,... <OUTPUT DIR>')
         sys.exit(1)
 
+    if mode == '--trend':
+        outdir = sys.argv[2]
+        if not isdir(outdir):
+            try:
+                makedirs(outdir)
+            except:
+                print('The output directory (' + outdir + ') could not be created. Exiting.')
+                sys.exit(1)
+
+        trend(sys.argv[1].split(','), outdir)
+        return
+
     olddirs = sys.argv[1].split(',')
     olddirs = [glob(d)[0] for d in olddirs]
     newdirs = sys.argv[2].split(',')
@@ -288,14 +922,28 @@ def main():
             sys.exit(1)
 
     print('The output directory is: ' + outdir)
+    if mode == '--gate':
+        sys.exit(gate(olddirs, newdirs, outdir))
 
     count = 0
-    for (o,n) in zip(olddirs,newdirs):
-        count += 1
-        out_basename = join(outdir, rundate + '_comp_' + format(count, '04d'))
-        write_comp_gp(o, n, out_basename)
-        p = Popen([gnuplot_path, out_basename + '.plt'])
-        p.wait()
+    jobs = []
+    with ThreadPoolExecutor(max_workers = gnuplot_workers) as executor:
+        for (o,n) in zip(olddirs,newdirs):
+            count += 1
+            out_basename = join(outdir, rundate + '_comp_' + format(count, '04d'))
+            write_comp_gp(o, n, out_basename)
+            jobs.append((out_basename + '.plt', executor.submit(run_gnuplot, gnuplot_path, out_basename + '.plt')))
+
+    failed = 0
+    for (script, job) in jobs:
+        status, err = job.result()
+        if status:
+            print('gnuplot exited with status ' + str(status) + ' for ' + script + ('\n' + err if err else ''))
+            failed += 1
+
+    if failed:
+        print(str(failed) + ' of ' + str(count) + ' comparison(s) failed to render.')
+        sys.exit(1)
 
 
 if __name__ == "__main__":
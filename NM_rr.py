@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Daynix Computing LTD (www.daynix.com)
+# All rights reserved.
+#
+# Maintained by oss@daynix.com
+#
+# For documentation please refer to README.md available at https://github.com/daynix/NetMeter
+#
+# This code is licensed under standard 3-clause BSD license.
+# See file LICENSE supplied with this package for the full license text.
+
+# The request/response (latency) tool of NetMeter. NetMeter runs it on the clients by feeding it
+# to their Python ("python3 - <arguments>"), so it must not depend on anything but the standard library.
+
+import sys
+import json
+import socket
+import os
+import struct
+import signal
+import multiprocessing
+from time import perf_counter_ns, monotonic, sleep
+from threading import Thread, Lock, Event
+from math import ceil
+
+# The port of the responder
+rr_port = 5301
+# The process name, to find and to stop the tool as the Iperf executables are (at most 15 characters)
+rr_name = 'NM_rr'
+# The histogram buckets: 2**rr_precision per power of two (the latencies are within 1/64 of the truth)
+rr_precision = 7
+# A UDP request without a response for this long (s) is counted as lost
+udp_timeout = 0.2
+
+
+class Histogram(object):
+    '''
+    A histogram of latencies (in ns), with log-linear (HDR-style) buckets: the values below
+    2**rr_precision have a bucket each, and above that every power of two is split into
+    2**(rr_precision - 1) buckets. Only the buckets that were hit are kept, and histograms of the
+    same precision are merged by adding up their counts.
+    '''
+    def __init__(self, counts = None):
+        self.counts = counts or {}
+
+    @staticmethod
+    def bucket(value):
+        e = max(value.bit_length() - rr_precision, 0)
+        return (e << (rr_precision - 1)) + (value >> e)
+
+    @staticmethod
+    def bucket_value(index):
+        '''
+        The middle of a bucket.
+        '''
+        e = max((index >> (rr_precision - 1)) - 1, 0)
+        m = index - (e << (rr_precision - 1))
+        return (m << e) + ((1 << e) - 1) / 2.0
+
+    def record(self, value):
+        i = self.bucket(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+
+    def merge(self, other):
+        for (i, c) in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, q):
+        '''
+        The latency (ns) below which q percent of the values are, or None for an empty histogram.
+        '''
+        rank = max(ceil(q / 100.0 * self.total()), 1)
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return self.bucket_value(i)
+
+        return None
+
+    def to_list(self):
+        return [[i, self.counts[i]] for i in sorted(self.counts)]
+
+    @classmethod
+    def from_list(cls, pairs):
+        return cls(dict((int(i), int(c)) for (i, c) in pairs))
+
+
+def prctl(option, arg):
+    try:
+        import ctypes
+        ctypes.CDLL(None).prctl(option, arg, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def set_process_name(name):
+    # PR_SET_NAME
+    prctl(15, name.encode())
+
+
+def fork_worker():
+    '''
+    Fork a process that ends with this one (so that stopping the server stops all of it).
+    Returns True in the new process.
+    '''
+    if os.fork():
+        return False
+
+    # PR_SET_PDEATHSIG
+    prctl(1, signal.SIGTERM)
+    return True
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+
+        data += chunk
+
+    return data
+
+
+def echo_tcp(conn):
+    '''
+    Answer the requests of one connection. The client sends the request size first.
+    '''
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        header = recv_exact(conn, 4)
+        if header:
+            size = struct.unpack('!I', header)[0]
+            while True:
+                request = recv_exact(conn, size)
+                if request == None:
+                    break
+
+                conn.sendall(request)
+
+    except OSError:
+        # The client resets the connections that it leaves at the end of the test
+        pass
+
+    conn.close()
+
+
+def echo_udp(server):
+    while True:
+        request, addr = server.recvfrom(65535)
+        server.sendto(request, addr)
+
+
+def run_server(protocol, port, streams):
+    '''
+    Answer every request with a response of the same size (its copy), until killed. Every TCP
+    connection, and every UDP stream (on a port of its own: port, port + 1, ... port + streams - 1),
+    is answered by a process of its own, so that the streams do not queue behind each other.
+    '''
+    # The workers are reaped by the system
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    if protocol == 'TCP':
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('', port))
+        server.listen(128)
+        while True:
+            conn, addr = server.accept()
+            if fork_worker():
+                server.close()
+                echo_tcp(conn)
+                os._exit(0)
+
+            conn.close()
+
+    else:
+        # The first port is bound last, so that when it is seen listening, all the others are too
+        servers = []
+        for p in reversed(range(port, port + streams)):
+            servers.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+            servers[-1].bind(('', p))
+
+        for server in servers:
+            if fork_worker():
+                echo_udp(server)
+
+        while True:
+            signal.pause()
+
+
+class Stream(Thread):
+    '''
+    One connection (TCP) or socket (UDP) of the client: sends a request and waits for its response,
+    again and again, until stopped. The latencies of the current interval are kept in hist.
+    Each stream runs in a process of its own (see run_stream()), where it is the only busy thread,
+    so that the measured latencies do not include waiting for the GIL of the other streams.
+    '''
+    def __init__(self, protocol, server, port, size):
+        Thread.__init__(self, daemon = True)
+        self.protocol = protocol
+        self.size = size
+        self.lock = Lock()
+        self.stopped = Event()
+        self.hist = Histogram()
+        self.transactions = 0
+        self.lost = 0
+        if protocol == 'TCP':
+            self.sock = socket.create_connection((server, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.sendall(struct.pack('!I', size))
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect((server, port))
+            self.sock.settimeout(udp_timeout)
+
+    def take(self):
+        '''
+        The histogram, the transactions and the lost requests of the interval so far, starting the next one.
+        '''
+        with self.lock:
+            taken = (self.hist, self.transactions, self.lost)
+            self.hist, self.transactions, self.lost = Histogram(), 0, 0
+
+        return taken
+
+    def transaction_tcp(self, request):
+        self.sock.sendall(request)
+        return recv_exact(self.sock, self.size) != None
+
+    def transaction_udp(self, request):
+        # A late response to a lost request is told apart by the sequence number at its start
+        self.sock.send(request)
+        while True:
+            response = self.sock.recv(65535)
+            if response[:8] == request[:8]:
+                return True
+
+    def run(self):
+        transaction = self.transaction_tcp if self.protocol == 'TCP' else self.transaction_udp
+        padding = bytes(max(self.size - 8, 0))
+        seq = 0
+        while not self.stopped.is_set():
+            seq += 1
+            request = (struct.pack('!Q', seq) + padding)[:self.size]
+            start = perf_counter_ns()
+            try:
+                done = transaction(request)
+            except socket.timeout:
+                with self.lock:
+                    self.lost += 1
+
+                continue
+            except OSError:
+                done = False
+
+            latency = perf_counter_ns() - start
+            if not done:
+                break
+
+            with self.lock:
+                self.hist.record(latency)
+                self.transactions += 1
+
+        self.sock.close()
+
+
+def run_stream(protocol, server, port, size, interval, repetitions, pipe):
+    '''
+    Run one stream in this process (for UDP, port is the server port of this stream). Reports through pipe: None when connected (or the error),
+    and then, after receiving the start time, at the end of every interval: its end, the
+    transactions, the lost requests, the histogram counts and whether the stream is still alive.
+    '''
+    try:
+        stream = Stream(protocol, server, port, size)
+    except OSError as err:
+        pipe.send(str(err))
+        return
+
+    pipe.send(None)
+    start = pipe.recv()
+    stream.start()
+    for i in range(1, repetitions + 1):
+        sleep(max(start + i * interval - monotonic(), 0))
+        hist, transactions, lost = stream.take()
+        pipe.send((monotonic(), transactions, lost, hist.counts, stream.is_alive()))
+
+    stream.stopped.set()
+
+
+def run_client(protocol, server, port, size, streams, duration, interval):
+    '''
+    Run streams request/response streams (a process each) for duration seconds, and write a JSON
+    line for every interval: its end and its length (s), the transactions and the lost requests
+    (UDP) of every stream, and the histogram of the latencies of all the streams (see
+    Histogram.to_list()). The first line describes the test. Returns the exit status.
+    '''
+    repetitions = max(int(duration / interval + 1e-6), 1)
+    # Forked, as this script is usually read from the standard input, and can not be imported again
+    context = multiprocessing.get_context('fork')
+    pipes = []
+    for s in range(streams):
+        parent_end, child_end = context.Pipe()
+        stream_port = port + s if protocol == 'UDP' else port
+        context.Process(target = run_stream, daemon = True,
+                        args = (protocol, server, stream_port, size, interval, repetitions, child_end)).start()
+        pipes.append(parent_end)
+
+    try:
+        errors = [e for e in [p.recv() for p in pipes] if e]
+        if errors:
+            sys.stderr.write('connect failed: ' + errors[0] + '\n')
+            return 1
+
+        sys.stdout.write(json.dumps({'protocol': protocol, 'size': size, 'streams': streams, 'interval': interval,
+                                     'precision': rr_precision, 'unit': 'ns'}) + '\n')
+        start = last = monotonic()
+        for p in pipes:
+            p.send(start)
+
+        for i in range(1, repetitions + 1):
+            reports = [p.recv() for p in pipes]
+            now = max(r[0] for r in reports)
+            hist = Histogram()
+            for r in reports:
+                hist.merge(Histogram(r[3]))
+
+            report = {'time': round(now - start, 6), 'interval': round(now - last, 6),
+                      'transactions': [r[1] for r in reports], 'hist': hist.to_list()}
+            if protocol == 'UDP':
+                report['lost'] = [r[2] for r in reports]
+
+            sys.stdout.write(json.dumps(report, separators = (',', ':')) + '\n')
+            sys.stdout.flush()
+            last = now
+            if not [r for r in reports if r[4]]:
+                sys.stderr.write('all the streams failed\n')
+                return 1
+
+    except EOFError:
+        sys.stderr.write('a stream process ended unexpectedly\n')
+        return 1
+
+    return 0
+
+
+def main():
+    set_process_name(rr_name)
+    args = sys.argv[1:]
+    if len(args) in [3, 4] and args[0] == 'server' and args[1] in ['TCP', 'UDP']:
+        try:
+            run_server(args[1], int(args[2]), int(args[3]) if len(args) == 4 else 1)
+        except KeyboardInterrupt:
+            pass
+
+    elif len(args) == 8 and args[0] == 'client' and args[1] in ['TCP', 'UDP']:
+        sys.exit(run_client(args[1], args[2], int(args[3]), int(args[4]), int(args[5]), float(args[6]),
+                            float(args[7])))
+    else:
+        print('Usage: ' + sys.argv[0] + ' server <TCP|UDP> <PORT> [<STREAMS (UDP)>]')
+        print('       ' + sys.argv[0] + ' client <TCP|UDP> <SERVER> <PORT> <SIZE (B)> <STREAMS> <DURATION (s)>'
+              ' <INTERVAL (s)>')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
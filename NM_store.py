@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Daynix Computing LTD (www.daynix.com)
+# All rights reserved.
+#
+# Maintained by oss@daynix.com
+#
+# For documentation please refer to README.md available at https://github.com/daynix/NetMeter
+#
+# This code is licensed under standard 3-clause BSD license.
+# See file LICENSE supplied with this package for the full license text.
+
+import numpy as np
+import sqlite3
+from os.path import join, dirname, basename, normpath, isfile
+
+# The store is kept in the export directory, next to the campaign directories.
+store_name = 'NetMeter_results.sqlite'
+
+schema = (
+          'CREATE TABLE IF NOT EXISTS tests (\n'
+          '    campaign TEXT NOT NULL,\n'       # the campaign directory name
+          '    timestamp TEXT NOT NULL,\n'
+          '    protocol TEXT NOT NULL,\n'
+          '    streams INTEGER NOT NULL,\n'
+          '    direction TEXT NOT NULL,\n'
+          '    size INTEGER NOT NULL,\n'
+          '    tcpwin TEXT NOT NULL,\n'         # '' for the default window
+          '    test_ok INTEGER NOT NULL,\n'     # 1: OK, 0: had problems, -1: failed
+          '    bw REAL, bw_stdev REAL, duration REAL, ci REAL,\n'
+          '    cpu REAL, cpu_stdev REAL,\n'
+          '    series BLOB, cpu_series BLOB,\n' # per-interval [time, sum, stdev] rows, float64
+          '    PRIMARY KEY (campaign, direction, size)\n'
+          ');\n'
+          'CREATE INDEX IF NOT EXISTS tests_by_key ON tests\n'
+          '    (protocol, streams, direction, size, tcpwin, timestamp);\n'
+          'CREATE INDEX IF NOT EXISTS tests_by_time ON tests (timestamp);\n'
+         )
+
+
+def store_location(campaign_dir):
+    '''
+    The store and the campaign name for a campaign directory.
+    '''
+    campaign_dir = normpath(campaign_dir)
+    return join(dirname(campaign_dir), store_name), basename(campaign_dir)
+
+
+def to_blob(arr):
+    if arr is None:
+        return None
+
+    return np.ascontiguousarray(arr, dtype=np.float64).tobytes()
+
+
+def from_blob(blob, columns = 3):
+    if blob is None:
+        return None
+
+    return np.frombuffer(blob, dtype=np.float64).reshape((-1, columns))
+
+
+class ResultStore(object):
+    '''
+    An indexed (SQLite) store of the results of all the campaigns in an export directory:
+    the per-size summaries and the per-interval series of every test, keyed by timestamp,
+    protocol, streams, direction, size and TCP window.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def add_test(self, campaign, timestamp, protocol, streams, direction, tcpwin, summary,
+                 cpu_summary = None, series = None, cpu_series = None, commit = True):
+        '''
+        summary - a row of the iperf summary: [TestOK, size, BW, stdev, BW (units), duration, CI].
+        cpu_summary - a row of the mpstat summary: [size, CPU fraction, stdev].
+        series, cpu_series - the processed per-interval data.
+        commit - False to add many tests in one transaction (call commit() after them).
+        '''
+        summary = list(summary) + [0] * (7 - len(summary))
+        cpu, cpu_stdev = (None, None)
+        if cpu_summary is not None:
+            cpu, cpu_stdev = float(cpu_summary[1]), float(cpu_summary[2])
+
+        self.db.execute('INSERT OR REPLACE INTO tests VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                        (campaign, timestamp, protocol, int(streams), direction, int(summary[1]),
+                         str(tcpwin or ''), int(summary[0]), float(summary[2]), float(summary[3]),
+                         float(summary[5]), float(summary[6]), cpu, cpu_stdev,
+                         to_blob(series), to_blob(cpu_series)))
+        if commit:
+            self.db.commit()
+
+    def campaign_info(self, campaign):
+        '''
+        (timestamp, protocol, streams, directions) of a campaign, or None if it is not in the store.
+        '''
+        rows = self.db.execute('SELECT DISTINCT timestamp, protocol, streams, direction FROM tests '
+                               'WHERE campaign = ?', (campaign,)).fetchall()
+        if not rows:
+            return None
+
+        return rows[0][0], rows[0][1], rows[0][2], sorted(set(r[3] for r in rows))
+
+    def campaign_keys(self):
+        '''
+        {campaign: (timestamp, protocol, streams, tcpwin)} of all the campaigns in the store.
+        '''
+        rows = self.db.execute('SELECT DISTINCT campaign, timestamp, protocol, streams, tcpwin FROM tests')
+        return dict((r[0], r[1:]) for r in rows)
+
+    def summaries(self, campaign, direction):
+        '''
+        The summary of a campaign direction, by size. The rows are:
+        [TestOK, size, BW, stdev, duration, CI, CPU fraction, CPU stdev] (NaN if no CPU data).
+        '''
+        rows = self.db.execute('SELECT test_ok, size, bw, bw_stdev, duration, ci, cpu, cpu_stdev '
+                               'FROM tests WHERE campaign = ? AND direction = ? ORDER BY size',
+                               (campaign, direction)).fetchall()
+        return np.array(rows, dtype=np.float64).reshape((-1, 8))
+
+    def series(self, campaign, direction, size):
+        '''
+        The processed per-interval Iperf and CPU data of one test (None if missing).
+        '''
+        row = self.db.execute('SELECT series, cpu_series FROM tests '
+                              'WHERE campaign = ? AND direction = ? AND size = ?',
+                              (campaign, direction, int(size))).fetchone()
+        if not row:
+            return None, None
+
+        return from_blob(row[0]), from_blob(row[1])
+
+    def query(self, protocol, streams, direction, tcpwin = None, campaigns = None):
+        '''
+        The summaries of all the campaigns with the given parameters, ordered by time.
+        Returns the campaign names, and the rows
+        [campaign index, TestOK, size, BW, stdev, CPU fraction, CPU stdev].
+        campaigns - only these campaigns (all of them if None).
+        '''
+        sql = ('SELECT campaign, test_ok, size, bw, bw_stdev, cpu, cpu_stdev FROM tests '
+               'WHERE protocol = ? AND streams = ? AND direction = ? AND tcpwin = ? '
+               'ORDER BY timestamp, campaign, size')
+        rows = self.db.execute(sql, (protocol, int(streams), direction, str(tcpwin or ''))).fetchall()
+        if campaigns != None:
+            campaigns = set(campaigns)
+            rows = [r for r in rows if r[0] in campaigns]
+
+        names = []
+        index = {}
+        for r in rows:
+            if r[0] not in index:
+                index[r[0]] = len(names)
+                names.append(r[0])
+
+        data = np.array([[index[r[0]]] + list(r[1:]) for r in rows], dtype=np.float64)
+        return names, data.reshape((-1, 7))
+
+
+def open_store(campaign_dir):
+    '''
+    The store that holds a campaign directory (or None if there is none), and the campaign name.
+    '''
+    filename, campaign = store_location(campaign_dir)
+    if not isfile(filename):
+        return None, campaign
+
+    return ResultStore(filename), campaign
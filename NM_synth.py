@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Daynix Computing LTD (www.daynix.com)
+# All rights reserved.
+#
+# Maintained by oss@daynix.com
+#
+# For documentation please refer to README.md available at https://github.com/daynix/NetMeter
+#
+# This code is licensed under standard 3-clause BSD license.
+# See file LICENSE supplied with this package for the full license text.
+
+import numpy as np
+import sys
+import json
+import socket
+from datetime import datetime, timedelta
+from time import sleep, time
+from select import select
+from threading import Thread, Lock
+from os import cpu_count
+from NM_rr import Histogram, rr_precision
+
+# The addresses in the synthetic Iperf output (as seen by the server)
+server_ip = '192.168.100.22'
+client_ip = '192.168.100.21'
+server_port = 5001
+# Iperf 2 numbers the connections by their file descriptors
+first_conn = 3
+# The port of the emulated Iperf server (the same as of Iperf), and of the emulated iperf3 one
+emulator_port = 5001
+emulator_port3 = 5201
+# iperf3 numbers the streams by their sockets (after the control connection)
+first_socket = 5
+# The link that the emulator emulates: its rate (b/s), and the per-buffer/datagram overhead
+# in bytes (the rate of a size s is link_rate * s / (s + size_overhead))
+link_rate = 10e9
+size_overhead = 2048
+# The round trip of an empty request/response on the emulated link (s), and the samples of the latency
+# distribution in each interval (the histograms are scaled up to the transactions)
+base_latency = 20e-6
+latency_samples = 10000
+
+mpstat_columns = ['%usr', '%nice', '%sys', '%iowait', '%irq', '%soft', '%steal', '%guest', '%gnice', '%idle']
+
+
+def iperf_stamp(t, interval):
+    '''
+    The Iperf timestamp of a time: "YYYYmmddHHMMSS", with milliseconds for sub-second intervals.
+    '''
+    stamp = t.strftime('%Y%m%d%H%M%S')
+    if interval < 1:
+        stamp += '.' + format(t.microsecond // 1000, '03d')
+
+    return stamp
+
+
+def iperf_blocks(protocol, streams, repetitions, interval = 1.0, rate = 1e9, size = 8192, noise = 0.05,
+                 missing_streams = 0, extra_streams = 0, missing_rows = 0.0, extra_rows = 0.0,
+                 garbled = 0.0, negative = 0.0, tail = 1.0, start = None, seed = None):
+    '''
+    Generate the "-y C" output of an Iperf server, an interval at a time: yields the rows of
+    every interval (the per-connection rows, and the sum row of several streams), and then
+    the rows of the totals of the whole run.
+    repetitions - the intervals of the test. The run goes on for tail more seconds (as NetMeter
+    runs the client), so that the totals are not taken for an interval.
+    rate - the total rate of all the streams (b/s), noise - its relative standard deviation.
+    size - the buffer/datagram size (for the UDP datagram counts).
+    missing_streams, extra_streams - streams that do not reach the server, and unexpected ones.
+    missing_rows, extra_rows - the probabilities of a row to be lost, and to be repeated.
+    garbled - the probability of a row to start with garbage.
+    negative - the probability of a row to have a negative (overflowed) rate.
+    start - the time of the start of the run (now, if None).
+    '''
+    rng = np.random.RandomState(seed)
+    start = start or datetime.now()
+    conns = list(range(first_conn, first_conn + streams - missing_streams + extra_streams))
+    stream_rate = rate / streams
+    totals = dict((c, [0, 0, 0]) for c in conns)
+
+    def row(conn, begin, end, rate, datagrams = None):
+        t = start + timedelta(seconds = end)
+        num_bytes = int(rate * (end - begin) / 8)
+        fields = [iperf_stamp(t, interval), server_ip, str(server_port), client_ip,
+                  str(40000 + conn if conn > 0 else 0), str(conn),
+                  format(begin, '.1f') + '-' + format(end, '.1f')]
+        if rng.random_sample() < negative:
+            fields += ['-' + str(num_bytes), '-' + str(int(rate))]
+        else:
+            fields += [str(num_bytes), str(int(rate))]
+
+        if protocol == 'UDP':
+            total, lost = datagrams
+            fields += [format(rng.uniform(0.005, 0.05), '.3f'), str(lost), str(total),
+                       format(100.0 * lost / max(total, 1), '.3f'), '0']
+
+        line = ','.join(fields)
+        if rng.random_sample() < garbled:
+            cut = rng.randint(1, 12)
+            line = ''.join(chr(c) for c in rng.randint(0, 32, cut)) + line[cut:]
+
+        return line
+
+    for i in range(repetitions + int(tail / interval + 1e-6)):
+        begin, end = i * interval, (i + 1) * interval
+        lines = []
+        interval_total = [0, 0, 0]
+        for c in conns:
+            conn_rate = max(stream_rate * (1 + noise * rng.standard_normal()), 0)
+            datagrams = None
+            if protocol == 'UDP':
+                total = int(conn_rate * interval / 8 / size)
+                datagrams = (total, rng.binomial(total, 0.001))
+
+            totals[c][0] += conn_rate * interval
+            interval_total[0] += conn_rate
+            if datagrams:
+                for t in [totals[c], interval_total]:
+                    t[1] += datagrams[0]
+                    t[2] += datagrams[1]
+
+            if rng.random_sample() < missing_rows:
+                continue
+
+            lines.append(row(c, begin, end, conn_rate, datagrams))
+            if rng.random_sample() < extra_rows:
+                lines.append(lines[-1])
+
+        if len(conns) > 1:
+            lines.append(row(-1, begin, end, interval_total[0], interval_total[1:]))
+
+        yield lines
+
+    duration = repetitions * interval + tail
+    lines = [row(c, 0, duration, totals[c][0] / duration, totals[c][1:]) for c in conns]
+    if len(conns) > 1:
+        lines.append(row(-1, 0, duration, sum(t[0] for t in totals.values()) / duration,
+                         [sum(t[1] for t in totals.values()), sum(t[2] for t in totals.values())]))
+
+    yield lines
+
+
+def iperf3_blocks(protocol, streams, repetitions, interval = 1.0, rate = 1e9, size = 8192, noise = 0.05,
+                  sender = False, json_stream = True, start = None, seed = None):
+    '''
+    Generate the JSON output of iperf3, an interval at a time, as iperf_blocks() does. With json_stream,
+    yields the events of every interval (the start event comes with the first one), and then the totals
+    event. Without it (--json), iperf3 writes the document at the end only: yields nothing for the
+    intervals, and then the whole document.
+    sender - the reports of the client, with the TCP details of the sender (the retransmits, the
+    congestion window and the RTT), instead of those of the server.
+    '''
+    rng = np.random.RandomState(seed)
+    start = start or datetime.now()
+    sockets = list(range(first_socket, first_socket + streams))
+    stream_rate = rate / streams
+    totals = dict((s, [0, 0, 0]) for s in sockets)
+    # The intervals of iperf3 end a little after the round times
+    drift = 4e-5
+
+    def report(socket, begin, end, num_bytes, datagrams = None):
+        r = {'socket': socket, 'start': begin, 'end': end, 'seconds': end - begin, 'bytes': int(num_bytes),
+             'bits_per_second': num_bytes * 8 / (end - begin), 'omitted': False, 'sender': sender}
+        if protocol == 'UDP' and sender:
+            r['packets'] = datagrams[0]
+        elif protocol == 'UDP':
+            r.update({'jitter_ms': rng.uniform(0.005, 0.05), 'lost_packets': datagrams[1],
+                      'packets': datagrams[0], 'lost_percent': 100.0 * datagrams[1] / max(datagrams[0], 1)})
+
+        return r
+
+    def tcp_sender(r, retransmits):
+        r.update({'retransmits': int(retransmits), 'snd_cwnd': int(rng.uniform(2e5, 4e6)),
+                  'snd_wnd': 3145728, 'rtt': int(rng.uniform(50, 500)), 'rttvar': int(rng.uniform(5, 50)),
+                  'pmtu': 1500})
+        return r
+
+    doc = {'start': {'connected': [{'socket': s, 'local_host': client_ip if sender else server_ip,
+                                    'local_port': 40000 + s if sender else emulator_port3,
+                                    'remote_host': server_ip if sender else client_ip,
+                                    'remote_port': emulator_port3 if sender else 40000 + s} for s in sockets],
+                     'version': 'iperf 3.17 (synthetic)',
+                     'timestamp': {'time': start.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+                                   'timesecs': int(start.timestamp())},
+                     'test_start': {'protocol': protocol, 'num_streams': streams, 'blksize': size,
+                                    'duration': repetitions * interval}},
+           'intervals': []}
+
+    def event(name, data):
+        return json.dumps({'event': name, 'data': data}, separators = (',', ':'))
+
+    for i in range(repetitions):
+        begin, end = i * interval + i * drift, (i + 1) * interval + (i + 1) * drift
+        reports = []
+        for s in sockets:
+            num_bytes = max(stream_rate * (1 + noise * rng.standard_normal()), 0) * (end - begin) / 8
+            datagrams = None
+            if protocol == 'UDP':
+                total = int(num_bytes / size)
+                datagrams = (total, rng.binomial(total, 0.001))
+                totals[s][1] += datagrams[0]
+                totals[s][2] += datagrams[1]
+
+            totals[s][0] += num_bytes
+            reports.append(report(s, begin, end, num_bytes, datagrams))
+            if protocol == 'TCP' and sender:
+                tcp_sender(reports[-1], rng.poisson(2))
+
+        sum_bytes = sum(r['bytes'] for r in reports)
+        interval_sum = {'start': begin, 'end': end, 'seconds': end - begin, 'bytes': sum_bytes,
+                        'bits_per_second': sum_bytes * 8 / (end - begin), 'omitted': False, 'sender': sender}
+        interval_report = {'streams': reports, 'sum': interval_sum}
+        if json_stream:
+            yield ([event('start', doc['start'])] if i == 0 else []) + [event('interval', interval_report)]
+        else:
+            doc['intervals'].append(interval_report)
+            yield []
+
+    duration = repetitions * (interval + drift)
+    streams_end = []
+    for s in sockets:
+        datagrams = totals[s][1:]
+        sent = report(s, 0, duration, totals[s][0], datagrams)
+        sent['sender'] = True
+        received = report(s, 0, duration, totals[s][0], datagrams)
+        received['sender'] = False
+        if protocol == 'TCP':
+            sent.update({'retransmits': int(rng.poisson(2 * repetitions)), 'max_rtt': 500, 'min_rtt': 50,
+                         'mean_rtt': 275})
+
+        streams_end.append({'sender': sent, 'receiver': received})
+
+    total_bytes = sum(t[0] for t in totals.values())
+    doc['end'] = {'streams': streams_end,
+                  'sum_sent': {'start': 0, 'end': duration, 'seconds': duration, 'bytes': int(total_bytes),
+                               'bits_per_second': total_bytes * 8 / duration, 'sender': True},
+                  'sum_received': {'start': 0, 'end': duration, 'seconds': duration, 'bytes': int(total_bytes),
+                                   'bits_per_second': total_bytes * 8 / duration, 'sender': False},
+                  'cpu_utilization_percent': {}}
+    # The total, user and system CPU utilisation of the sender and of the receiver
+    cpu = [(35.0, 5.0, 30.0), (25.0, 3.0, 22.0)]
+    for (host, usage) in zip(['host_', 'remote_'], cpu if sender else cpu[::-1]):
+        doc['end']['cpu_utilization_percent'].update(zip([host + 'total', host + 'user', host + 'system'], usage))
+
+    if json_stream:
+        yield [event('end', doc['end'])]
+    else:
+        # cJSON formats the document with tabs
+        yield json.dumps(doc, indent = '\t', separators = (',', ':\t')).splitlines()
+
+
+def rr_blocks(protocol, streams, repetitions, interval = 1.0, size = 1024, noise = 0.05, seed = None):
+    '''
+    Generate the output of the client of NM_rr.py, an interval at a time: yields the description of
+    the test with the first interval, and then the line of every interval. The latency of a transaction
+    is the base latency and the time of the request and of the response on the link, with a log-normal
+    spread and a tail of 1% of transactions that wait 5 times longer.
+    '''
+    rng = np.random.RandomState(seed)
+    latency = base_latency + 2 * (size + size_overhead) * 8 / link_rate
+    header = json.dumps({'protocol': protocol, 'size': size, 'streams': streams, 'interval': interval,
+                         'precision': rr_precision, 'unit': 'ns'})
+    for i in range(repetitions):
+        # Every stream waits for each response before the next request
+        transactions = [int(max(interval / latency * (1 + noise * rng.standard_normal()), 0)) for s in range(streams)]
+        samples = latency * 1e9 * rng.lognormal(0, 0.25, latency_samples)
+        samples[rng.uniform(size = latency_samples) < 0.01] *= 5
+        samples = np.maximum(samples, 1).astype(np.int64)
+        e = np.maximum(np.floor(np.log2(samples)).astype(np.int64) + 1 - rr_precision, 0)
+        buckets, counts = np.unique((e << (rr_precision - 1)) + (samples >> e), return_counts = True)
+        counts = rng.multinomial(sum(transactions), counts / float(latency_samples))
+        hist = Histogram(dict((int(b), int(c)) for (b, c) in zip(buckets, counts) if c))
+        report = {'time': round((i + 1) * interval, 6), 'interval': interval, 'transactions': transactions,
+                  'hist': hist.to_list()}
+        if protocol == 'UDP':
+            report['lost'] = [int(rng.poisson(0.0001 * t)) for t in transactions]
+
+        yield ([header] if i == 0 else []) + [json.dumps(report, separators = (',', ':'))]
+
+
+def mpstat_blocks(num_cpu, count, interval = 1, load = 0.3, noise = 0.05, start = None, ampm = False,
+                  seed = None):
+    '''
+    Generate the output of "mpstat -P ALL interval count", a measurement at a time: yields the
+    header lines, the lines of every measurement (the "all" row and a row per core), and then
+    the averages.
+    load - the mean busy fraction of the cores, noise - its standard deviation.
+    ampm - the 12-hour time format of some locales.
+    '''
+    rng = np.random.RandomState(seed)
+    start = start or datetime.now()
+    time_format = '%I:%M:%S %p' if ampm else '%H:%M:%S'
+    header = '  CPU' + ''.join(format(c, '>8') for c in mpstat_columns)
+    yield ['Linux 4.4.0 (synthetic) \t' + start.strftime('%m/%d/%Y') + ' \t_x86_64_\t(' + str(num_cpu) + ' CPU)', '']
+
+    def row(stamp, cpu, busy):
+        # The busy time is split between the user, system, irq and softirq times
+        usage = np.array([0.5, 0, 0.3, 0, 0.05, 0.15, 0, 0, 0]) * busy * 100
+        return stamp + format(cpu, '>5') + ''.join(format(u, '8.2f') for u in usage) + format(100 - busy * 100, '8.2f')
+
+    busy_sum = np.zeros(num_cpu)
+    for i in range(count):
+        stamp = (start + timedelta(seconds = (i + 1) * interval)).strftime(time_format)
+        busy = np.clip(load + noise * rng.standard_normal(num_cpu), 0, 1)
+        busy_sum += busy
+        yield ([stamp + header, row(stamp, 'all', busy.mean())] +
+               [row(stamp, str(c), b) for (c, b) in enumerate(busy)] + [''])
+
+    busy = busy_sum / max(count, 1)
+    yield (['Average:' + header, row('Average:', 'all', busy.mean())] +
+           [row('Average:', str(c), b) for (c, b) in enumerate(busy)])
+
+
+def write_iperf(filename, *args, **kwargs):
+    '''
+    Write a whole synthetic Iperf server output (see iperf_blocks() for the arguments).
+    '''
+    with open(filename, 'w') as outfile:
+        for lines in iperf_blocks(*args, **kwargs):
+            outfile.write(''.join(l + '\n' for l in lines))
+
+
+def iperf3_error(message, json_stream = True):
+    '''
+    The output of iperf3 for a test that failed.
+    '''
+    if json_stream:
+        return json.dumps({'event': 'error', 'data': message}, separators = (',', ':'))
+
+    return json.dumps({'start': {}, 'intervals': [], 'end': {}, 'error': message}, indent = '\t',
+                      separators = (',', ':\t'))
+
+
+def write_iperf3(filename, *args, **kwargs):
+    '''
+    Write a whole synthetic iperf3 output (see iperf3_blocks() for the arguments).
+    '''
+    with open(filename, 'w') as outfile:
+        for lines in iperf3_blocks(*args, **kwargs):
+            outfile.write(''.join(l + '\n' for l in lines))
+
+
+def write_rr(filename, *args, **kwargs):
+    '''
+    Write a whole synthetic output of the NM_rr.py client (see rr_blocks() for the arguments).
+    '''
+    with open(filename, 'w') as outfile:
+        for lines in rr_blocks(*args, **kwargs):
+            outfile.write(''.join(l + '\n' for l in lines))
+
+
+def write_mpstat(filename, *args, **kwargs):
+    '''
+    Write a whole synthetic mpstat output (see mpstat_blocks() for the arguments).
+    '''
+    with open(filename, 'w') as outfile:
+        for lines in mpstat_blocks(*args, **kwargs):
+            outfile.write(''.join(l + '\n' for l in lines))
+
+
+def write_cpustat(filename, num_cpu, count, interval = 1.0, load = 0.3, noise = 0.05, hz = 100, seed = None):
+    '''
+    Write synthetic samples of the /proc/stat counters, as a CPUSampler saves them (.npz).
+    '''
+    rng = np.random.RandomState(seed)
+    ticks = int(round(interval * hz))
+    busy = np.clip(load + noise * rng.standard_normal((count, num_cpu)), 0, 1)
+    busy_ticks = np.round(busy * ticks).astype(np.int64)
+    stat = np.zeros((count, num_cpu, 10), dtype=np.int64)
+    # user, system, softirq and idle
+    stat[:,:,0] = busy_ticks // 2
+    stat[:,:,2] = busy_ticks // 3
+    stat[:,:,6] = busy_ticks - stat[:,:,0] - stat[:,:,2]
+    stat[:,:,3] = ticks - busy_ticks
+    times = (np.arange(count) + 1) * interval + rng.uniform(0, 0.002, count)
+    np.savez_compressed(filename, times = times, stat = stat)
+
+
+def option(args, name, default = None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def emulated_rate(protocol, size):
+    return link_rate * size / (size + size_overhead) * (0.9 if protocol == 'UDP' else 1)
+
+
+def emulate_server(args, factor):
+    '''
+    Emulate "iperf -s -i <interval> -y C [-u]": listen on emulator_port (TCP, and also UDP with -u,
+    so that the server is seen listening as usual), and for every client that connects, write the
+    rows of its test to the standard output as the (compressed) time goes by. A client that goes
+    away early ends its test without the totals. The timestamps follow an emulated clock, that runs
+    1 / factor times faster than the real one from the start of the server.
+    With --json-stream or --json, emulate "iperf3 -s -i <interval>" instead: listen on emulator_port3,
+    take the protocol from the client, and write the JSON output.
+    '''
+    server_start = time()
+    interval = float(option(args, '-i', 1))
+    json_output = '--json-stream' in args or '--json' in args
+    protocol = 'UDP' if '-u' in args else 'TCP'
+    lock = Lock()
+    control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    control.bind(('127.0.0.1', emulator_port3 if json_output else emulator_port))
+    control.listen(16)
+    if protocol == 'UDP':
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp.bind(('127.0.0.1', emulator_port))
+
+    def run_test(conn):
+        job = json.loads(conn.makefile().readline())
+        size = job['size']
+        test_protocol = job.get('protocol', protocol)
+        rate = emulated_rate(test_protocol, size)
+        start = time()
+        repetitions = int(job['runtime'] / interval + 1e-6)
+        if json_output:
+            blocks = iperf3_blocks(test_protocol, job['streams'], repetitions, interval, rate, size,
+                                   json_stream = '--json-stream' in args,
+                                   start = datetime.fromtimestamp(server_start + (start - server_start) / factor))
+        else:
+            blocks = iperf_blocks(protocol, job['streams'], repetitions, interval, rate, size,
+                                  tail = job['runtime'] - repetitions * interval,
+                                  start = datetime.fromtimestamp(server_start + (start - server_start) / factor))
+
+        for (i, lines) in enumerate(blocks):
+            # The totals come right after the last interval
+            wait = max(0, start + (i + 1) * interval * factor - time()) if i < repetitions else 0
+            if select([conn], [], [], wait)[0] and not conn.recv(1):
+                # The client is gone. iperf3 reports it as the error of the test.
+                if json_output:
+                    with lock:
+                        sys.stdout.write(iperf3_error('the client has unexpectedly closed the connection',
+                                                      '--json-stream' in args) + '\n')
+                        sys.stdout.flush()
+
+                break
+
+            with lock:
+                sys.stdout.write(''.join(l + '\n' for l in lines))
+                sys.stdout.flush()
+
+        conn.close()
+
+    while True:
+        conn, addr = control.accept()
+        Thread(target = run_test, args = (conn,), daemon = True).start()
+
+
+def emulate_client(args, factor):
+    '''
+    Emulate "iperf -c <server> -t <time> -l <size> -P <streams> ...": ask the emulated server
+    (on this machine, whatever the server address is) for a test, and stay connected until it is over.
+    With --json-stream or --json, emulate the iperf3 client: ask the emulated iperf3 server, and write
+    the JSON output of the sender at the end.
+    '''
+    json_output = '--json-stream' in args or '--json' in args
+    job = {'runtime': float(option(args, '-t', 10)), 'size': int(option(args, '-l', 8192)),
+           'streams': int(option(args, '-P', 1)), 'protocol': 'UDP' if '-u' in args else 'TCP'}
+    try:
+        conn = socket.create_connection(('127.0.0.1', emulator_port3 if json_output else emulator_port))
+    except OSError as err:
+        sys.stderr.write('connect failed: ' + str(err) + '\n')
+        sys.exit(1)
+
+    conn.sendall((json.dumps(job) + '\n').encode())
+    # The server closes the connection after the totals
+    conn.recv(1)
+    conn.close()
+    if json_output:
+        interval = float(option(args, '-i', 1))
+        for lines in iperf3_blocks(job['protocol'], job['streams'], int(job['runtime'] / interval + 1e-6),
+                                   interval, emulated_rate(job['protocol'], job['size']), job['size'],
+                                   sender = True, json_stream = '--json-stream' in args):
+            sys.stdout.write(''.join(l + '\n' for l in lines))
+
+
+def emulate_rr_server(args, factor):
+    '''
+    Emulate "NM_rr.py server <TCP|UDP> <port> [<streams>]": listen on the port (TCP, and also UDP for UDP), and hold
+    the connections of the emulated clients until they are over.
+    '''
+    port = int(args[2])
+    control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    control.bind(('127.0.0.1', port))
+    control.listen(16)
+    if args[1] == 'UDP':
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp.bind(('127.0.0.1', port))
+
+    def hold(conn):
+        while conn.recv(1024):
+            pass
+
+        conn.close()
+
+    while True:
+        conn, addr = control.accept()
+        Thread(target = hold, args = (conn,), daemon = True).start()
+
+
+def emulate_rr_client(args, factor):
+    '''
+    Emulate "NM_rr.py client <TCP|UDP> <server> <port> <size> <streams> <duration> <interval>": connect to
+    the emulated server (on this machine, whatever the server address is), and write the output of the
+    test as the (compressed) time goes by.
+    '''
+    protocol, port, size, streams = args[1], int(args[3]), int(args[4]), int(args[5])
+    interval = float(args[7])
+    try:
+        conn = socket.create_connection(('127.0.0.1', port))
+    except OSError as err:
+        sys.stderr.write('connect failed: ' + str(err) + '\n')
+        sys.exit(1)
+
+    start = time()
+    for (i, lines) in enumerate(rr_blocks(protocol, streams, max(int(float(args[6]) / interval + 1e-6), 1),
+                                          interval, size)):
+        sleep(max(0, start + (i + 1) * interval * factor - time()))
+        sys.stdout.write(''.join(l + '\n' for l in lines))
+        sys.stdout.flush()
+
+    conn.close()
+
+
+def emulate_mpstat(args, factor):
+    '''
+    Emulate "mpstat -P ALL <interval> <count>" on the cores of this machine, in compressed time.
+    '''
+    interval, count = int(args[-2]), int(args[-1])
+    start = time()
+    for (i, lines) in enumerate(mpstat_blocks(cpu_count() or 1, count, interval)):
+        if 0 < i <= count:
+            sleep(max(0, start + i * interval * factor - time()))
+
+        sys.stdout.write(''.join(l + '\n' for l in lines))
+        sys.stdout.flush()
+
+
+def emulate(args):
+    '''
+    The emulator of the "simulate" access method of NetMeter:
+    emulate <client name> iperf|rr|mpstat <time factor> <the Iperf/NM_rr.py/mpstat arguments>
+    The client name only tells the emulators of the simulated clients apart.
+    '''
+    factor = float(args[2])
+    try:
+        if args[1] == 'mpstat':
+            emulate_mpstat(args[3:], factor)
+        elif args[1] == 'rr' and args[3] == 'server':
+            emulate_rr_server(args[3:], factor)
+        elif args[1] == 'rr':
+            emulate_rr_client(args[3:], factor)
+        elif '-s' in args:
+            emulate_server(args[3:], factor)
+        else:
+            emulate_client(args[3:], factor)
+
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    if len(sys.argv) > 4 and sys.argv[1] == 'emulate':
+        emulate(sys.argv[2:])
+    elif len(sys.argv) in [6, 7] and sys.argv[1] in ['iperf', 'iperf3'] and sys.argv[3] in ['TCP', 'UDP']:
+        interval = float(sys.argv[6]) if len(sys.argv) == 7 else 1.0
+        write = write_iperf if sys.argv[1] == 'iperf' else write_iperf3
+        write(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(float(sys.argv[5]) / interval + 1e-6),
+              interval)
+    elif len(sys.argv) in [7, 8] and sys.argv[1] == 'rr' and sys.argv[3] in ['TCP', 'UDP']:
+        interval = float(sys.argv[7]) if len(sys.argv) == 8 else 1.0
+        write_rr(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(float(sys.argv[5]) / interval + 1e-6),
+                 interval, int(sys.argv[6]))
+    elif len(sys.argv) in [5, 6] and sys.argv[1] in ['mpstat', 'cpustat']:
+        interval = float(sys.argv[5]) if len(sys.argv) == 6 else 1.0
+        write = write_mpstat if sys.argv[1] == 'mpstat' else write_cpustat
+        write(sys.argv[2], int(sys.argv[3]), int(float(sys.argv[4])), interval)
+    else:
+        print('Usage: ' + sys.argv[0] + ' iperf <OUTPUT FILE> <TCP|UDP> <STREAMS> <DURATION (s)> [<INTERVAL (s)>]')
+        print('       ' + sys.argv[0] + ' iperf3 <OUTPUT FILE> <TCP|UDP> <STREAMS> <DURATION (s)> [<INTERVAL (s)>]')
+        print('       ' + sys.argv[0] + ' rr <OUTPUT FILE> <TCP|UDP> <STREAMS> <DURATION (s)> <SIZE (B)> [<INTERVAL (s)>]')
+        print('       ' + sys.argv[0] + ' mpstat <OUTPUT FILE> <CPUS> <COUNT> [<INTERVAL (s)>]')
+        print('       ' + sys.argv[0] + ' cpustat <OUTPUT FILE (.npz)> <CPUS> <COUNT> [<INTERVAL (s)>]')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
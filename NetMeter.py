@@ -13,17 +13,32 @@
 import numpy as np
 import sys
 import signal
+import json
+import re
 from datetime import datetime, timedelta
-from time import sleep
-from subprocess import Popen, PIPE
-from os import makedirs
-from os.path import isdir, isfile, join
+from time import sleep, time
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+from os import makedirs, remove, walk, replace, geteuid
+from glob import glob
+from os.path import isdir, isfile, join, getsize, exists, abspath
+from threading import local, Thread, Event
+from tempfile import gettempdir
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from hashlib import sha256
+from inspect import getsource
+from codecs import getincrementaldecoder
+from array import array
 from ntpath import dirname, basename
 
 # Import configuration
 from NetMeterConfig import *
+from NM_store import ResultStore, store_name
+from NM_common import t_quantile_975, run_gnuplot
+from NM_rr import Histogram, rr_port, rr_name, rr_precision
 
 rundate = datetime.now().strftime('%Y_%m_%d_%H-%M-%S')
+# With simulated clients, all the test times (and the waits for them) are compressed by sim_time_factor
+time_factor = sim_time_factor if 'simulate' in [access_method_cl1, access_method_cl2] else 1
 logo = (
         'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAGkAAAATCAYAAACTOyOdAAAAIGNIUk0AAHomAACAhAAA+gAAAIDo'
         'AAB1MAAA6mAAADqYAAAXcJy6UTwAAAAGYktHRAD/AP8A/6C9p5MAAAAJcEhZcwAACxMAAAsTAQCa'
@@ -91,32 +106,99 @@ logo = (
 
 class Connect(object):
     def __init__(self, access_method, ip, conn_name, iperf_bin, ssh_port = 22,
-                 creds = None):
+                 creds = None, python_bin = 'python3'):
         self.conn_type = basename(access_method)
         self.conn_name = conn_name
         self.creds = creds
         self.ip = ip
         self.ssh_port = ssh_port
         self.verify_credsfile()
-        self.iperf_cmd = [iperf_bin]
-        if self.conn_type == 'local':
-            self.stop_iperf = ['killall', '-9', basename(iperf_bin)]
-        elif self.conn_type == 'ssh':
-            self.auth = [access_method, '-i', self.key, '-p', str(ssh_port), '-l', self.username,
-                         '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
-                         '-o', 'BatchMode=yes', '-o', 'LogLevel=ERROR', ip]
-            self.stop_iperf = ['killall', '-9', basename(iperf_bin)]
+        self.iperf_bin = iperf_bin
+        self.python_bin = python_bin
+        self.test_iface = {}
+        self.control_path = None
+        self.mpstat_found = None
+        if self.conn_type == 'simulate':
+            # Iperf and mpstat are emulated on the local machine, in compressed time (see NM_synth.py)
+            self.emulator = [sys.executable, join(dirname(abspath(__file__)), 'NM_synth.py'), 'emulate', conn_name]
+        elif self.conn_type == 'netns':
+            # The client is a network namespace of the local machine (see setup_netns())
+            self.netns = 'NetMeter_' + conn_name
+            cpus = {'cl1': netns_cpus_cl1, 'cl2': netns_cpus_cl2}.get(conn_name)
+            self.netns_exec = (([] if geteuid() == 0 else ['sudo', '-n']) + ['ip', 'netns', 'exec', self.netns] +
+                               (['taskset', '-c', cpus] if cpus else []))
+
+        if self.conn_type in ['local', 'ssh', 'simulate', 'netns']:
+            self.list_sockets = {'TCP': ['cat', '/proc/net/tcp', '/proc/net/tcp6'],
+                                 'UDP': ['cat', '/proc/net/udp', '/proc/net/udp6']}
+            self.net_dev = ['cat', '/proc/net/dev']
+
+        if self.conn_type == 'ssh':
+            self.ssh_opts = [access_method, '-i', self.key, '-p', str(ssh_port), '-l', self.username,
+                             '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+                             '-o', 'BatchMode=yes', '-o', 'LogLevel=ERROR']
+            if ssh_multiplexing:
+                # All the commands go through one master connection per client.
+                # The master is closed after 10 idle minutes, if NetMeter does not close it.
+                self.control_path = join(gettempdir(), 'NetMeter_' + rundate + '_' + conn_name)
+                self.ssh_opts += ['-o', 'ControlPath=' + self.control_path, '-o', 'ControlPersist=600']
+
+            self.auth = self.ssh_opts + ['-o', 'ControlMaster=' + ('auto' if ssh_multiplexing else 'no'), ip]
             self.shutdown_command = ['sudo', 'shutdown', '-h', 'now']
         elif self.conn_type == 'winexe':
             self.auth = [access_method, '-A',  self.creds, '//' + ip]
-            self.stop_iperf = ['taskkill /im ' + basename(iperf_bin) + ' /f']
             self.shutdown_command = ['shutdown /t 10 /s /f']
-        else:
+            self.list_sockets = {'TCP': ['netstat -an -p TCP'], 'UDP': ['netstat -an -p UDP']}
+            # No /proc/net/dev on Windows: the interface quiet check is skipped.
+            self.net_dev = None
+        elif self.conn_type == 'simulate':
+            # No emulated interfaces: the interface quiet check and the counters are skipped.
+            self.net_dev = None
+        elif self.conn_type not in ['local', 'netns']:
             print('\033[91mConnection method not supported.\033[0m Exiting.')
             sys.exit(1)
 
+        self.set_tool(iperf)
+
+    def set_tool(self, tool):
+        '''
+        Set the tool that the test commands (iperf_cmd, list_iperf, stop_iperf...) run: the Iperf
+        backend, or rr_tool for the request/response tests. rr_tool runs NM_rr.py on the Python of
+        the client, which reads it from the standard input (tool_input).
+        '''
+        self.tool = tool
+        self.tool_input = None
+        if tool.rr:
+            self.iperf_cmd = [self.python_bin, '-']
+            self.iperf_name = rr_name
+            self.tool_input = join(dirname(abspath(__file__)), 'NM_rr.py')
+        else:
+            self.iperf_cmd = [self.iperf_bin]
+            self.iperf_name = basename(self.iperf_bin)
+
+        if self.conn_type in ['local', 'ssh']:
+            self.list_iperf = ['pgrep', '-l', '-x', self.iperf_name]
+            self.stop_iperf = ['killall', '-9', self.iperf_name]
+        elif self.conn_type == 'winexe':
+            self.list_iperf = ['tasklist /nh /fi "imagename eq ' + self.iperf_name + '"']
+            self.stop_iperf = ['taskkill /im ' + self.iperf_name + ' /f']
+        elif self.conn_type == 'simulate':
+            # The emulators of the two simulated clients are told apart by the client name
+            emulated = 'rr' if tool.rr else 'iperf'
+            self.iperf_cmd = self.emulator + [emulated, format(sim_time_factor, 'g')]
+            self.iperf_name = 'NM_synth.py'
+            self.tool_input = None
+            self.list_iperf = ['pgrep', '-a', '-f', 'NM_synth.py emulate ' + self.conn_name + ' ' + emulated]
+            self.stop_iperf = ['pkill', '-9', '-f', 'NM_synth.py emulate ' + self.conn_name + ' ' + emulated]
+        elif self.conn_type == 'netns':
+            # The processes of the namespace only: the other client runs the same Iperf on this machine
+            pids = 'for p in $(ip netns pids ' + self.netns + '); do '
+            self.list_iperf = ['sh', '-c', pids + 'cat /proc/$p/comm 2>/dev/null; done']
+            self.stop_iperf = ['sh', '-c', pids + '[ "$(cat /proc/$p/comm 2>/dev/null)" = "' + self.iperf_name[:15] +
+                               '" ] && kill -9 $p; done; true']
+
     def islocal(self):
-        if self.conn_type == 'local':
+        if self.conn_type in ['local', 'netns']:
             return True
         else:
             return False
@@ -124,42 +206,238 @@ class Connect(object):
     def getname(self):
         return self.conn_name
 
-    def get_command(self, args, outfile = None, errfile = None):
+    def master_alive(self):
+        p = Popen(self.ssh_opts + ['-O', 'check', self.ip], stdout=PIPE, stderr=PIPE)
+        p.communicate()
+        return p.returncode == 0
+
+    def open_master(self):
+        '''
+        Make sure the ssh master connection is up, (re)connecting if needed.
+        '''
+        if not self.control_path or self.master_alive():
+            return
+
+        if exists(self.control_path):
+            # A socket left by a master that dropped
+            remove(self.control_path)
+
+        p = Popen(self.ssh_opts + ['-o', 'ControlMaster=yes', '-N', '-f', self.ip], stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        if p.returncode:
+            print('\033[93mWARNING:\033[0m Could not open the ssh master connection to ' +
+                  self.conn_name + ': ' + err.decode('ascii', errors='ignore').strip())
+
+    def close_master(self):
+        if self.control_path and self.master_alive():
+            p = Popen(self.ssh_opts + ['-O', 'exit', self.ip], stdout=PIPE, stderr=PIPE)
+            p.communicate()
+
+    def wrap_command(self, cmd):
+        if self.conn_type in ['local', 'simulate']:
+            return cmd
+        elif self.conn_type == 'netns':
+            return self.netns_exec + cmd
+        else:
+            self.open_master()
+            return self.auth + [' '.join(cmd)]
+
+    def get_command(self, args, outfile = None, errfile = None, append = False):
         if args == 'stop_iperf':
             cmd = self.stop_iperf
         else:
             cmd = self.iperf_cmd + args
 
         if outfile:
-            if self.conn_type == 'local':
+            if self.conn_type in ['local', 'simulate']:
                 self.print_cmd = ' '.join(cmd)
+            elif self.conn_type == 'netns':
+                self.print_cmd = ' '.join(self.wrap_command(cmd))
             else:
+                self.open_master()
                 self.print_cmd = ' '.join(self.auth) + ' "' + ' '.join(cmd) + '"'
 
             err_redirect = ''
+            redirect = ' >> ' if append else ' > '
 
             if (errfile):
-                err_redirect = ' 2> ' + errfile
+                err_redirect = redirect.replace('>', '2>', 1) + errfile
+
+            if self.tool_input:
+                err_redirect += ' < ' + self.tool_input
+
+            return self.print_cmd, redirect + outfile + err_redirect
+
+        return self.wrap_command(cmd)
+
+    def run_command(self, cmd):
+        '''
+        Run a short command on the client and return its standard output.
+        Used by the readiness probes, so the commands are not logged.
+        '''
+        p = Popen(self.wrap_command(cmd), stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        return out.decode('ascii', errors='ignore')
+
+    def iperf_running(self):
+        # pgrep reports at most 15 characters of the process name
+        return self.iperf_name[:15] in self.run_command(self.list_iperf)
+
+    def iperf_listening(self, protocol):
+        protocol = self.tool.listen_protocol(protocol)
+        for line in self.run_command(self.list_sockets[protocol]).splitlines():
+            fields = line.split()
+            if self.conn_type == 'winexe':
+                # TCP    0.0.0.0:5001    0.0.0.0:0    LISTENING
+                # UDP    0.0.0.0:5001    *:*
+                if len(fields) < 2 or fields[0] != protocol or fields[1].rsplit(':', 1)[-1] != str(self.tool.port):
+                    continue
+
+                if protocol == 'UDP' or (len(fields) >= 4 and fields[3] == 'LISTENING'):
+                    return True
+
+            elif len(fields) >= 4 and ':' in fields[1]:
+                # sl  local_address rem_address   st ... (ports and states are hex)
+                try:
+                    port = int(fields[1].rsplit(':', 1)[1], 16)
+                except ValueError:
+                    continue
+
+                if port == self.tool.port and (protocol == 'UDP' or fields[3] == '0A'):
+                    return True
+
+        return False
+
+    def get_test_iface(self, test_ip):
+        if not self.net_dev:
+            return None
+
+        if test_ip not in self.test_iface:
+            out = self.run_command(['ip', '-o', 'addr', 'show', 'to', test_ip]).split()
+            self.test_iface[test_ip] = out[1].split('@')[0] if len(out) > 1 else None
+
+        return self.test_iface[test_ip]
+
+    def nic_bytes(self, iface):
+        '''
+        Total of received and transmitted bytes on an interface, from /proc/net/dev.
+        '''
+        for line in self.run_command(self.net_dev).splitlines():
+            name, sep, counters = line.partition(':')
+            if sep and name.strip() == iface:
+                counters = counters.split()
+                return int(counters[0]) + int(counters[8])
+
+        return None
+
+    def measures_cpu(self):
+        '''
+        Whether the CPU usage is measured on this client: always on the local machine (also
+        for the netns clients), and on ssh clients if remote_cpu is set and mpstat is installed
+        there (on simulated clients it is emulated, if remote_cpu is set).
+        '''
+        if self.islocal():
+            return True
 
-            return self.print_cmd, ' > ' + outfile + err_redirect
+        if self.conn_type == 'simulate':
+            return remote_cpu
 
-        if self.conn_type == 'local':
-            return cmd
+        if self.conn_type != 'ssh' or not remote_cpu:
+            return False
+
+        if self.mpstat_found == None:
+            self.mpstat_found = bool(self.run_command(['command', '-v', 'mpstat']).strip())
+            if not self.mpstat_found:
+                print('\033[93mWARNING:\033[0m mpstat was not found on ' + self.conn_name +
+                      ' (it is in the sysstat package). Its CPU usage will not be measured.')
+
+        return self.mpstat_found
+
+    def start_cpu_sampling(self, init_name, tag, duration):
+        '''
+        Start measuring the CPU usage for a test of the given duration. On the local machine
+        it is sampled by a CPUSampler (with cpu_sampler), or by mpstat. On ssh clients mpstat
+        runs remotely, and its output comes back through the (master) ssh connection.
+        Returns the sampler, or the mpstat process.
+        '''
+        if self.islocal() and cpu_sampler:
+            sampler = CPUSampler(report_interval, max(1, int(round(duration / report_interval))),
+                                 init_name + '_cpustat' + tag + '.npz', cpu_softirqs)
+            sampler.start()
+            return sampler
+
+        # mpstat can not sample more often than every second
+        interval = max(1, int(round(report_interval)))
+        cmd = ['mpstat', '-P', 'ALL', str(interval), str(max(1, int(duration / interval)))]
+        if self.conn_type == 'simulate':
+            cmd = self.emulator + ['mpstat', format(sim_time_factor, 'g')] + cmd[1:]
+
+        with open(init_name + '_mpstat' + tag + '.dat', 'w') as mpstat_out:
+            return Popen(self.wrap_command(cmd), stdout=mpstat_out)
+
+    def start_counters(self, iface, interval, count, outname):
+        '''
+        Start sampling, count + 1 times, every interval seconds, the counters of the test interface
+        (/proc/net/dev), the TCP and UDP counters (/proc/net/snmp), and the interrupts of the
+        interface (/proc/interrupts: the MSI interrupts of its device, and the ones named after it).
+        The samples are taken at fixed times from the first one, so that they do not drift.
+        The raw samples are written to outname. Returns the sampling (shell) process.
+        '''
+        device = '/sys/class/net/' + iface + '/device'
+        script = ("irqs=$(ls " + device + "/msi_irqs " + device + "/../msi_irqs 2>/dev/null | grep -x '[0-9]*'); "
+                  "pattern=' " + iface + "(-|$)'; for n in $irqs; do pattern=\"$pattern|^ *$n:\"; done; "
+                  "echo '#IFACE " + iface + "'; echo \"#CPUS $(head -n 1 /proc/interrupts)\"; "
+                  "start=$(date +%s.%N); for i in $(seq 0 " + str(count) + "); do "
+                  "[ $i -gt 0 ] && sleep $(awk -v s=$start -v i=$i -v now=$(date +%s.%N) "
+                  "'BEGIN { d = s + i * " + format(interval, 'g') + " - now; print (d > 0 ? d : 0) }'); "
+                  "echo \"#T $(date +%s.%N)\"; cat /proc/net/dev /proc/net/snmp; "
+                  "grep -E \"$pattern\" /proc/interrupts; done")
+        if self.conn_type in ['local', 'netns']:
+            cmd = self.wrap_command(['sh', '-c', script])
         else:
-            return self.auth + [' '.join(cmd)]
+            self.open_master()
+            cmd = self.auth + [script]
+
+        with open(outname, 'w') as counters_out:
+            return Popen(cmd, stdout=counters_out)
+
+    def stop_sampling(self, proc, counters = False):
+        '''
+        Stop a CPU or a counters (counters = True) sampling that did not finish by itself.
+        '''
+        if isinstance(proc, CPUSampler):
+            proc.stop()
+            proc.wait()
+            return
+
+        if self.conn_type in ['local', 'simulate', 'netns'] and not counters:
+            # On SIGINT mpstat finishes with the averages, which are ignored.
+            proc.send_signal(signal.SIGINT)
+        else:
+            # A shell (bash) defers SIGINT until its sleep is over, but not SIGTERM.
+            # The remote process exits on its next write to the closed connection.
+            proc.terminate()
+
+        try:
+            proc.wait(client_finish_timeout)
+        except TimeoutExpired:
+            proc.kill()
+            proc.wait()
 
     def shutdown(self):
-        if self.conn_type != 'local':
+        if self.conn_type not in ['local', 'simulate', 'netns']:
             print('Shutting down ' + self.conn_name + '...')
             if self.conn_type == 'ssh':
                 self.auth = self.auth[:-1] + ['-t'] + [self.auth[-1]]
 
+            self.open_master()
             p = Popen(self.auth + self.shutdown_command)
             p.wait()
+            self.close_master()
             sleep(10)
 
     def verify_credsfile(self):
-        if self.conn_type != 'local' and (not isfile(self.creds)):
+        if self.conn_type not in ['local', 'simulate', 'netns'] and (not isfile(self.creds)):
             print('\033[91mCredentials file "' + self.creds + '" not found.\033[0m Exiting.')
             sys.exit(1)
 
@@ -207,6 +485,263 @@ class Connect(object):
                     sys.exit(1)
 
 
+def netns_commands(commands):
+    '''
+    Run the commands that set up or remove the netns testbed (as root), until one fails.
+    Returns the error of the failed one, or None.
+    '''
+    sudo = [] if geteuid() == 0 else ['sudo', '-n']
+    for cmd in commands:
+        p = Popen(sudo + cmd, stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        if p.returncode:
+            return ' '.join(cmd) + ': ' + err.decode('ascii', errors='ignore').strip()
+
+    return None
+
+
+def setup_netns(cl1_conn, cl2_conn, cl1_test_ip, cl2_test_ip):
+    '''
+    Create the local testbed of the netns clients: a network namespace for each of them, joined by
+    netns_link (a veth pair, or two interfaces of this machine), with the test IPs on it.
+    Namespaces left by a previous (interrupted) run are replaced.
+    '''
+    conns = [(cl1_conn, cl1_test_ip), (cl2_conn, cl2_test_ip)]
+    if [c.conn_type for (c, ip) in conns] != ['netns', 'netns']:
+        print('\033[91mBoth the clients must use the netns access method.\033[0m Exiting.')
+        sys.exit(1)
+
+    remove_netns(cl1_conn, cl2_conn)
+    commands = [['ip', 'netns', 'add', c.netns] for (c, ip) in conns]
+    if netns_link == 'veth':
+        devs = ['nm_' + c.getname() for (c, ip) in conns]
+        commands.append(['ip', 'link', 'add', devs[0], 'netns', cl1_conn.netns, 'type', 'veth',
+                         'peer', 'name', devs[1], 'netns', cl2_conn.netns])
+    else:
+        devs = list(netns_link)
+        commands += [['ip', 'link', 'set', d, 'netns', c.netns] for (d, (c, ip)) in zip(devs, conns)]
+
+    for (dev, (c, ip)) in zip(devs, conns):
+        commands += [['ip', '-n', c.netns, 'link', 'set', 'lo', 'up'],
+                     ['ip', '-n', c.netns, 'addr', 'add', ip + '/24', 'dev', dev],
+                     ['ip', '-n', c.netns, 'link', 'set', dev] + netns_link_opts.split() + ['up']]
+        if netns_qdisc:
+            commands.append(['tc', '-n', c.netns, 'qdisc', 'add', 'dev', dev, 'root'] + netns_qdisc.split())
+
+    print('Setting up the network namespaces (' + ' <--> '.join(devs) + ')...')
+    err = netns_commands(commands)
+    if err:
+        print('\033[91mCould not set up the network namespaces:\033[0m ' + err)
+        remove_netns(cl1_conn, cl2_conn)
+        sys.exit(1)
+
+    for (dev, (c, ip)) in zip(devs, conns):
+        if not wait_until(lambda: c.run_command(['cat', '/sys/class/net/' + dev + '/operstate']).strip() == 'up',
+                          server_start_timeout):
+            print('\033[93mWARNING:\033[0m The link ' + dev + ' in ' + c.netns + ' is not up.')
+
+
+def remove_netns(cl1_conn, cl2_conn):
+    '''
+    Remove the namespaces of the netns testbed. A veth pair goes with them, and the interfaces
+    of this machine go back to the main namespace.
+    '''
+    for c in [cl1_conn, cl2_conn]:
+        netns_commands([['ip', 'netns', 'del', c.netns]])
+
+
+class CPUSampler(Thread):
+    '''
+    Samples the CPU usage of the local machine from /proc/stat (and /proc/softirqs, if asked to)
+    every interval seconds, count times or until stopped, in a thread, instead of running mpstat.
+    The per-core deltas of the counters go straight into buffers preallocated for count samples,
+    and are saved to outname (.npz) when the sampling is over. Has poll() and wait(), like the mpstat
+    process that it replaces.
+    '''
+    def __init__(self, interval, count, outname, softirqs = False):
+        Thread.__init__(self, daemon = True)
+        self.interval = interval
+        self.count = count
+        self.outname = outname
+        self.softirqs = softirqs
+        self.stopped = Event()
+        self.prev = self.read_counters()
+        self.num_cpu = self.prev[0].shape[0]
+        self.times = np.zeros(count)
+        self.stat = np.zeros((count, self.num_cpu, 10), dtype=np.int64)
+        if softirqs:
+            self.softirq_names = self.prev[1][1]
+            self.softirq = np.zeros((count, self.num_cpu, len(self.softirq_names)), dtype=np.int64)
+
+        self.samples = 0
+
+    def read_counters(self, prev = None):
+        '''
+        The per-core /proc/stat counters (user, nice, system, idle, iowait, irq, softirq, steal,
+        guest, guest_nice) and, optionally, the per-core /proc/softirqs counters (with their names).
+        After the first reading (prev), the CPUs are the same as in it: the CPUs that went offline
+        keep their previous counters, and the ones that came online above them are left out.
+        '''
+        with open('/proc/stat') as inputfile:
+            lines = [l.split() for l in inputfile if l[:3] == 'cpu' and l[3].isdigit()]
+
+        if prev == None:
+            stat = np.zeros((int(lines[-1][0][3:]) + 1, 10), dtype=np.int64)
+        else:
+            stat = prev[0].copy()
+
+        for l in lines:
+            cpu = int(l[0][3:])
+            if cpu < stat.shape[0]:
+                # Old kernels have fewer counters
+                stat[cpu,:len(l) - 1] = l[1:11]
+
+        if not self.softirqs:
+            return stat, None
+
+        with open('/proc/softirqs') as inputfile:
+            rows = [l.split() for l in inputfile][1:]
+
+        return stat, ([r[1:stat.shape[0] + 1] for r in rows], [r[0].rstrip(':') for r in rows])
+
+    def run(self):
+        start = time()
+        try:
+            while self.samples < self.count:
+                # Sampling at fixed times from the start, so that the intervals do not drift
+                if self.stopped.wait(max(0, start + (self.samples + 1) * self.interval - time())):
+                    break
+
+                stat, softirq = self.read_counters(self.prev)
+                i = self.samples
+                self.times[i] = time() - start
+                self.stat[i] = stat - self.prev[0]
+                if self.softirqs:
+                    self.softirq[i] = (np.array(softirq[0], dtype=np.int64) -
+                                       np.array(self.prev[1][0], dtype=np.int64)).T
+
+                self.prev = (stat, softirq)
+                self.samples += 1
+
+        except Exception as e:
+            # Keep the samples taken so far, rather than losing the whole test
+            print('\033[93mWARNING:\033[0m CPU sampling stopped after ' + str(self.samples) + ' samples: ' + str(e))
+
+        n = self.samples
+        arrays = {'times': self.times[:n], 'stat': self.stat[:n]}
+        if self.softirqs:
+            arrays.update({'softirqs': self.softirq[:n], 'softirq_names': np.array(self.softirq_names)})
+
+        np.savez_compressed(self.outname, **arrays)
+
+    def poll(self):
+        return None if self.is_alive() else 0
+
+    def wait(self):
+        self.join()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class GnuplotBatch(object):
+    '''
+    One long-lived gnuplot process, that renders script after script fed over its
+    standard input. This saves loading gnuplot, cairo and the fonts for every plot.
+    The scripts stay on disk as they are - they are only "load"ed.
+    '''
+    done_marker = 'NetMeter: plot done'
+
+    def __init__(self, gnuplot_bin):
+        self.gnuplot_bin = gnuplot_bin
+        self.proc = None
+
+    def render(self, script, cwd):
+        if not self.proc or self.proc.poll() != None:
+            try:
+                self.proc = Popen([self.gnuplot_bin], stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                                  universal_newlines=True)
+            except OSError as e:
+                return -1, str(e)
+
+        try:
+            self.proc.stdin.write("cd '" + abspath(cwd) + "'\n"
+                                  "load '" + script + "'\n"
+                                  "set output\n"
+                                  "reset\n"
+                                  "print '" + self.done_marker + "'\n")
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+        # Errors and the marker are printed to stderr (merged into stdout here).
+        # gnuplot exits on an error in a script; it is restarted for the next one.
+        messages = []
+        for line in self.proc.stdout:
+            if line.strip() == self.done_marker:
+                break
+
+            messages.append(line)
+        else:
+            return self.proc.wait() or -1, ''.join(messages).strip()
+
+        failed = any((', line ' in m and 'warning:' not in m) for m in messages)
+        return int(failed), ''.join(messages).strip()
+
+    def close(self):
+        if self.proc and self.proc.poll() == None:
+            self.proc.communicate('quit\n')
+
+        self.proc = None
+
+
+class PlotQueue(object):
+    '''
+    Renders gnuplot scripts in the background, at most "workers" at a time,
+    so that plotting does not hold the next test. In the batch mode, each worker
+    feeds its scripts to its own long-lived gnuplot process.
+    '''
+    def __init__(self, gnuplot_bin, workers, batch = False):
+        self.gnuplot_bin = gnuplot_bin
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.jobs = []
+        self.batch = batch
+        self.worker = local()
+        self.batches = []
+
+    def run_gnuplot(self, script, cwd):
+        if self.batch:
+            if not hasattr(self.worker, 'gnuplot'):
+                self.worker.gnuplot = GnuplotBatch(self.gnuplot_bin)
+                self.batches.append(self.worker.gnuplot)
+
+            return self.worker.gnuplot.render(script, cwd)
+
+        return run_gnuplot(self.gnuplot_bin, script, cwd)
+
+    def render(self, script, cwd):
+        self.jobs.append((script, self.executor.submit(self.run_gnuplot, script, cwd)))
+
+    def join(self):
+        '''
+        Wait for all the submitted plots, and report the ones that failed.
+        Returns the list of the failed scripts.
+        '''
+        failed = []
+        for script, job in self.jobs:
+            status, err = job.result()
+            if status:
+                print('\033[93mWARNING:\033[0m gnuplot exited with status ' + str(status) +
+                      ' for ' + script + ('\n' + err if err else ''))
+                failed.append(script)
+
+        self.jobs = []
+        for b in self.batches:
+            b.close()
+
+        return failed
+
+
 def time_header():
     return datetime.now().strftime('[ %H:%M:%S ] ')
 
@@ -215,8 +750,24 @@ def tprint(str):
     print(time_header() + str)
 
 
+def wait_until(condition, timeout, poll_interval = 1.0):
+    '''
+    Poll condition() until it is true or until the timeout (in seconds) expires.
+    Returns whether the condition became true before the timeout.
+    '''
+    deadline = time() + timeout
+    while not condition():
+        if time() >= deadline:
+            return False
+
+        sleep(poll_interval * time_factor)
+
+    return True
+
+
 def interrupt_exit(signal, frame):
     print('\n\033[91mInterrupted by user. Exiting.\033[0m')
+    print('To continue the campaign later, run: ' + sys.argv[0] + ' --resume ' + export_dir)
     sys.exit(1)
 
 
@@ -306,7 +857,10 @@ def place_images(direction, protocol, summary_img, image_list, print_unit,
                 '        <h2>By Time</h2>\n'
                 )
     for f in image_list:
-        if f.split('.')[-1] == 'png':
+        if isinstance(f, list):
+            # The bandwidth plot, and the per-core CPU heatmap
+            content += ''.join('        <img src="' + img + '">\n' for img in f)
+        elif f.split('.')[-1] == 'png':
             content += '        <img src="' + f + '">\n'
         else:
             content += (
@@ -321,13 +875,18 @@ def place_images(direction, protocol, summary_img, image_list, print_unit,
 
 
 def gen_html(title, one2two_summary, two2one_summary, one2two_images, two2one_images, html_outname,
-             protocol, streams, all_one2two_failed, all_two2one_failed, print_unit, localpart,
+             protocol, streams, all_one2two_failed, all_two2one_failed, print_unit, cpu_measured,
              cl1_pretty_name, cl2_pretty_name, tcpwin):
-    if localpart:
+    if cpu_measured:
         CPU_note = 'and CPU '
     else:
         CPU_note = ''
 
+    if protocol in rr_protocols:
+        report_kind = ('Request/Response ', ' Latency ')
+    else:
+        report_kind = ('Iperf ', ' Bandwidth ')
+
     tcp_win_msg = gen_tcp_win_msg(tcpwin)
     content = (
                '<!doctype html>\n'
@@ -399,8 +958,8 @@ def gen_html(title, one2two_summary, two2one_summary, one2two_images, two2one_im
                '    margin: 0px;\n'
                '}\n'
                '</style>\n'
-               '<title>Iperf ' + cl1_pretty_name + ' &#8596; ' + cl2_pretty_name
-               + ' Bandwidth ' + CPU_note + 'Performance Report</title>\n'
+               '<title>' + report_kind[0] + cl1_pretty_name + ' &#8596; ' + cl2_pretty_name
+               + report_kind[1] + CPU_note + 'Performance Report</title>\n'
                '</head>\n'
                '<body>\n'
                '<div id="header">\n'
@@ -454,48 +1013,238 @@ def get_round_size_name(i, gap = False):
         return str(int(round(float(size_name[0])))) + size_name[1]
 
 
-def get_iperf_data_single(iperf_out, protocol, streams, repetitions):
+def is_iperf_stamp(field):
     '''
-    Notice: all entries are counted from the end, as sometimes the beginning of an
-    output row can be unreadable. This is also the reason for "errors='ignore'".
+    Iperf timestamps are "YYYYmmddHHMMSS", newer versions add fractions of a second.
+    '''
+    return field.replace('.', '', 1).isdigit()
+
+
+def read_iperf_csv(iperf_out, protocol, max_time, offset = 0, complete_rows = False):
+    '''
+    Read the Iperf "-y C" output in one pass into typed columns.
+    Returns an array with the rows [time (s), connection number, rate (b/s), interval length (s)].
+    The time is the end of the interval relative to the end of the first one. It is taken from the
+    interval field, and not from the timestamp, which has a resolution of one second in most Iperf versions.
+    Only rows with the expected amount of fields and a readable timestamp are taken,
+    and of them only the per-connection (not summary) rows that end up to max_time seconds.
+    offset - where to start reading (for the output of a persistent server).
+    complete_rows - ignore the last row if it is not terminated (the output is still written).
     '''
-    iperf_data = []
     additional_fields = 0
     if protocol == 'UDP':
         additional_fields = 5
 
-    with open(iperf_out, encoding='utf-8', errors='ignore') as inputfile:
-        for line in inputfile:
-            tmp_lst = line.strip().split(',')
-            if (
-                not tmp_lst[0].isdigit()
-                or len(tmp_lst) != (9 + additional_fields)
-                or (additional_fields and float(tmp_lst[-3]) <= 0)
-                or float(tmp_lst[-3 - additional_fields].split('-')[-1]) > repetitions * 10.0
-               ):
+    num_fields = 9 + additional_fields
+    with open(iperf_out, 'rb') as inputfile:
+        inputfile.seek(offset)
+        data = inputfile.read()
+
+    if complete_rows:
+        data = data[:data.rfind(b'\n') + 1]
+
+    lines = [l.strip() for l in data.decode('utf-8', errors='ignore').splitlines()]
+
+    lines = [l for l in lines if l.count(',') == num_fields - 1 and is_iperf_stamp(l.partition(',')[0])]
+    if not lines:
+        return np.empty((0, 4))
+
+    fields = np.array(','.join(lines).split(',')).reshape((len(lines), num_fields))
+    interval = np.char.rpartition(fields[:,-3 - additional_fields], '-')
+    interval_start = interval[:,0].astype(float)
+    interval_end = interval[:,2].astype(float)
+    keep = interval_end <= max_time
+    if additional_fields:
+        total_datagrams = fields[:,-3].astype(float)
+        keep &= total_datagrams > 0
+
+    conn = fields[:,-4 - additional_fields].astype(np.int64)
+    # Summary rows have the link number -1
+    keep &= conn > 0
+    fields = fields[keep]
+    if not fields.shape[0]:
+        return np.empty((0, 4))
+
+    rate = fields[:,-1 - additional_fields].astype(float)
+    if additional_fields:
+        # For UDP: rate = rate * (total_datagrams - lost_datagrams) / total_datagrams
+        total_datagrams = total_datagrams[keep]
+        rate = rate * (total_datagrams - fields[:,-4].astype(float)) / total_datagrams
+
+    rate[(fields[:,-2 - additional_fields].astype(float) < 0) | (rate < 0.0)] = np.nan
+    interval_end = interval_end[keep]
+    return np.column_stack((interval_end - interval_end.min(), conn[keep], rate,
+                            interval_end - interval_start[keep]))
+
+
+# Where a report starts in an iperf3 JSON output: the intervals list, the totals or the error of
+# a --json document, or an interval, a totals or an error event of --json-stream
+iperf3_report_start = re.compile(r'"(intervals)"\s*:\s*\[|"(end|error)"\s*:\s*(?=[{"])|'
+                                 r'"event"\s*:\s*"(interval|end|error)"\s*,\s*"data"\s*:\s*')
+# A longer report is taken for garbage
+iperf3_max_report = 1 << 22
+
+
+def iperf3_reports(iperf_out, offset = 0, chunk_size = 1 << 20):
+    '''
+    Yield the reports of an iperf3 JSON output: ('interval', the report of an interval),
+    ('end', the totals of a test), and ('error', the message of a test that failed).
+    The output is read in chunks, and only the report that is decoded is kept in memory,
+    so a long multi-stream output is never loaded as a whole.
+    Both the --json-stream output (an event per line) and the --json one (a document per test,
+    several of them appended by a persistent server) are read. A report that can not be decoded
+    is skipped, and one that is cut short at the end (the output is still written) ends the reading.
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = getincrementaldecoder('utf-8')(errors='ignore')
+    buf = ''
+    in_list = False
+    eof = False
+    with open(iperf_out, 'rb') as inputfile:
+        inputfile.seek(offset)
+        while True:
+            kind = None
+            if in_list:
+                # Between the items of the intervals list of a --json document
+                pos = len(buf) - len(buf.lstrip(', \t\r\n'))
+                if buf[pos:pos + 1] == ']':
+                    in_list = False
+                    buf = buf[pos + 1:]
+                    continue
+
+                kind = 'interval'
+            else:
+                m = iperf3_report_start.search(buf)
+                if m and m.group(1):
+                    in_list = True
+                    buf = buf[m.end():]
+                    continue
+                elif m:
+                    kind, pos = m.group(2) or m.group(3), m.end()
+                else:
+                    # Only a tail that can be the beginning of the next report start is kept
+                    buf = buf[-64:]
+
+            if kind and pos < len(buf):
+                try:
+                    report, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof or len(buf) - pos > iperf3_max_report:
+                        in_list = False
+                        buf = buf[pos + 1:]
+                        continue
+
+                else:
+                    buf = buf[end:]
+                    if isinstance(report, dict) or kind == 'error':
+                        yield kind, report
+
+                    continue
+
+            if eof:
+                return
+
+            data = inputfile.read(chunk_size)
+            eof = not data
+            buf += utf8.decode(data, final = eof)
+
+
+def read_iperf3_json(iperf_out, max_time, offset = 0):
+    '''
+    Read the receiver (server) reports of an iperf3 JSON output into the rows of read_iperf_csv():
+    [time (s), connection number (the socket), rate (b/s), interval length (s)].
+    The intervals end a little after the round times in iperf3, so those whose middle
+    is up to max_time seconds are taken.
+    '''
+    # A flat array of the rows (a tuple per row would take several times the memory)
+    rows = array('d')
+    for (kind, report) in iperf3_reports(iperf_out, offset):
+        if kind != 'interval':
+            continue
+
+        for s in report.get('streams') or []:
+            try:
+                if s.get('sender') or s.get('omitted'):
+                    continue
+
+                start, end = float(s['start']), float(s['end'])
+                rows.extend((end, int(s['socket']), float(s['bits_per_second']), end - start))
+            except (AttributeError, KeyError, TypeError, ValueError):
                 continue
 
-            if (int(tmp_lst[-4 - additional_fields]) > 0):
-                # If the link number is positive (i.e if it is not a summary, where it's -1)...
-                date = datetime.strptime(tmp_lst[0], '%Y%m%d%H%M%S')
-                if not iperf_data:
-                    first_date = date
+    iperf_data = np.frombuffer(rows).reshape((-1, 4))
+    iperf_data = iperf_data[iperf_data[:,0] - iperf_data[:,3] / 2 <= max_time]
+    if iperf_data.shape[0]:
+        iperf_data[iperf_data[:,2] < 0, 2] = np.nan
+        iperf_data[:,0] -= iperf_data[:,0].min()
+
+    return iperf_data
+
+
+def iperf_format(iperf_out, offset = 0):
+    '''
+    'json' for the output of iperf3 (--json or --json-stream), 'csv' for the "-y C" one of Iperf 2.
+    '''
+    with open(iperf_out, 'rb') as inputfile:
+        inputfile.seek(offset)
+        return 'json' if inputfile.read(4096).lstrip().startswith(b'{') else 'csv'
+
+
+def read_iperf(iperf_out, protocol, max_time, offset = 0, complete_rows = False):
+    '''
+    Read the output of an Iperf server of either version (see read_iperf_csv() and read_iperf3_json()).
+    '''
+    if iperf_format(iperf_out, offset) == 'json':
+        return read_iperf3_json(iperf_out, max_time, offset)
+
+    return read_iperf_csv(iperf_out, protocol, max_time, offset, complete_rows)
+
+
+def read_iperf3_sender(iperf_out):
+    '''
+    The TCP details of the sender (client) reports of an iperf3 JSON output: an array with the rows
+    [time (s), retransmits, mean RTT (ms), total congestion window (KB)] of all the streams in every
+    interval, and the CPU utilisation of the test from its totals (a dict, as iperf3 reports it).
+    '''
+    rows = []
+    cpu = {}
+    for (kind, report) in iperf3_reports(iperf_out):
+        if kind == 'end':
+            cpu = report.get('cpu_utilization_percent') or cpu
+
+        if kind != 'interval':
+            continue
+
+        try:
+            # UDP senders have no retransmits
+            streams = [s for s in report.get('streams') or []
+                       if s.get('sender') and not s.get('omitted') and 'retransmits' in s]
+            if streams:
+                rows.append((float(streams[0]['end']), sum(int(s['retransmits']) for s in streams),
+                             np.mean([float(s.get('rtt', np.nan)) for s in streams]) / 1000,
+                             sum(float(s.get('snd_cwnd', 0)) for s in streams) / 1024))
+
+        except (AttributeError, KeyError, TypeError, ValueError):
+            continue
 
-                time_from_start = float((date - first_date).total_seconds())
-                rate = float(tmp_lst[-1 - additional_fields])
-                if additional_fields:
-                    # For UDP: rate = rate * (total_datagrams - lost_datagrams) / total_datagrams
-                    rate = rate * (float(tmp_lst[-3]) - float(tmp_lst[-4])) / float(tmp_lst[-3])
+    sender_data = np.array(rows).reshape((-1, 4))
+    if sender_data.shape[0]:
+        sender_data[:,0] -= sender_data[0,0]
 
-                if (int(tmp_lst[-2 - additional_fields]) < 0) or (rate < 0.0):
-                    rate = np.nan
+    return sender_data, cpu
 
-                iperf_data.append([ time_from_start, int(tmp_lst[-4 - additional_fields]), rate ])
 
-    if not iperf_data:
+def get_iperf_data_single(iperf_out, protocol, streams, repetitions, interval = report_interval):
+    '''
+    Notice: all entries are counted from the end, as sometimes the beginning of an
+    output row can be unreadable. This is also the reason for "errors='ignore'".
+    interval - the report interval of the output (s).
+    '''
+    # (Allowing for the rounding of the interval in the output)
+    iperf_data = read_iperf(iperf_out, protocol, repetitions * interval + 1e-6)
+    if not iperf_data.shape[0]:
         raise ValueError('Nothing reached the server.')
 
-    iperf_data = np.array(iperf_data)
     conns = np.unique(iperf_data[:,1])
     num_conn = conns.shape[0]
     if num_conn < streams:
@@ -552,46 +1301,476 @@ def get_iperf_data_single(iperf_out, protocol, streams, repetitions):
     return out_arr, out_arr[:,1].mean(), out_arr[:,1].std(), server_fault
 
 
-def get_mpstat_data_single(mpstat_out):
-    mpstat_data = []
-    tmp_row = []
-    time_interval = 0.0
+def rate_ci(rates):
+    '''
+    The relative half-width of the 95% confidence interval of the mean rate.
+    Infinite if there are too few measurements to tell.
+    '''
+    rates = rates[~np.isnan(rates)]
+    if rates.size < 4 or rates.mean() <= 0:
+        return np.inf
+
+    return t_quantile_975(rates.size - 1) * rates.std(ddof = 1) / np.sqrt(rates.size) / rates.mean()
+
+
+def get_interval_rates(iperf_out, protocol, streams, offset = 0):
+    '''
+    The total rates of the intervals that all the streams have reported so far,
+    from the output of a running Iperf server.
+    '''
+    iperf_data = read_iperf(iperf_out, protocol, np.inf, offset, complete_rows = True)
+    conns, conn_count = np.unique(iperf_data[:,1], return_counts = True)
+    if conns.shape[0] != streams:
+        return np.empty(0)
+
+    # Take the first (complete) intervals of each connection
+    iperf_data = iperf_data[np.lexsort((iperf_data[:,0], iperf_data[:,1]))]
+    position = np.arange(iperf_data.shape[0]) - np.repeat(np.cumsum(conn_count) - conn_count, conn_count)
+    complete = conn_count.min()
+    return iperf_data[position < complete, 2].reshape((streams, complete)).sum(axis=0)
+
+
+def wait_converged(iperf_out, protocol, streams, offset, max_repetitions, iperf_proc):
+    '''
+    Watch the output of the server while the test runs, until the confidence interval
+    of the mean rate is narrower than ci_target (but at least adaptive_min_duration),
+    until max_repetitions intervals are over, or until the client exits.
+    Returns the number of intervals measured, and whether the test converged.
+    '''
+    start = time()
+    repetitions = 0
+    # With short intervals, look at the output about once a second only
+    step = max(1, int(round(1.0 / report_interval)))
+    while repetitions < max_repetitions and iperf_proc.poll() == None:
+        next_repetitions = min(repetitions + step, max_repetitions)
+        sleep(max(0, start + report_interval * next_repetitions * time_factor - time()))
+        repetitions = next_repetitions
+        if report_interval * repetitions < adaptive_min_duration:
+            continue
+
+        # The server reports may lag behind the clock, so only the reported intervals count.
+        rates = get_interval_rates(iperf_out, protocol, streams, offset)
+        if report_interval * rates.size >= adaptive_min_duration and rate_ci(rates) <= ci_target:
+            return rates.size, True
+
+    return repetitions, False
+
+
+def read_mpstat(mpstat_out):
+    '''
+    Read the "mpstat -P ALL" output into a (measurements x CPUs x columns) array, in one pass.
+    Returns the times (s, from the first measurement), the column names ("%usr", "%sys",
+    "%soft", "%idle"...), and the array (percents). An incomplete last measurement is left out.
+    '''
     with open(mpstat_out) as inputfile:
-        for line in inputfile:
-            tmp_lst = line.split()
-            if (not any('CPU' in s for s in tmp_lst)) and tmp_lst and ('Average' not in tmp_lst[0]):
-                if any('all' in s for s in tmp_lst):
-                    if tmp_row:
-                        mpstat_data.append(tmp_row)
+        lines = inputfile.read().splitlines()
+
+    columns = next((l.split() for l in lines if '%idle' in l), ['%idle'])
+    columns = [c for c in columns if c.startswith('%')]
+    num_columns = len(columns)
+    rows = [l.split() for l in lines if l.strip() and 'CPU' not in l and not l.startswith('Average')]
+    # A row is the time (one or two fields, depending on the locale), the CPU, and the columns
+    row_length = max(set(len(r) for r in rows), key = [len(r) for r in rows].count) if rows else 0
+    rows = np.array([r for r in rows if len(r) == row_length])
+    if row_length < num_columns + 2 or not (rows[:,-num_columns - 1] == 'all').any():
+        raise ValueError('No CPU measurements in ' + basename(mpstat_out) + '.')
+
+    starts = (rows[:,-num_columns - 1] == 'all').nonzero()[0]
+
+    num_cpu = starts[1] - starts[0] - 1 if starts.size > 1 else rows.shape[0] - starts[0] - 1
+    starts = starts[starts + num_cpu < rows.shape[0]]
+    data = rows[(starts[:,None] + 1 + np.arange(num_cpu))][:,:,-num_columns:].astype(float)
+
+    def row_time(row):
+        stamp = ' '.join(rows[row,:-num_columns - 1])
+        try:
+            return datetime.strptime(stamp, '%I:%M:%S %p')
+        except ValueError:
+            return datetime.strptime(stamp, '%H:%M:%S')
 
-                    tmp_row = []
-                else:
-                    tmp_row.append(float(tmp_lst[-1]))
+    time_interval = 0.0
+    if starts.size > 1:
+        time_interval = (row_time(starts[1]) - row_time(starts[0])).total_seconds() % 86400
 
-                if not time_interval:
-                    try:
-                        time = datetime.strptime(tmp_lst[0] + tmp_lst[1], '%I:%M:%S%p')
-                    except ValueError:
-                        time = datetime.strptime(tmp_lst[0], '%H:%M:%S')
+    times = np.arange(starts.size) * (time_interval or max(1, round(report_interval)))
+    return times, columns, data
+
+
+def read_cpustat(cpustat_out):
+    '''
+    Read the /proc/stat samples of a CPUSampler into the same form as read_mpstat() returns,
+    with the mpstat columns (the guest time is counted in the user time by the kernel, and not by mpstat).
+    '''
+    with np.load(cpustat_out) as inputfile:
+        times, stat = inputfile['times'], inputfile['stat'].astype(float)
 
-                    if not mpstat_data:
-                        first_time = time
+    if not times.size:
+        raise ValueError('No CPU measurements in ' + basename(cpustat_out) + '.')
 
-                    time_interval = float((time - first_time).total_seconds())
+    user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice = np.moveaxis(stat, 2, 0)
+    columns = ['%usr', '%nice', '%sys', '%iowait', '%irq', '%soft', '%steal', '%guest', '%gnice', '%idle']
+    data = np.stack((user - guest, nice - guest_nice, system, iowait, irq, softirq, steal, guest,
+                     guest_nice, idle), axis=2)
+    total = stat[:,:,:8].sum(axis=2)
+    # A core with no ticks in an interval (an interval shorter than a tick) counts as idle
+    data[total == 0, -1] = 1
+    data = data * 100 / np.maximum(total, 1)[:,:,None]
+    return np.round(times - times[0], 3), columns, data
 
-    mpstat_data.append(tmp_row)
-    mpstat_data = np.array(mpstat_data)
-    num_measurements, num_cpu = mpstat_data.shape
-    times = np.arange(0, num_measurements * time_interval, time_interval)
-    mpstat_data = (1 - mpstat_data / 100) / num_cpu
+
+def get_mpstat_data_single(mpstat_out):
+    '''
+    The total CPU usage fraction over time, and the standard deviation between the cores.
+    mpstat_out - the mpstat output, or the samples of a CPUSampler (.npz).
+    Returns also the full per-core data (as returned by read_mpstat()).
+    '''
+    times, columns, cores = (read_cpustat if mpstat_out.endswith('.npz') else read_mpstat)(mpstat_out)
+    num_measurements, num_cpu, _ = cores.shape
+    mpstat_data = (1 - cores[:,:,columns.index('%idle')] / 100) / num_cpu
     tot_cpu_usage = mpstat_data.sum(axis=1)
     core_stdev = np.std(mpstat_data, axis=1) * np.sqrt(num_cpu)
     out_arr = np.vstack((times, tot_cpu_usage, core_stdev)).T
-    return out_arr, out_arr[:,1].mean(), out_arr[:,1].std()
+    return out_arr, out_arr[:,1].mean(), out_arr[:,1].std(), (times, columns, cores)
+
+
+def export_heatmap(times, values, data_outname):
+    '''
+    Write a (time x CPU) matrix for gnuplot ("binary matrix": float32, the first row is the
+    number of columns and the y coordinates - the CPU numbers, the others are the x coordinate -
+    the time, and the values of all the CPUs at that time).
+    '''
+    matrix = np.empty((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float32)
+    matrix[0,0] = values.shape[1]
+    matrix[0,1:] = np.arange(values.shape[1])
+    matrix[1:,0] = times
+    matrix[1:,1:] = values
+    matrix.tofile(data_outname)
+
+
+def export_mpstat_cores(cores, init_name, tag = ''):
+    '''
+    Save the per-core data of a test compactly (in hundredths of percent), and export its heatmaps:
+    the busy time, and the time in interrupts, of every core (averaged down to plot_max_points times).
+    tag - the CPU data file tag of the measured machine (see cpu_sources()).
+    '''
+    times, columns, data = cores
+    np.savez_compressed(init_name + '_mpstat' + tag + '_cores.npz', times = times, columns = np.array(columns),
+                        cores = np.round(data * 100).astype(np.uint16))
+    edges = np.linspace(0, times.size, min(times.size, plot_max_points) + 1).astype(int)
+    counts = np.diff(edges)[:,None]
+    bin_times = np.add.reduceat(times, edges[:-1]) / counts[:,0]
+    busy = np.add.reduceat(100 - data[:,:,columns.index('%idle')], edges[:-1]) / counts
+    interrupts = data[:,:,[i for (i, c) in enumerate(columns) if c in ['%irq', '%soft']]].sum(axis=2)
+    export_heatmap(bin_times, busy, init_name + '_cores' + tag + '_busy.bin')
+    export_heatmap(bin_times, np.add.reduceat(interrupts, edges[:-1]) / counts,
+                   init_name + '_cores' + tag + '_irq.bin')
+
+
+def cpu_sources(cl1_conn, cl2_conn):
+    '''
+    The clients to measure the CPU usage on, and the tags of their CPU data files: '' (no tag,
+    as always) for the local machine, and '_cl1' or '_cl2' for the ssh clients. The local one first.
+    '''
+    sources = []
+    for conn in [cl1_conn, cl2_conn]:
+        tag = '' if conn.islocal() else '_' + conn.getname()
+        if tag not in [t for (c, t) in sources] and conn.measures_cpu():
+            sources.append((conn, tag))
+
+    return sorted(sources, key = lambda s: s[1])
+
+
+def tag_host_name(tag, cl1_pretty_name, cl2_pretty_name):
+    '''
+    The machine that a data file tag ('', '_cl1' or '_cl2') stands for.
+    '''
+    return {'': 'local machine', '_cl1': cl1_pretty_name, '_cl2': cl2_pretty_name}[tag]
+
+
+def primary_cpu_tag(tags, direction):
+    '''
+    The CPU data that goes to the results store (and so to the comparisons): the local machine's,
+    or, if it was not measured, the receiver's. None if neither was measured.
+    '''
+    if '' in tags:
+        return ''
+
+    receiver = '_cl2' if direction == 'one2two' else '_cl1'
+    return receiver if receiver in tags else None
+
+
+def cpu_raw_file(init_name, tag = ''):
+    '''
+    The raw CPU data of one measured machine in a test (the CPUSampler or the mpstat output),
+    or None if it was not measured.
+    '''
+    for f in [init_name + '_cpustat' + tag + '.npz', init_name + '_mpstat' + tag + '.dat']:
+        if isfile(f):
+            return f
+
+    return None
+
+
+def process_mpstat(init_name, tag = ''):
+    '''
+    Parse the CPU data of one measured machine in a test, and export the processed data.
+    Returns the processed data, its mean and standard deviation, and the name of the file to plot.
+    '''
+    mpstat_array, tot_mpstat_mean, tot_mpstat_stdev, mpstat_cores =\
+    get_mpstat_data_single(cpu_raw_file(init_name, tag) or init_name + '_mpstat' + tag + '.dat')
+    export_single_data(mpstat_array, init_name + '_mpstat' + tag + '_processed.dat')
+    export_mpstat_cores(mpstat_cores, init_name, tag)
+    mpstat_plot_file = export_plot_data(mpstat_array, init_name + '_mpstat' + tag + '_processed.dat',
+                                        init_name + '_mpstat' + tag + '_plot.dat')
+    return mpstat_array, tot_mpstat_mean, tot_mpstat_stdev, mpstat_plot_file
+
+
+counters_header = ('TimeStamp(s) Interval(s) RxBytes TxBytes RxPackets TxPackets RxDrop TxDrop RxErrs TxErrs '
+                   'TcpRetransSegs UdpInErrors UdpRcvbufErrors UdpSndbufErrors Interrupts IrqMaxCPUShare')
+
+
+def read_counters(counters_out):
+    '''
+    Read the raw counter samples of a client (see Connect.start_counters()). Returns the times of
+    the samples, the counters in every sample: [RX bytes, TX bytes, RX packets, TX packets, RX drops,
+    TX drops, RX errors, TX errors, TCP RetransSegs, UDP InErrors, UDP RcvbufErrors, UDP SndbufErrors],
+    and the interrupts of the interface on every CPU in every sample.
+    '''
+    with open(counters_out) as inputfile:
+        content = inputfile.read()
+
+    iface = re.search(r'^#IFACE (\S+)$', content, re.M)
+    cpus = re.search(r'^#CPUS (.*)$', content, re.M)
+    if not (iface and cpus):
+        raise ValueError('No counters in ' + basename(counters_out) + '.')
+
+    iface, num_cpu = iface.group(1), len(cpus.group(1).split())
+    times, counters, irqs, irq_lines = [], [], [], []
+    for sample in content.split('\n#T ')[1:]:
+        lines = sample.splitlines()
+        dev = None
+        snmp, snmp_names = {}, {}
+        irq = np.zeros(num_cpu, dtype=np.int64)
+        num_irq_lines = 0
+        for line in lines[1:]:
+            name, sep, fields = line.partition(':')
+            name, fields = name.strip(), fields.split()
+            if not (sep and fields):
+                continue
+
+            if name == iface:
+                dev = [int(f) for f in fields[:16]]
+            elif name in ['Tcp', 'Udp'] and name not in snmp_names:
+                snmp_names[name] = fields
+            elif name in ['Tcp', 'Udp']:
+                snmp.update((name + n, int(v)) for (n, v) in zip(snmp_names[name], fields))
+            elif name.isdigit():
+                counts = [int(f) for f in fields[:num_cpu] if f.isdigit()]
+                irq[:len(counts)] += counts
+                num_irq_lines += 1
+
+        # A sample cut off by stopping the sampling is left out
+        if dev == None or len(dev) < 12 or 'TcpRetransSegs' not in snmp or 'UdpInErrors' not in snmp:
+            continue
+
+        times.append(float(lines[0]))
+        counters.append([dev[0], dev[8], dev[1], dev[9], dev[3], dev[11], dev[2], dev[10],
+                         snmp['TcpRetransSegs'], snmp['UdpInErrors'], snmp.get('UdpRcvbufErrors', 0),
+                         snmp.get('UdpSndbufErrors', 0)])
+        irqs.append(irq)
+        irq_lines.append(num_irq_lines)
+
+    if irq_lines and irq_lines[-1] != irq_lines[0]:
+        times, counters, irqs = times[:-1], counters[:-1], irqs[:-1]
+
+    return np.array(times), np.array(counters, dtype=np.int64).reshape((-1, 12)), np.array(irqs).reshape((-1, num_cpu))
+
+
+def get_counters_data_single(counters_out):
+    '''
+    The counters of a test, per interval: the deltas between consecutive samples, timed like
+    the Iperf and the CPU data (from the end of the first interval). The columns are in counters_header.
+    '''
+    times, counters, irqs = read_counters(counters_out)
+    if times.size < 2:
+        raise ValueError('Too few counter samples in ' + basename(counters_out) + '.')
+
+    irq_deltas = np.diff(irqs, axis = 0)
+    irq_total = irq_deltas.sum(axis = 1)
+    return np.column_stack((times[1:] - times[1], np.diff(times), np.diff(counters, axis = 0), irq_total,
+                            irq_deltas.max(axis = 1, initial = 0) / np.maximum(irq_total, 1)))
+
+
+def process_counters(init_name, tag):
+    '''
+    Parse the counters of one client in a test, and export them. Returns the name of the processed file.
+    '''
+    counters_array = get_counters_data_single(init_name + '_counters' + tag + '.txt')
+    np.savetxt(init_name + '_counters' + tag + '.dat', counters_array, fmt = '%.12g', header = counters_header)
+    return basename(init_name + '_counters' + tag + '.dat')
+
+
+sender_header = 'TimeStamp(s) Retransmits RTT(ms) Cwnd(KB)'
+
+
+def process_sender(init_name):
+    '''
+    Export the TCP details of the iperf3 sender reports of a test (see read_iperf3_sender()).
+    Returns the summary of the test: the retransmits, the mean RTT (ms), and the CPU utilisation (%)
+    of the sender and the receiver, as iperf3 measured them. None for Iperf 2.
+    '''
+    client_out = init_name + '_iperf_client.out'
+    if not isfile(client_out) or iperf_format(client_out) != 'json':
+        return None
+
+    sender_array, cpu = read_iperf3_sender(client_out)
+    summary = {'retransmits': None, 'rtt': None, 'cpu_sender': cpu.get('host_total'),
+               'cpu_receiver': cpu.get('remote_total')}
+    if sender_array.shape[0]:
+        np.savetxt(init_name + '_sender.dat', sender_array, fmt = '%.12g', header = sender_header)
+        summary['retransmits'] = int(sender_array[:,1].sum())
+        summary['rtt'] = float(np.nanmean(sender_array[:,2])) if (~np.isnan(sender_array[:,2])).any() else None
+
+    if summary['retransmits'] == None and None in [summary['cpu_sender'], summary['cpu_receiver']]:
+        return None
+
+    return summary
+
+
+def sender_message(sender):
+    parts = []
+    if sender['retransmits'] != None:
+        parts.append(str(sender['retransmits']) + ' retransmits' +
+                     (', mean RTT ' + format(sender['rtt'], '.3g') + ' ms' if sender['rtt'] != None else ''))
+
+    if sender['cpu_sender'] != None and sender['cpu_receiver'] != None:
+        parts.append('iperf3 CPU usage ' + format(sender['cpu_sender'], '.1f') + '% (sender), ' +
+                     format(sender['cpu_receiver'], '.1f') + '% (receiver)')
+
+    return 'Sender: ' + '; '.join(parts) + '.'
+
+
+rr_percentiles = [50, 99, 99.9]
+rr_header = 'TimeStamp(s) Trans/s Stdev P50(us) P99(us) P99.9(us)'
+
+
+def hist_percentiles(buckets, counts, qs):
+    '''
+    The percentiles qs (ns) of a histogram given as its buckets (sorted) and their counts,
+    as Histogram.percentile() finds them, at once.
+    '''
+    seen = np.cumsum(counts)
+    ranks = np.maximum(np.ceil(np.array(qs) / 100.0 * seen[-1]), 1)
+    return [Histogram.bucket_value(int(buckets[i])) for i in np.searchsorted(seen, ranks)]
+
+
+def get_rr_data_single(rr_out, streams, repetitions):
+    '''
+    The results of a request/response test, from the output of its client (see NM_rr.run_client()),
+    read a line at a time: an array with a row for every interval (the time, the transaction rate of all
+    the streams, its stdev as in get_iperf_data_single(), and the latency percentiles of rr_percentiles
+    in us), the mean and the stdev of the transaction rate, the histogram of the latencies of the whole
+    test (the intervals merged), and the number of lost requests (UDP).
+    '''
+    rows = []
+    hists = []
+    lost = 0
+    with open(rr_out, errors='ignore') as inputfile:
+        for line in inputfile:
+            try:
+                report = json.loads(line)
+                interval_hist = np.array(report['hist'], dtype=np.int64).reshape((-1, 2))
+                rates = np.array(report['transactions'], dtype=float) / float(report['interval'])
+                row = [float(report['time']), rates.sum(), rates.std() * np.sqrt(rates.size)]
+                lost += sum(report.get('lost', []))
+            except (ValueError, KeyError, TypeError):
+                # The description of the test, and broken lines
+                continue
+
+            if rates.size != streams:
+                raise ValueError(str(rates.size) + ' out of ' + str(streams) + ' streams reported.')
+
+            if interval_hist.shape[0]:
+                hists.append(interval_hist)
+                row += [p / 1000.0 for p in hist_percentiles(interval_hist[:,0], interval_hist[:,1], rr_percentiles)]
+            else:
+                row += [np.nan] * len(rr_percentiles)
+
+            rows.append(row)
+            if len(rows) == repetitions:
+                break
+
+    if not rows:
+        raise ValueError('No request/response results.')
+    elif not hists:
+        raise ValueError('No request got a response.')
+
+    # The intervals merged (bucket by bucket)
+    hists = np.concatenate(hists)
+    counts = np.bincount(hists[:,0], weights = hists[:,1])
+    hist = Histogram(dict((int(i), int(counts[i])) for i in counts.nonzero()[0]))
+    out_arr = np.array(rows)
+    return out_arr, out_arr[:,1].mean(), out_arr[:,1].std(), hist, lost
+
+
+def rr_message(hist, lost):
+    return ('Latency: ' + ', '.join('p' + format(q, 'g') + ' ' + format(hist.percentile(q) / 1000.0, '.1f') + ' us'
+                                    for q in rr_percentiles) +
+            ' (' + str(hist.total()) + ' transactions' + (', ' + str(lost) + ' lost' if lost else '') + ').')
+
+
+def export_rr_hist(hist, hist_outname):
+    '''
+    The histogram of the latencies of a test, so that tests can be merged later on
+    (see NM_rr.Histogram): the buckets that were hit, and their counts.
+    '''
+    with open(hist_outname, 'w') as outfile:
+        json.dump({'precision': rr_precision, 'unit': 'ns', 'counts': hist.to_list()}, outfile)
 
 
-def export_single_data(data_processed, data_outname):
-    np.savetxt(data_outname, data_processed, fmt='%g', header='TimeStamp(s) Sum Stdev')
+def export_single_data(data_processed, data_outname, header = 'TimeStamp(s) Sum Stdev'):
+    np.savetxt(data_outname, data_processed, fmt='%g', header=header)
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    The indices of the points that Largest-Triangle-Three-Buckets downsampling keeps:
+    the first and the last points, and from each of n_out - 2 buckets of the rest, the point
+    that forms the largest triangle with the point kept from the previous bucket and the
+    average of the next bucket.
+    '''
+    n = x.size
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    y = np.nan_to_num(y)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    counts = np.diff(edges)
+    next_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1])[1:] / counts[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[:n - 1], edges[:-1])[1:] / counts[1:], y[-1])
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        area = np.abs((x[a] - next_x[b]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[b] - y[a]))
+        a = lo + np.argmax(area)
+        keep[b + 1] = a
+
+    return keep
+
+
+def export_plot_data(data_processed, data_outname, plot_outname, header = 'TimeStamp(s) Sum Stdev'):
+    '''
+    The data file to plot: the processed data itself, or, if it has more than plot_max_points
+    rows, a downsampled copy of it (written to plot_outname).
+    '''
+    if data_processed.shape[0] <= plot_max_points:
+        return basename(data_outname)
+
+    keep = lttb_indices(data_processed[:,0], data_processed[:,1], plot_max_points)
+    export_single_data(data_processed[keep], plot_outname, header)
+    return basename(plot_outname)
 
 
 def plot_iperf_data(passed, plot_type, net_dat_file):
@@ -640,10 +1819,19 @@ def plot_iperf_data(passed, plot_type, net_dat_file):
         return for_all_areas[1] + for_all_points[3]
 
 
-def write_gp(gp_outname, net_dat_file, proc_dat_file, img_file, net_rate,
+# Sizes that are not whole KB/MB (e.g. from the adaptive sweep) get one decimal
+gp_size_format = ('printxsizes(x) = x < 1024.0 ? sprintf("%.0fB", x) '
+                  ': (x < 1048576.0 ? sprintf(x/1024.0 == int(x/1024.0) ? "%.0fKB" : "%.1fKB", x/1024.0) '
+                  ': sprintf(x/1048576.0 == int(x/1048576.0) ? "%.0fMB" : "%.1fMB", x/1048576.0))\n')
+
+
+def write_gp(gp_outname, net_dat_file, proc_dat_files, img_file, net_rate,
              protocol, streams, print_unit, cl1_pretty_name, cl2_pretty_name,
              plot_type = 'singlesize', direction = 'one2two', finished = True,
              server_fault = False, packet_size = 0.0, tcpwin = None):
+    '''
+    proc_dat_files - (file, machine name) of the CPU data of every measured machine (may be empty).
+    '''
     try:
         net_rate, rate_units, rate_factor = get_size_units_factor(net_rate, rate=True)
         rate_format = ''
@@ -677,18 +1865,20 @@ def write_gp(gp_outname, net_dat_file, proc_dat_file, img_file, net_rate,
         stats_calc = 'stats "' + net_dat_file + '" using ($1 >= 0 ? $3 : 1/0) nooutput\n'
         log2_scale = 'set logscale x 2\n'
         rotate_xtics = 'set xtics rotate by -30\n'
-        formatx = ('printxsizes(x) = x < 1024.0 ? sprintf("%.0fB", x) '
-                   ': (x < 1048576.0 ? sprintf("%.0fKB", x/1024.0) '
-                   ': sprintf("%.0fMB", x/1048576.0))\n')
+        formatx = gp_size_format
 
     if direction == 'one2two':
         plot_subtitle = cl1_pretty_name + ' to ' + cl2_pretty_name
     else:
         plot_subtitle = cl2_pretty_name + ' to ' + cl1_pretty_name
 
-    if proc_dat_file:
-        proc_plot = ('     "' + proc_dat_file + '" using 1:($2-$3):($2+$3) with filledcurves lc rgb "red" axes x1y2 notitle, \\\n'
-                     '     "" using 1:2 with points pt 1 ps 1.5 lw 3 lc rgb "red" axes x1y2 title "Mean tot. CPU"\n')
+    if proc_dat_files:
+        proc_colors = ['red', 'dark-green', 'orange']
+        proc_plot = ', \\\n'.join('     "' + f + '" using 1:($2-$3):($2+$3) with filledcurves lc rgb "' + c + '"'
+                                   ' axes x1y2 notitle, \\\n'
+                                   '     "" using 1:2 with points pt 1 ps 1.5 lw 3 lc rgb "' + c + '"'
+                                   ' axes x1y2 title "Mean tot. CPU (' + name + ')"'
+                                   for ((f, name), c) in zip(proc_dat_files, proc_colors)) + '\n'
         y2_axis = ('set y2label "CPU busy time fraction"\n'
                    'set y2tics nomirror\n'
                    'set y2range [0:1]\n')
@@ -733,6 +1923,167 @@ def write_gp(gp_outname, net_dat_file, proc_dat_file, img_file, net_rate,
         outfile.write(content)
 
 
+def write_rr_gp(gp_outname, rr_dat_file, img_file, trans_rate, protocol, streams, print_unit,
+                cl1_pretty_name, cl2_pretty_name, plot_type = 'singlesize', direction = 'one2two',
+                finished = True, passed = None, packet_size = 0.0, tcpwin = None):
+    '''
+    The plot of a request/response test (plot_type 'singlesize', from the processed data - see rr_header),
+    or of the summary of a direction ('multisize', from the summary file - see export_rr_summary()):
+    the transaction rate, and the latency percentiles (rr_percentiles) on a logarithmic scale.
+    passed - for 'multisize', the TestOK column of the summary.
+    '''
+    packet_size = get_round_size_name(packet_size, gap = True)
+    if plot_type == 'singlesize':
+        plot_title = print_unit + ' size: ' + packet_size + ', Av. rate: ' + format(trans_rate, '.0f') + ' trans/s'
+        x_title = 'Time (s)'
+        x_column = '1'
+        # The rate and its stdev, then the percentiles
+        columns = [2, 3, 4]
+        xtic = ''
+        x_scale = ''
+    else:
+        plot_title = 'Transaction rate \\\\& latency for different ' + print_unit.lower() + ' sizes'
+        x_title = print_unit + ' size'
+        x_column = '($1 >= 0 ? $2 : 1/0)'
+        columns = [3, 4, 8]
+        xtic = ':xtic(printxsizes($2))'
+        x_scale = 'set logscale x 2\nset xtics rotate by -30\n' + gp_size_format
+
+    if direction == 'one2two':
+        plot_subtitle = cl1_pretty_name + ' to ' + cl2_pretty_name
+    else:
+        plot_subtitle = cl2_pretty_name + ' to ' + cl1_pretty_name
+
+    warning_message = ''
+    if not finished:
+        warning_message = 'set label "Warning:\\nTest failed to finish!\\nResults may not be accurate!" at screen 0.01, screen 0.96 tc rgb "red"\n'
+    elif passed is not None and (passed == 0).any():
+        warning_message = 'set label "Warning:\\nSome tests failed to finish!\\nResults may not be accurate!" at screen 0.01, screen 0.96 tc rgb "red"\n'
+
+    rate, stdev, first_percentile = columns
+    percentile_colors = ['dark-green', 'orange', 'red']
+    percentile_plot = ', \\\n'.join('     "" using ' + x_column + ':' + str(first_percentile + i) + ' with linespoints'
+                                    ' pt 7 ps 1 lw 2 lc rgb "' + c + '" axes x1y2 title "p' + format(q, 'g') + '"'
+                                    for (i, (q, c)) in enumerate(zip(rr_percentiles, percentile_colors))) + '\n'
+    content = (
+               'set terminal pngcairo nocrop enhanced size 1024,768 font "Verdana,15"\n'
+               'set output "' + img_file + '"\n'
+               '\n'
+               'set title "{/=20 ' + plot_title + '}\\n\\n{/=18 (' + plot_subtitle + ', ' + protocol + ', ' + str(streams) + ' st.' + gen_tcp_win_msg(tcpwin) + ')}"\n'
+               + warning_message +
+               '\n'
+               'set xlabel "' + x_title + '"\n'
+               'set ylabel "Transactions/s"\n'
+               'set ytics nomirror\n'
+               'set yrange [0:*]\n'
+               'set y2label "Latency (us)"\n'
+               'set y2tics nomirror\n'
+               'set logscale y2\n'
+               'set key bmargin center horizontal box samplen 1 width -1\n'
+               'set bmargin 4.6\n'
+               + x_scale +
+               '\n'
+               'set style fill transparent solid 0.2 noborder\n'
+               'set autoscale xfix\n'
+               'plot "' + rr_dat_file + '" using ' + x_column + ':($' + str(rate) + '-$' + str(stdev) + '):($' + str(rate) +
+               '+$' + str(stdev) + ') with filledcurves lc rgb "blue" notitle, \\\n'
+               '     "" using ' + x_column + ':' + str(rate) + xtic + ' with points pt 2 ps 1.5 lw 3 lc rgb "blue"'
+               ' title "Transactions/s", \\\n'
+               + percentile_plot
+              )
+    with open(gp_outname, 'w') as outfile:
+        outfile.write(content)
+
+
+def write_cores_gp(gp_outname, busy_dat_file, irq_dat_file, img_file, protocol, streams, print_unit,
+                   cl1_pretty_name, cl2_pretty_name, direction, packet_size, tcpwin, host_name):
+    '''
+    The per-core heatmaps of a single size: the busy time and the time in interrupts of every core
+    of one measured machine (host_name).
+    '''
+    if direction == 'one2two':
+        plot_subtitle = cl1_pretty_name + ' to ' + cl2_pretty_name
+    else:
+        plot_subtitle = cl2_pretty_name + ' to ' + cl1_pretty_name
+
+    content = (
+               'set terminal pngcairo nocrop enhanced size 1024,768 font "Verdana,15"\n'
+               'set output "' + img_file + '"\n'
+               '\n'
+               'set multiplot layout 2,1 title "{/=20 Per-core CPU usage (' + host_name + '), ' + print_unit + ' size: '
+               + get_round_size_name(packet_size, gap = True) + '}\\n{/=18 (' + plot_subtitle + ', ' + protocol
+               + ', ' + str(streams) + ' st.' + gen_tcp_win_msg(tcpwin) + ')}"\n'
+               'set xlabel "Time (s)"\n'
+               'set ylabel "CPU"\n'
+               'set cblabel "%"\n'
+               'set cbrange [0:100]\n'
+               'set palette defined (0 "#ffffff", 25 "#ffe080", 60 "#ff8000", 100 "#900000")\n'
+               'set autoscale xfix\n'
+               'set autoscale yfix\n'
+               '\n'
+               'set title "Busy time (100 - %idle)"\n'
+               'plot "' + busy_dat_file + '" binary matrix with image notitle\n'
+               'set title "Interrupts (%irq + %soft)"\n'
+               'plot "' + irq_dat_file + '" binary matrix with image notitle\n'
+               'unset multiplot\n'
+              )
+    with open(gp_outname, 'w') as outfile:
+        outfile.write(content)
+
+
+def write_counters_gp(gp_outname, dat_files, img_file, protocol, streams, print_unit,
+                      cl1_pretty_name, cl2_pretty_name, direction, packet_size, tcpwin):
+    '''
+    The counters of a single size, of every client (dat_files - (file, client name)): the drops, the errors
+    and the retransmits in every interval, and the interrupt rate of the test interface and its imbalance.
+    '''
+    if direction == 'one2two':
+        plot_subtitle = cl1_pretty_name + ' to ' + cl2_pretty_name
+    else:
+        plot_subtitle = cl2_pretty_name + ' to ' + cl1_pretty_name
+
+    if protocol.startswith('TCP'):
+        proto_errors = ('11', 'TCP retransmits')
+    else:
+        proto_errors = ('($12+$13+$14)', 'UDP errors')
+
+    colors = ['blue', 'red']
+    errors_plot = ', \\\n'.join(
+                  '     "' + f + '" using 1:($7+$8) with linespoints pt 7 lc rgb "' + c + '" title "Drops (' + name + ')", \\\n'
+                  '     "" using 1:($9+$10) with linespoints pt 5 lc rgb "' + c + '" title "Errors (' + name + ')", \\\n'
+                  '     "" using 1:' + proto_errors[0] + ' with linespoints pt 9 lc rgb "' + c + '"'
+                  ' title "' + proto_errors[1] + ' (' + name + ')"'
+                  for ((f, name), c) in zip(dat_files, colors))
+    irq_plot = ', \\\n'.join(
+               '     "' + f + '" using 1:($15/$2) with linespoints pt 7 lc rgb "' + c + '" title "Interrupts/s (' + name + ')", \\\n'
+               '     "" using 1:16 with lines dt 2 lc rgb "' + c + '" axes x1y2 title "Busiest CPU share (' + name + ')"'
+               for ((f, name), c) in zip(dat_files, colors))
+    content = (
+               'set terminal pngcairo nocrop enhanced size 1024,768 font "Verdana,15"\n'
+               'set output "' + img_file + '"\n'
+               '\n'
+               'set multiplot layout 2,1 title "{/=20 Counters, ' + print_unit + ' size: '
+               + get_round_size_name(packet_size, gap = True) + '}\\n{/=18 (' + plot_subtitle + ', ' + protocol
+               + ', ' + str(streams) + ' st.' + gen_tcp_win_msg(tcpwin) + ')}"\n'
+               'set xlabel "Time (s)"\n'
+               'set key outside right top vertical font ",10"\n'
+               'set autoscale xfix\n'
+               'set yrange [0:*]\n'
+               '\n'
+               'set ylabel "Per interval"\n'
+               'plot ' + errors_plot.lstrip() + '\n'
+               'set ylabel "Interrupts/s"\n'
+               'set y2label "Busiest CPU share"\n'
+               'set y2range [0:1]\n'
+               'set ytics nomirror\n'
+               'set y2tics\n'
+               'plot ' + irq_plot.lstrip() + '\n'
+               'unset multiplot\n'
+              )
+    with open(gp_outname, 'w') as outfile:
+        outfile.write(content)
+
+
 def set_protocol_opts(protocol, tcpwin, client = True):
     if protocol == 'TCP' and tcpwin:
         return ['-w', str(tcpwin)]
@@ -750,78 +2101,200 @@ def set_protocol_opts(protocol, tcpwin, client = True):
 
 
 def bend_max_size(size, protocol):
-    if (protocol == 'UDP') and (size > 65507) and (size <= 65536):
+    if protocol.startswith('UDP') and (size > 65507) and (size <= 65536):
         # Allow 2**16 (64KB) UDP tests to pass (ignore up to 29 bytes)
         return 65507
-    elif (protocol == 'UDP') and (size > 65536):
+    elif protocol.startswith('UDP') and (size > 65536):
         raise ValueError('Datagram size too big for UDP.')
     else:
         return size
 
 
-def run_server(protocol, init_name, dir_time, conn, tcpwin):
-    iperf_args = ['-s', '-i', '10', '-y', 'C']
-    protocol_opts = set_protocol_opts(protocol, tcpwin, client = False)
-    iperf_args += protocol_opts
+class Iperf2Backend(object):
+    '''
+    The commands of Iperf 2, which reports in CSV ("-y C").
+    '''
+    port = 5001
+    json = False
+    rr = False
+    label = 'Iperf'
+    server_name = '_iperf'
+    client_name = '_iperf_client'
+
+    def server_args(self, protocol, tcpwin, streams):
+        return (['-s', '-i', format(report_interval, 'g'), '-y', 'C'] +
+                set_protocol_opts(protocol, tcpwin, client = False))
+
+    def client_args(self, server_addr, runtime, p_size, streams, protocol, tcpwin):
+        repetitions = int(runtime / report_interval + 1e-6)
+        if repetitions * report_interval > runtime - 1e-6:
+            # So that the total (of the whole run) ends after the last interval, and is not taken for it
+            runtime += 1
+
+        return (['-c', server_addr, '-t', str(runtime), '-l', str(p_size), '-P', str(streams)] +
+                set_protocol_opts(protocol, tcpwin))
+
+    def listen_protocol(self, protocol):
+        return protocol
+
+
+class Iperf3Backend(object):
+    '''
+    The commands of iperf3, which reports in JSON (see iperf3_reports()). The server takes the
+    protocol and the window from the client, and listens on TCP (for the control connection) for both.
+    There is no total row to keep apart from the intervals, so the client runs for the run time only.
+    '''
+    port = 5201
+    json = True
+    rr = False
+    label = 'Iperf'
+    server_name = '_iperf'
+    client_name = '_iperf_client'
+
+    def json_args(self):
+        # Flushed at every report, so that adaptive_duration can watch the rate
+        return ['--json-stream', '--forceflush'] if iperf3_json_stream else ['--json']
+
+    def server_args(self, protocol, tcpwin, streams):
+        return ['-s', '-i', format(report_interval, 'g')] + self.json_args()
+
+    def client_args(self, server_addr, runtime, p_size, streams, protocol, tcpwin):
+        # "-b 0" is the unlimited rate of iperf3
+        protocol_opts = ['-u', '-b', '0'] if protocol == 'UDP' else set_protocol_opts(protocol, tcpwin)
+        return (['-c', server_addr, '-t', str(runtime), '-i', format(report_interval, 'g'), '-l', str(p_size),
+                 '-P', str(streams)] + protocol_opts + self.json_args())
+
+    def listen_protocol(self, protocol):
+        return 'TCP'
+
+
+class RRTool(object):
+    '''
+    The commands of NM_rr.py, the request/response tool of the latency tests (TCP_RR and UDP_RR).
+    The server answers every request with a response of the same size; the results are in the
+    output of the client (see get_rr_data_single()).
+    '''
+    port = rr_port
+    json = False
+    rr = True
+    label = 'NM_rr'
+    server_name = '_rr_server'
+    client_name = '_rr'
+
+    def server_args(self, protocol, tcpwin, streams):
+        # A UDP server listens on a port of its own for every stream
+        return ['server', protocol[:3], str(self.port), str(streams)]
+
+    def client_args(self, server_addr, runtime, p_size, streams, protocol, tcpwin):
+        return ['client', protocol[:3], server_addr, str(self.port), str(p_size), str(streams), str(runtime),
+                format(report_interval, 'g')]
+
+    def listen_protocol(self, protocol):
+        return protocol[:3]
+
+
+iperf_backends = {'iperf2': Iperf2Backend(), 'iperf3': Iperf3Backend()}
+iperf = iperf_backends.get(iperf_backend)
+rr_tool = RRTool()
+rr_protocols = ['TCP_RR', 'UDP_RR']
+
+
+def test_tool(protocol):
+    return rr_tool if protocol in rr_protocols else iperf
+
+
+def run_server(protocol, init_name, dir_time, conn, tcpwin, streams, append = False):
+    iperf_args = conn.tool.server_args(protocol, tcpwin, streams)
     conn_name = conn.getname()
-    iperf_command, output = conn.get_command(iperf_args, init_name + '_iperf.dat', init_name + '_iperf.err')
+    iperf_command, output = conn.get_command(iperf_args, init_name + conn.tool.server_name + '.dat',
+                                             init_name + conn.tool.server_name + '.err', append)
     print('Starting server on ' + conn_name + '...')
     cmd_print(iperf_command, conn_name, dir_time)
     p = Popen(iperf_command + output, shell=True)
-    sleep(10)
+    if not wait_until(lambda: conn.iperf_listening(protocol), server_start_timeout):
+        stop_server(conn, dir_time)
+        raise ValueError('The server on ' + conn_name + ' did not start listening within '
+                         + str(server_start_timeout) + ' seconds.')
 
 
 def run_client(server_addr, runtime, p_size, streams, init_name, dir_time,
-               protocol, conn, localpart, tcpwin):
+               protocol, conn, cpu_conns, tcpwin, server_out = None, server_offset = 0,
+               counter_conns = ()):
+    '''
+    cpu_conns - (client, file tag) of the clients to measure the CPU usage on (see cpu_sources()).
+    counter_conns - (client, test interface, file tag) of the clients to sample the counters on.
+    server_out, server_offset - the server output (and where this test starts in it),
+    watched for the convergence of the rate when adaptive_duration is on (not for the
+    request/response tests, whose results are in the client output).
+    '''
     p_size = bend_max_size(p_size, protocol)
-    repetitions, mod = divmod(runtime, 10)
-    if not mod:
-        runtime += 1
-
-    iperf_args =  ['-c', server_addr, '-t', str(runtime), '-l', str(p_size),
-                   '-P', str(streams)]
-    protocol_opts = set_protocol_opts(protocol, tcpwin)
-    iperf_args += protocol_opts
-    iperf_command, output = conn.get_command(iperf_args, init_name + '_iperf_client.out', init_name + '_iperf_client.err')
+    repetitions = int(runtime / report_interval + 1e-6)
+    adaptive = adaptive_duration and not conn.tool.rr
+    iperf_args = conn.tool.client_args(server_addr, runtime, p_size, streams, protocol, tcpwin)
+    iperf_command, output = conn.get_command(iperf_args, init_name + conn.tool.client_name + '.out',
+                                             init_name + conn.tool.client_name + '.err')
     source_name = conn.getname()
     size_name = get_round_size_name(p_size)
     tprint('Running ' + size_name + ' test from ' + source_name + '. (Duration: '
-          + str(timedelta(seconds = repetitions * 10 + mod)) + ')')
+          + ('up to ' if adaptive else '')
+          + str(timedelta(seconds = runtime)) + ')')
     conn_name = conn.getname()
     cmd_print(iperf_command, conn_name, dir_time)
+    # The first counters sample is the baseline, so it is taken before the traffic starts.
+    samplers = [(c, c.start_counters(iface, report_interval, repetitions, init_name + '_counters' + tag + '.txt'),
+                 True) for (c, iface, tag) in counter_conns]
     iperf_proc = Popen(iperf_command + output, shell=True)
-    if localpart:
-        mpstat_proc = Popen('mpstat -P ALL 10 ' + str(repetitions) + ' > ' + init_name + '_mpstat.dat', shell=True)
-        mpstat_proc.wait()
-    else:
-        sleep(10 * repetitions)
-
-    sleep(2)
-    waitcount = 1  # Positive integer. Number of 10 sec intervals to wait for the client to finish.
-    while iperf_proc.poll() == None:
-        # iperf_proc.poll() may be "False" or "None". Here we want "None" specifically, thus "not iperf_proc.poll()" won't work.
-        if waitcount:
-            tprint('\033[93mThe Iperf test is not over yet.\033[0m Waiting for 10 more seconds...')
-            sleep(10)
-            waitcount -= 1
-        else:
-            iperf_proc.kill()
-            sleep(2)
-
+    samplers += [(c, c.start_cpu_sampling(init_name, tag, repetitions * report_interval), False)
+                 for (c, tag) in cpu_conns]
+
+    if adaptive:
+        repetitions, converged = wait_converged(server_out, protocol, streams, server_offset,
+                                                repetitions, iperf_proc)
+        phase_timer.lap('client_run')
+        if converged:
+            tprint('The rate converged after ' + str(timedelta(seconds = repetitions * report_interval)) +
+                   '. Stopping the client...')
+            conn.run_command(conn.stop_iperf)
+            wait_until(lambda: iperf_proc.poll() != None, client_finish_timeout, 0.2)
+            for (c, sampler, counters) in samplers:
+                c.stop_sampling(sampler, counters)
+
+            phase_timer.lap('client_wait')
+            return True, repetitions
+
+    if samplers:
+        # The samplings run for the whole test. A remote one may be late, but not by much.
+        wait_until(lambda: all(m.poll() != None for (c, m, counters) in samplers),
+                   repetitions * report_interval * time_factor + client_finish_timeout, 0.2)
+        for (c, sampler, counters) in samplers:
+            if sampler.poll() == None:
+                c.stop_sampling(sampler, counters)
+
+    elif not adaptive:
+        sleep(report_interval * repetitions * time_factor)
+
+    if not adaptive:
+        phase_timer.lap('client_run')
+
+    if not wait_until(lambda: iperf_proc.poll() != None, client_finish_timeout, 0.2):
+        tprint('\033[93mThe ' + conn.tool.label + ' test is not over after ' + str(client_finish_timeout) +
+               ' more seconds.\033[0m Killing it.')
+        iperf_proc.kill()
+        iperf_proc.wait()
+
+    phase_timer.lap('client_wait')
     if not iperf_proc.poll():
-        tprint('\033[92mThe ' + size_name + ' test finished.\033[0m Waiting for 10 seconds.')
-        sleep(10)
+        tprint('\033[92mThe ' + size_name + ' test finished.\033[0m')
         return True, repetitions
     else:
-        tprint('\033[91mThe Iperf test failed to finish.\033[0m Skipping in 10 seconds.')
-        sleep(10)
+        tprint('\033[91mThe ' + conn.tool.label + ' test failed to finish.\033[0m Skipping.')
         return False, repetitions
 
 
 def stop_server(conn, dir_time):
     conn_name = conn.getname()
     iperf_stop_command = conn.get_command('stop_iperf')
-    print('Stopping previous Iperf instances on ' + conn_name + '...')
+    print('Stopping previous ' + conn.tool.label + ' instances on ' + conn_name + '...')
     cmd_print(iperf_stop_command, conn_name, dir_time)
     p = Popen(iperf_stop_command, stdout=PIPE, stderr=PIPE)
     p.wait()
@@ -832,142 +2305,982 @@ def stop_server(conn, dir_time):
     elif (out or err):
         print(((out + err).strip()).decode('ascii', errors='ignore'))
 
-    sleep(10)
+    if not wait_until(lambda: not conn.iperf_running(), server_stop_timeout):
+        print('\033[93mWARNING:\033[0m ' + conn.tool.label + ' is still running on ' + conn_name + '.')
+
+
+def wait_output_settled(filename, timeout):
+    '''
+    Wait until a file stops growing (its size is the same in two consecutive checks).
+    '''
+    sizes = [-1]
+    def settled():
+        sizes.append(getsize(filename) if isfile(filename) else 0)
+        return sizes[-1] == sizes[-2]
+
+    wait_until(settled, timeout)
+
+
+def split_server_output(server_out, segment_out, segment_state):
+    '''
+    Copy the output that a persistent Iperf server wrote since the previous size to
+    the per-size file. Rows of the previous size's connections that are not newer
+    than its last row (reports that arrived late) are left out.
+    segment_state - (file offset, connection numbers, last timestamp) of the previous size.
+    Returns the state for the next size.
+    '''
+    offset, prev_conns, prev_last = segment_state
+    if iperf.json:
+        # iperf3 serves one test at a time, and ends its output with the totals (or the error) of the test
+        wait_until(lambda: isfile(server_out) and any(kind in ['end', 'error'] for (kind, report)
+                                                      in iperf3_reports(server_out, offset)),
+                   client_finish_timeout)
+
+    wait_output_settled(server_out, client_finish_timeout)
+    with open(server_out, 'rb') as inputfile:
+        inputfile.seek(offset)
+        data = inputfile.read()
+
+    # Take only complete rows. The rest will go to the next size.
+    data = data[:data.rfind(b'\n') + 1]
+    conns = set()
+    last = prev_last
+    segment = []
+    for line in data.decode('utf-8', errors='ignore').splitlines(True):
+        fields = line.strip().split(',')
+        if len(fields) in [9, 14] and is_iperf_stamp(fields[0]):
+            # Counted from the end, as in get_iperf_data_single (5 more fields for UDP)
+            conn = fields[-4 - (len(fields) - 9)]
+            stamp = float(fields[0])
+            if conn in prev_conns and stamp <= prev_last:
+                continue
+
+            conns.add(conn)
+            last = max(last, stamp)
+
+        segment.append(line)
+
+    with open(segment_out, 'w') as outfile:
+        outfile.write(''.join(segment))
+
+    return offset + len(data), conns, last
+
+
+def wait_nic_quiet(conn, test_ip):
+    '''
+    Wait until the traffic on the test interface of the client (found by its
+    test IP) falls below nic_quiet_rate, so that the next test starts on a quiet link.
+    '''
+    iface = conn.get_test_iface(test_ip)
+    if not iface:
+        return
+
+    def nic_quiet():
+        start_bytes, start_time = conn.nic_bytes(iface), time()
+        sleep(1)
+        end_bytes, end_time = conn.nic_bytes(iface), time()
+        if start_bytes == None or end_bytes == None:
+            return True
+
+        return (end_bytes - start_bytes) * 8 / (end_time - start_time) < nic_quiet_rate
+
+    if not wait_until(nic_quiet, nic_quiet_timeout, 0):
+        print('\033[93mWARNING:\033[0m The test interface ' + iface + ' on ' + conn.getname() +
+              ' did not quiet down within ' + str(nic_quiet_timeout) + ' seconds.')
+
+
+def export_mpstat_summaries(dir_time, direction, mpstat_tot, print_unit, cl1_pretty_name, cl2_pretty_name):
+    '''
+    Write the CPU usage summary files of a direction. Returns (file, machine name) of each of them.
+    '''
+    mpstat_ser_files = []
+    for tag in sorted(mpstat_tot or {}):
+        mpstat_sumname = dir_time + '_' + direction + '_mpstat' + tag + '_summary'
+        np.savetxt(mpstat_sumname + '.dat', mpstat_tot[tag], fmt = '%g',
+                   header = print_unit + 'Size(B) Frac Stdev')
+        mpstat_ser_files.append((basename(mpstat_sumname + '.dat'),
+                                 tag_host_name(tag, cl1_pretty_name, cl2_pretty_name)))
+
+    return mpstat_ser_files
+
+
+def export_summary(dir_time, direction, iperf_tot, mpstat_tot, protocol, streams, print_unit,
+                   rate_units, cl1_pretty_name, cl2_pretty_name, tcpwin, plotter):
+    '''
+    Write the summary data files of a direction, and plot them.
+    mpstat_tot - the CPU usage summaries by CPU data file tag, or None if the CPU usage was not measured.
+    '''
+    iperf_sumname = dir_time + '_' + direction + '_iperf_summary'
+    combined_sumname = dir_time + '_' + direction + '_summary'
+    np.savetxt(iperf_sumname + '.dat', iperf_tot, fmt='%g',
+               header= ('TestOK ' + print_unit +
+                        'Size(B) BW(b/s) Stdev(b/s) BW(' +
+                        rate_units + ') Duration(s) CI95(rel)'))
+
+    mpstat_ser_files = export_mpstat_summaries(dir_time, direction, mpstat_tot, print_unit,
+                                               cl1_pretty_name, cl2_pretty_name)
+    non_failed_BW = [l[2] for l in iperf_tot if l[2]]
+    tot_iperf_mean = sum(non_failed_BW)/len(non_failed_BW)
+    write_gp(combined_sumname + '.plt', basename(iperf_sumname + '.dat'),
+             mpstat_ser_files, basename(combined_sumname + '.png'),
+             tot_iperf_mean, protocol, streams, print_unit, cl1_pretty_name,
+             cl2_pretty_name, plot_type = 'multisize', direction = direction,
+             server_fault = np.array(iperf_tot)[:,0],
+             packet_size = np.mean([l[1] for l in iperf_tot]), tcpwin = tcpwin)
+    plotter.render(basename(combined_sumname + '.plt'), dirname(dir_time))
+
+
+def export_rr_summary(dir_time, direction, rr_tot, mpstat_tot, protocol, streams, print_unit,
+                      cl1_pretty_name, cl2_pretty_name, tcpwin, plotter):
+    '''
+    Write the summary data files of a direction of request/response tests, and plot them.
+    rr_tot - the rows of the summary: as for Iperf (with the transaction rate for the bandwidth),
+    and the latency percentiles (rr_percentiles) of the whole test.
+    '''
+    rr_sumname = dir_time + '_' + direction + '_rr_summary'
+    combined_sumname = dir_time + '_' + direction + '_summary'
+    np.savetxt(rr_sumname + '.dat', rr_tot, fmt='%g',
+               header= ('TestOK ' + print_unit + 'Size(B) Rate(trans/s) Stdev(trans/s) Rate(trans/s) Duration(s) CI95(rel) ' +
+                        ' '.join('P' + format(q, 'g') + '(us)' for q in rr_percentiles)))
+
+    # The CPU usage is not plotted with the latencies, but it is summarised as for Iperf
+    export_mpstat_summaries(dir_time, direction, mpstat_tot, print_unit, cl1_pretty_name, cl2_pretty_name)
+    non_failed_rates = [l[2] for l in rr_tot if l[2]]
+    write_rr_gp(combined_sumname + '.plt', basename(rr_sumname + '.dat'), basename(combined_sumname + '.png'),
+                sum(non_failed_rates)/len(non_failed_rates), protocol, streams, print_unit, cl1_pretty_name,
+                cl2_pretty_name, plot_type = 'multisize', direction = direction,
+                passed = np.array(rr_tot)[:,0], packet_size = np.mean([l[1] for l in rr_tot]), tcpwin = tcpwin)
+    plotter.render(basename(combined_sumname + '.plt'), dirname(dir_time))
+
+
+def refine_sizes(iperf_tot, threshold):
+    '''
+    Sizes to add to an adaptive sweep: the (geometric) middles between neighbouring
+    measured sizes whose bandwidths differ by more than threshold (relatively),
+    the biggest differences first. Sizes that were already tried are not repeated.
+    '''
+    tried = set(l[1] for l in iperf_tot)
+    passed = np.array(sorted(l[1:3] for l in iperf_tot if l[0] >= 0)).reshape((-1, 2))
+    sizes, rates = passed[:,0], passed[:,1]
+    rate_diff = np.abs(np.diff(rates)) / np.maximum(rates[1:], rates[:-1])
+    middles = np.round(np.sqrt(sizes[1:] * sizes[:-1])).astype(int)
+    candidates = [(d, m) for (d, m, a, b) in zip(rate_diff, middles, sizes[:-1], sizes[1:])
+                  if d > threshold and a < m < b and m not in tried]
+    return [int(m) for (d, m) in sorted(candidates, reverse = True)]
+
+
+class Campaign(object):
+    '''
+    The manifest of a campaign (all the tests of one NetMeter run), with the status,
+    the files and the summary numbers of each finished test ("cell"). It is written
+    after every cell, so that an interrupted campaign can be resumed.
+    '''
+    def __init__(self, export_dir, timestamp):
+        self.filename = join(export_dir, timestamp + '_campaign.json')
+        if isfile(self.filename):
+            with open(self.filename) as inputfile:
+                self.manifest = json.load(inputfile)
+        else:
+            self.manifest = {'timestamp': timestamp, 'cells': []}
+
+        self.cells = dict((self.key(c['streams'], c['protocol'], c['direction'], c['size']), c)
+                          for c in self.manifest['cells'])
+
+    @staticmethod
+    def key(streams, protocol, direction, size):
+        return (str(streams), protocol, direction, int(size))
+
+    def get_cells(self, streams, protocol, direction):
+        '''
+        The cells of one direction that finished (also with problems), by size.
+        Failed cells are not returned, so that they will run again.
+        '''
+        cells = [c for (k, c) in self.cells.items()
+                 if k[:3] == (str(streams), protocol, direction) and c['status'] != 'failed']
+        return sorted(cells, key = lambda c: c['size'])
+
+    def record(self, streams, protocol, direction, size, cell):
+        cell.update({'streams': streams, 'protocol': protocol, 'direction': direction, 'size': size})
+        self.cells[self.key(streams, protocol, direction, size)] = cell
+        self.manifest['cells'] = sorted(self.cells.values(), key = lambda c: (
+                                        str(c['streams']), c['protocol'], c['direction'], c['size']))
+        # Write to a temporary file first, so that an interruption will not break the manifest
+        with open(self.filename + '.tmp', 'w') as outfile:
+            json.dump(self.manifest, outfile, indent = 1)
+
+        replace(self.filename + '.tmp', self.filename)
+
+
+def find_campaign(export_dir):
+    '''
+    The timestamp of the latest campaign manifest in an export directory.
+    '''
+    manifests = sorted(glob(join(export_dir, '*_campaign.json')))
+    if not manifests:
+        print('\033[91mNo campaign manifest found in ' + export_dir + '.\033[0m Exiting.')
+        sys.exit(1)
+
+    with open(manifests[-1]) as inputfile:
+        return json.load(inputfile)['timestamp']
+
+
+class PhaseTimer(object):
+    '''
+    Times the phases of every test ("cell") and of every report of a campaign, into the
+    campaign timing log (one JSON entry per line), and learns from them how long a test
+    takes, for the expected run times. The phases are timed as laps: lap(name) ends the
+    phase that is running, and starts the next one.
+    '''
+    # The order of the phases in the summary
+    phases = ['readiness', 'server_start', 'client_run', 'client_wait', 'server_stop',
+              'parse', 'export', 'summary', 'gnuplot', 'html']
+
+    def __init__(self):
+        self.logname = None
+        self.entry = None
+        self.cells = 0
+        self.measurement = 0.0
+        self.overhead = 0.0
+
+    def open(self, export_dir, timestamp):
+        '''
+        Start logging into the campaign timing log. The previous campaigns in the
+        export directory (and this one, if it is resumed) are learned from first.
+        '''
+        self.logname = join(export_dir, timestamp + '_timing.log')
+        for logname in sorted(glob(join(export_dir, '*_timing.log'))):
+            for entry in read_timing_log(logname):
+                self.learn(entry)
+
+    def learn(self, entry):
+        if entry['kind'] == 'cell' and entry['status'] == 'failed':
+            return
+
+        measurement = entry['phases'].get('client_run', 0.0)
+        self.cells += entry['kind'] == 'cell'
+        self.measurement += measurement
+        self.overhead += entry['total'] - measurement
+
+    def start(self, kind, **info):
+        '''
+        kind - 'cell' for a test, 'report' for the summaries, the plots and the html.
+        '''
+        self.entry = dict(info, kind = kind, phases = {})
+        self.start_time = self.last = time()
+
+    def lap(self, name):
+        if self.entry == None:
+            return
+
+        now = time()
+        self.entry['phases'][name] = self.entry['phases'].get(name, 0.0) + now - self.last
+        self.last = now
+
+    def end(self, status = 'ok'):
+        if self.entry == None:
+            return
+
+        self.entry.update(status = status, total = time() - self.start_time)
+        if self.logname:
+            with open(self.logname, 'a') as outfile:
+                outfile.write(json.dumps(self.entry) + '\n')
+
+        self.learn(self.entry)
+        self.entry = None
+
+    def cell_time(self, runtime):
+        '''
+        The expected time of a test: its run time, and the overhead (the time beyond the
+        measurement, with the reports) of the tests so far. 30 seconds before any test.
+        '''
+        runtime = runtime * time_factor
+        if not self.cells:
+            return runtime + 30 * time_factor
+
+        if adaptive_duration:
+            # The tests may converge before the run time is over
+            runtime = min(runtime, self.measurement / self.cells)
+
+        return runtime + self.overhead / self.cells
+
+    def eta(self, runtime, cells):
+        return str(timedelta(seconds = int(cells * self.cell_time(runtime))))
+
+
+def read_timing_log(logname):
+    entries = []
+    if not isfile(logname):
+        return entries
+
+    with open(logname) as inputfile:
+        for line in inputfile:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # An interrupted write
+                continue
+
+    return entries
+
+
+def timing_summary(logname):
+    '''
+    A table of the time that the phases of a campaign took: in total, per test, and as a
+    share of the wall-clock time. The measurement is the client run; the rest is overhead.
+    '''
+    entries = read_timing_log(logname)
+    cells = len([e for e in entries if e['kind'] == 'cell'])
+    total = sum(e['total'] for e in entries)
+    if not cells or not total:
+        return 'No tests were timed.'
+
+    times = {}
+    for e in entries:
+        for (name, t) in e['phases'].items():
+            times[name] = times.get(name, 0.0) + t
+
+    # The time that is not in any phase (between the laps of a failed test, for example)
+    times['other'] = max(total - sum(times.values()), 0.0)
+    names = ([n for n in PhaseTimer.phases if n in times] +
+             sorted(n for n in times if n not in PhaseTimer.phases + ['other']) + ['other'])
+    lines = [format('Phase', '<14') + format('Total', '>12') + format('Per test', '>12') + format('Share', '>9')]
+    for name in names:
+        lines.append(format(name, '<14') + format(str(timedelta(seconds = int(times[name]))), '>12') +
+                     format(format(times[name] / cells, '.1f') + ' s', '>12') +
+                     format(format(100 * times[name] / total, '.1f') + '%', '>9'))
+
+    measurement = times.get('client_run', 0.0)
+    lines.append(str(cells) + ' test(s) in ' + str(timedelta(seconds = int(total))) + '. Measurement: ' +
+                 format(100 * measurement / total, '.1f') + '%, overhead: ' +
+                 str(timedelta(seconds = int(total - measurement))) + ' (' +
+                 format(100 * (total - measurement) / total, '.1f') + '%).')
+    return '\n'.join(lines)
+
+
+phase_timer = PhaseTimer()
 
 
 def run_tests(cl1_conn, cl2_conn, cl1_test_ip, cl2_test_ip, runtime, p_sizes,
-              streams, timestamp, test_title, protocol, tcpwin, export_dir):
-    series_time = str(timedelta(seconds = 2 * len(p_sizes) * (runtime + 30) + 20))
-    tprint('\033[92mStarting ' + protocol + ' tests.\033[0m Expected run time: ' + series_time)
+              streams, timestamp, test_title, protocol, tcpwin, export_dir, campaign):
+    tests_done = len(campaign.get_cells(streams, protocol, 'one2two') + campaign.get_cells(streams, protocol, 'two2one'))
+    tprint('\033[92mStarting ' + protocol + ' tests.\033[0m Expected run time: ' +
+           phase_timer.eta(runtime, 2 * len(p_sizes) - tests_done))
     top_dir_name = timestamp + '_' + protocol + '_' + str(streams) + '_st'
     common_filename = protocol + '_' + str(streams) + '_st_' + timestamp
-    print_unit = 'Buffer' if protocol == 'TCP' else 'Datagram'
+    print_unit = {'TCP': 'Buffer', 'UDP': 'Datagram'}.get(protocol, 'Request')
+    # The request/response tests run NM_rr.py instead of Iperf
+    tool = test_tool(protocol)
+    cl1_conn.set_tool(tool)
+    cl2_conn.set_tool(tool)
     raw_data_subdir="raw-data"
     dir_prep(join(export_dir, top_dir_name), raw_data_subdir)
     dir_time = join(export_dir, top_dir_name, raw_data_subdir, common_filename)
     html_name = join(export_dir, top_dir_name, common_filename + ".html")
     one2two_images = []
     two2one_images = []
+    plotter = PlotQueue(gnuplot_bin, gnuplot_workers, gnuplot_batch)
+    store = ResultStore(join(export_dir, store_name))
     all_one2two_failed = False
     all_two2one_failed = False
     stop_server(cl1_conn, dir_time)
     stop_server(cl2_conn, dir_time)
-    if cl1_conn.islocal() or cl2_conn.islocal():
-        localpart = True
-    else:
-        localpart = False
-
+    cpu_conns = cpu_sources(cl1_conn, cl2_conn)
     connlist = [
-                [cl1_conn, cl2_conn, 'one2two', cl2_test_ip, one2two_images, 'Plotting cl1 --> cl2 summary...'],
-                [cl2_conn, cl1_conn, 'two2one', cl1_test_ip, two2one_images, 'Plotting cl2 --> cl1 summary...']
+                [cl1_conn, cl2_conn, 'one2two', cl1_test_ip, cl2_test_ip, one2two_images, 'Plotting cl1 --> cl2 summary...'],
+                [cl2_conn, cl1_conn, 'two2one', cl2_test_ip, cl1_test_ip, two2one_images, 'Plotting cl2 --> cl1 summary...']
                ]
     for c in connlist:
-        [client_conn, server_conn, direction, server_addr, image_list, plot_message] = c
+        [client_conn, server_conn, direction, client_addr, server_addr, image_list, plot_message] = c
+        counter_conns = []
+        if collect_counters:
+            for (conn, addr) in [(client_conn, client_addr), (server_conn, server_addr)]:
+                iface = conn.get_test_iface(addr)
+                if iface:
+                    counter_conns.append((conn, iface, '_' + conn.getname()))
+
+        counter_conns.sort(key = lambda c: c[2])
         tot_iperf_mean = -1.0
         iperf_tot = []
-        mpstat_tot = []
-        for p in p_sizes:
+        mpstat_tot = dict((tag, []) for (conn, tag) in cpu_conns)
+        size_images = []
+        # Take the cells that a previous (interrupted) run of this campaign finished
+        for cell in campaign.get_cells(streams, protocol, direction):
+            iperf_tot.append(cell['iperf_summary'])
+            if cell['mpstat_summary']:
+                mpstat_tot.setdefault('', []).append(cell['mpstat_summary'])
+
+            for (tag, summary) in cell.get('remote_mpstat_summaries', {}).items():
+                mpstat_tot.setdefault(tag, []).append(summary)
+
+            size_images.append((cell['size'], cell['image']))
+            tot_iperf_mean = cell['iperf_summary'][2]
+            rate_units, rate_factor = cell['rate_units'], cell['rate_factor']
+            images = cell['image'] if isinstance(cell['image'], list) else [cell['image']]
+            plots = [cell['files']['plot']] + (cell['files'].get('cores_plots') or [cell['files'].get('cores_plot')])
+            plots = [f for f in plots + [cell['files'].get('counters_plot')] if f]
+            for (image, plot) in zip(images, plots):
+                if not isfile(join(export_dir, top_dir_name, image)):
+                    # The run was interrupted before the plot was rendered
+                    plotter.render(basename(plot), dirname(dir_time))
+
+        if iperf_tot:
+            tprint('Resuming: ' + str(len(iperf_tot)) + ' ' + direction + ' test(s) already done.')
+
+        sizes_to_run = [p for p in p_sizes if p not in [l[1] for l in iperf_tot]]
+        if persistent_server:
+            # One server for all the sizes. Its output is split into the per-size files.
+            server_name = dir_time + '_' + direction
+            server_out = server_name + tool.server_name + '.dat'
+            server_segment = (getsize(server_out) if isfile(server_out) else 0, set(), 0)
+            if sizes_to_run:
+                try:
+                    run_server(protocol, server_name, dir_time, server_conn, tcpwin, streams, append = True)
+                except ValueError as err:
+                    tprint('\033[91mERROR:\033[0m ' + err.args[0])
+
+        sweep_start = time()
+        while True:
+            if adaptive_sweep and not sizes_to_run:
+                # The grid is done: refine it where the bandwidth changes, while the time allows.
+                sizes_to_run = refine_sizes(iperf_tot, sweep_threshold)[:1]
+                size_time = (time() - sweep_start) / max(len(iperf_tot), 1)
+                # With simulated clients the sweep runs in compressed time, and so does its budget
+                if sizes_to_run and time() - sweep_start + size_time > sweep_time_budget * time_factor:
+                    print('The time budget of the adaptive sweep is over.')
+                    sizes_to_run = []
+                elif sizes_to_run:
+                    print('Adaptive sweep: adding ' + get_round_size_name(sizes_to_run[0], gap = True) + '.')
+
+            if not sizes_to_run:
+                break
+
+            p = sizes_to_run.pop(0)
             size_name = format(p, '05d') + 'B'
             init_name = dir_time + '_' + direction + '_' + size_name
-            iperf_sumname = dir_time + '_' + direction + '_iperf_summary'
-            mpstat_sumname = dir_time + '_' + direction + '_mpstat_summary'
-            combined_sumname = dir_time + '_' + direction + '_summary'
             print('++++++++++++++++++++++++++++++++++++++++++++++++++')
+            # The ETA of the tests of this protocol, learned from the tests so far
+            tests_left = len(sizes_to_run) + (len(p_sizes) if direction == 'one2two' else 0)
+            print('Tests left after this one: ' + str(tests_left) + ', ETA: ' +
+                  phase_timer.eta(runtime, tests_left + 1))
+
+            phase_timer.start('cell', streams = streams, protocol = protocol, direction = direction, size = p)
+            wait_nic_quiet(client_conn, client_addr)
+            wait_nic_quiet(server_conn, server_addr)
+            phase_timer.lap('readiness')
             try:
-                run_server(protocol, init_name, dir_time, server_conn, tcpwin)
+                if not persistent_server:
+                    run_server(protocol, init_name, dir_time, server_conn, tcpwin, streams)
+                elif not server_conn.iperf_listening(protocol):
+                    print('The persistent server on ' + server_conn.getname() + ' is not running.')
+                    run_server(protocol, server_name, dir_time, server_conn, tcpwin, streams, append = True)
+
+                phase_timer.lap('server_start')
+
+                if persistent_server:
+                    server_out, server_offset = server_name + tool.server_name + '.dat', server_segment[0]
+                else:
+                    server_out, server_offset = init_name + tool.server_name + '.dat', 0
+
                 test_completed, repetitions = run_client(server_addr, runtime, p, streams,
                                                          init_name, dir_time, protocol,
-                                                         client_conn, localpart, tcpwin)
-                stop_server(server_conn, dir_time)
+                                                         client_conn, cpu_conns, tcpwin,
+                                                         server_out, server_offset, counter_conns)
+                if not persistent_server:
+                    stop_server(server_conn, dir_time)
+                elif not tool.rr:
+                    server_segment = split_server_output(server_name + '_iperf.dat', init_name + '_iperf.dat',
+                                                         server_segment)
+
+                phase_timer.lap('server_stop')
                 print('Parsing results...')
-                if localpart:
-                    mpstat_array, tot_mpstat_mean, tot_mpstat_stdev = get_mpstat_data_single(init_name + '_mpstat.dat')
-                    mpstat_tot.append([ p, tot_mpstat_mean, tot_mpstat_stdev ])
-                    export_single_data(mpstat_array, init_name + '_mpstat_processed.dat')
-                    mpstat_single_file = basename(init_name + '_mpstat_processed.dat')
+                mpstat_arrays = {}
+                mpstat_plot_files = []
+                for (conn, tag) in cpu_conns:
+                    try:
+                        mpstat_array, tot_mpstat_mean, tot_mpstat_stdev, mpstat_plot_file =\
+                        process_mpstat(init_name, tag)
+                    except ValueError as err:
+                        if not tag:
+                            raise
+
+                        # The test itself is fine: only the CPU usage of this client is missing.
+                        tprint('\033[93mWARNING:\033[0m ' + conn.getname() + ': ' + err.args[0])
+                        continue
+
+                    mpstat_arrays[tag] = mpstat_array
+                    mpstat_tot[tag].append([ p, tot_mpstat_mean, tot_mpstat_stdev ])
+                    mpstat_plot_files.append((mpstat_plot_file, tag_host_name(tag, cl1_pretty_name,
+                                                                              cl2_pretty_name)))
+
+                if tool.rr:
+                    (iperf_array, tot_iperf_mean, tot_iperf_stdev, rr_hist, rr_lost) =\
+                    get_rr_data_single(init_name + '_rr.out', streams, repetitions)
+                    server_fault = False
+                    print(rr_message(rr_hist, rr_lost))
                 else:
-                    mpstat_single_file = None
-
-                (iperf_array, tot_iperf_mean, tot_iperf_stdev, server_fault) =\
-                get_iperf_data_single(init_name + '_iperf.dat', protocol, streams, repetitions)
-                if server_fault == 'too_few':
-                    print('\033[93mWARNING:\033[0m The server received fewer connections than expected.')
-                elif server_fault == 'too_many':
-                    print('\033[93mWARNING:\033[0m The server received more connections than expected.')
-
+                    (iperf_array, tot_iperf_mean, tot_iperf_stdev, server_fault) =\
+                    get_iperf_data_single(init_name + '_iperf.dat', protocol, streams, repetitions)
+                    rr_lost = None
+                    if server_fault == 'too_few':
+                        print('\033[93mWARNING:\033[0m The server received fewer connections than expected.')
+                    elif server_fault == 'too_many':
+                        print('\033[93mWARNING:\033[0m The server received more connections than expected.')
+
+                sender = process_sender(init_name)
+                if sender:
+                    print(sender_message(sender))
+
+                phase_timer.lap('parse')
             except ValueError as err:
                 tprint('\033[91mERROR:\033[0m ' + err.args[0] + ' Skipping test...')
-                image_list.append(get_round_size_name(p, gap = True))
-                iperf_tot.append([ -1, p, 0, 0, 0 ])
+                size_images.append((p, get_round_size_name(p, gap = True)))
+                iperf_tot.append([ -1, p, 0, 0, 0, 0, 0 ] + ([0] * len(rr_percentiles) if tool.rr else []))
+                campaign.record(streams, protocol, direction, p,
+                                {'status': 'failed', 'error': err.args[0]})
+                store.add_test(top_dir_name, timestamp, protocol, streams, direction, tcpwin, iperf_tot[-1])
+                phase_timer.end('failed')
                 print('==================================================')
                 continue
 
             # Get the "humanly readable" rate and its units.
             # This is just to put in the output data file, not for any calculations.
             # The units will be constant, and will be fixed after the first measurement.
+            if tool.rr:
+                rate_units, rate_factor = 'Trans/s', '1'
+
             try:
                 hr_net_rate = tot_iperf_mean / float(rate_factor)
             except:
                 _, rate_units, rate_factor = get_size_units_factor(tot_iperf_mean, rate=True)
                 hr_net_rate = tot_iperf_mean / float(rate_factor)
 
-            export_single_data(iperf_array, init_name + '_iperf_processed.dat')
-            write_gp(init_name + '.plt', basename(init_name + '_iperf_processed.dat'),
-                     mpstat_single_file, basename(init_name + '.png'),
-                     tot_iperf_mean, protocol, streams, print_unit, cl1_pretty_name,
-                     cl2_pretty_name, plot_type = 'singlesize', direction = direction,
-                     finished = test_completed, server_fault = server_fault,
-                     packet_size = p, tcpwin = tcpwin)
-            print('Plotting...')
-            pr = Popen([gnuplot_bin, basename(init_name + '.plt')],
-                       cwd = dirname(dir_time))
-            pr.wait()
-            image_list.append(join(raw_data_subdir, basename(init_name + '.png')))
+            if tool.rr:
+                processed_name = init_name + '_rr_processed.dat'
+                export_single_data(iperf_array, processed_name, rr_header)
+                export_rr_hist(rr_hist, init_name + '_rr_hist.json')
+                write_rr_gp(init_name + '.plt',
+                            export_plot_data(iperf_array, processed_name, init_name + '_rr_plot.dat', rr_header),
+                            basename(init_name + '.png'), tot_iperf_mean, protocol, streams, print_unit,
+                            cl1_pretty_name, cl2_pretty_name, plot_type = 'singlesize', direction = direction,
+                            finished = test_completed, packet_size = p, tcpwin = tcpwin)
+            else:
+                processed_name = init_name + '_iperf_processed.dat'
+                export_single_data(iperf_array, processed_name)
+                write_gp(init_name + '.plt',
+                         export_plot_data(iperf_array, processed_name, init_name + '_iperf_plot.dat'),
+                         mpstat_plot_files, basename(init_name + '.png'),
+                         tot_iperf_mean, protocol, streams, print_unit, cl1_pretty_name,
+                         cl2_pretty_name, plot_type = 'singlesize', direction = direction,
+                         finished = test_completed, server_fault = server_fault,
+                         packet_size = p, tcpwin = tcpwin)
+
+            print('Plotting (in the background)...')
+            plotter.render(basename(init_name + '.plt'), dirname(dir_time))
+            images = [join(raw_data_subdir, basename(init_name + '.png'))]
+            cores_plots = []
+            for tag in sorted(mpstat_arrays):
+                cores_name = init_name + '_cores' + tag
+                write_cores_gp(cores_name + '.plt', basename(cores_name + '_busy.bin'),
+                               basename(cores_name + '_irq.bin'), basename(cores_name + '.png'),
+                               protocol, streams, print_unit, cl1_pretty_name, cl2_pretty_name,
+                               direction, p, tcpwin, tag_host_name(tag, cl1_pretty_name, cl2_pretty_name))
+                plotter.render(basename(cores_name + '.plt'), dirname(dir_time))
+                images.append(join(raw_data_subdir, basename(cores_name + '.png')))
+                cores_plots.append(basename(cores_name + '.plt'))
+
+            counter_files = []
+            for (conn, iface, tag) in counter_conns:
+                try:
+                    counter_files.append((process_counters(init_name, tag),
+                                          tag_host_name(tag, cl1_pretty_name, cl2_pretty_name)))
+                except ValueError as err:
+                    tprint('\033[93mWARNING:\033[0m ' + conn.getname() + ': ' + err.args[0])
+
+            if plot_counters and counter_files:
+                write_counters_gp(init_name + '_counters.plt', counter_files, basename(init_name + '_counters.png'),
+                                  protocol, streams, print_unit, cl1_pretty_name, cl2_pretty_name,
+                                  direction, p, tcpwin)
+                plotter.render(basename(init_name + '_counters.plt'), dirname(dir_time))
+                images.append(join(raw_data_subdir, basename(init_name + '_counters.png')))
+
+            size_images.append((p, images if len(images) > 1 else images[0]))
+
             iperf_tot.append([ yes_and_no(test_completed, server_fault), p,
-                              tot_iperf_mean, tot_iperf_stdev, hr_net_rate ])
+                              tot_iperf_mean, tot_iperf_stdev, hr_net_rate,
+                              iperf_array.shape[0] * report_interval, rate_ci(iperf_array[:,1]) ])
+            if tool.rr:
+                iperf_tot[-1] += [rr_hist.percentile(q) / 1000.0 for q in rr_percentiles]
+
+            campaign.record(streams, protocol, direction, p, {
+                            'status': 'ok' if iperf_tot[-1][0] else 'approx',
+                            'completed': test_completed,
+                            'server_fault': server_fault,
+                            'repetitions': repetitions,
+                            'interval': report_interval,
+                            'image': size_images[-1][1],
+                            'iperf_summary': iperf_tot[-1],
+                            'mpstat_summary': mpstat_tot[''][-1] if '' in mpstat_arrays else None,
+                            'remote_mpstat_summaries': dict((tag, mpstat_tot[tag][-1])
+                                                            for tag in mpstat_arrays if tag),
+                            'rate_units': rate_units,
+                            'rate_factor': rate_factor,
+                            'sender': sender,
+                            'lost': rr_lost,
+                            'files': {
+                                      'iperf': basename(init_name + (tool.client_name + '.out' if tool.rr
+                                                                     else '_iperf.dat')),
+                                      'iperf_processed': basename(processed_name),
+                                      'rr_hist': basename(init_name + '_rr_hist.json') if tool.rr else None,
+                                      'mpstat_processed': basename(init_name + '_mpstat_processed.dat')
+                                                          if '' in mpstat_arrays else None,
+                                      'plot': basename(init_name + '.plt'),
+                                      'cores_plots': cores_plots,
+                                      'counters': [f for (f, name) in counter_files],
+                                      'sender': basename(init_name + '_sender.dat')
+                                                if sender and sender['retransmits'] != None else None,
+                                      'counters_plot': basename(init_name + '_counters.plt')
+                                                       if plot_counters and counter_files else None
+                                     }
+                           })
+            primary = primary_cpu_tag(mpstat_arrays, direction)
+            # (For the request/response tests: the transaction rate, without the latencies)
+            store.add_test(top_dir_name, timestamp, protocol, streams, direction, tcpwin, iperf_tot[-1],
+                           mpstat_tot[primary][-1] if primary != None else None, iperf_array[:,:3],
+                           mpstat_arrays.get(primary))
+            phase_timer.lap('export')
+            phase_timer.end('ok' if iperf_tot[-1][0] else 'approx')
             print('==================================================')
 
+        if persistent_server:
+            stop_server(server_conn, dir_time)
+
+        # The adaptive sweep adds the sizes out of order
+        image_list += [img for (size, img) in sorted(size_images, key = lambda i: i[0])]
+        iperf_tot.sort(key = lambda l: l[1])
+        mpstat_tot = dict((tag, sorted(l, key = lambda l: l[0])) for (tag, l) in mpstat_tot.items() if l)
+
         if tot_iperf_mean > 0.0:
             print(plot_message)
-            np.savetxt(iperf_sumname + '.dat', iperf_tot, fmt='%g',
-                       header= ('TestOK ' + print_unit +
-                                'Size(B) BW(b/s) Stdev(b/s) BW(' +
-                                rate_units + ')'))
-
-            if localpart:
-                np.savetxt(mpstat_sumname + '.dat', mpstat_tot, fmt = '%g',
-                           header = print_unit + 'Size(B) Frac Stdev')
-                mpstat_ser_file = basename(mpstat_sumname + '.dat')
+            phase_timer.start('report', streams = streams, protocol = protocol, direction = direction)
+            if tool.rr:
+                export_rr_summary(dir_time, direction, iperf_tot, mpstat_tot or None, protocol, streams,
+                                  print_unit, cl1_pretty_name, cl2_pretty_name, tcpwin, plotter)
             else:
-                mpstat_ser_file = None
-
-            non_failed_BW = [l[2] for l in iperf_tot if l[2]]
-            tot_iperf_mean = sum(non_failed_BW)/len(non_failed_BW)
-            write_gp(combined_sumname + '.plt', basename(iperf_sumname + '.dat'),
-                     mpstat_ser_file, basename(combined_sumname + '.png'),
-                     tot_iperf_mean, protocol, streams, print_unit, cl1_pretty_name,
-                     cl2_pretty_name, plot_type = 'multisize', direction = direction,
-                     server_fault = np.array(iperf_tot)[:,0], packet_size = np.mean(p_sizes),
-                     tcpwin = tcpwin)
-            pr = Popen([gnuplot_bin, basename(combined_sumname + '.plt')], cwd=dirname(dir_time))
-            pr.wait()
+                export_summary(dir_time, direction, iperf_tot, mpstat_tot or None,
+                               protocol, streams, print_unit, rate_units, cl1_pretty_name,
+                               cl2_pretty_name, tcpwin, plotter)
+
+            phase_timer.lap('summary')
+            phase_timer.end()
         elif direction == 'one2two':
             all_one2two_failed = True
         else:
             all_two2one_failed = True
 
+    store.close()
+    print('Waiting for the plots...')
+    phase_timer.start('report', streams = streams, protocol = protocol)
+    failed_plots = plotter.join()
+    phase_timer.lap('gnuplot')
+    if failed_plots:
+        tprint('\033[93m' + str(len(failed_plots)) + ' plot(s) failed to render.\033[0m')
+
     print('Exporting html...')
     gen_html(test_title,
              join(raw_data_subdir, common_filename + '_one2two_summary.png'),
              join(raw_data_subdir, common_filename + '_two2one_summary.png'),
              one2two_images, two2one_images, html_name, protocol, streams,
-             all_one2two_failed, all_two2one_failed, print_unit, localpart,
+             all_one2two_failed, all_two2one_failed, print_unit, bool(cpu_conns),
              cl1_pretty_name, cl2_pretty_name, tcpwin)
+    phase_timer.lap('html')
+    phase_timer.end()
+
+
+def replot(out_dirs):
+    '''
+    Render again all the gnuplot scripts found in the given NetMeter output directories
+    (for example, after editing them, or after changing the plotting code).
+    '''
+    plotter = PlotQueue(gnuplot_bin, gnuplot_workers, gnuplot_batch)
+    count = 0
+    for d in out_dirs:
+        for (path, subdirs, files) in walk(d):
+            for f in sorted(files):
+                if f.endswith('.plt'):
+                    plotter.render(f, path)
+                    count += 1
+
+    tprint('Rendering ' + str(count) + ' plot(s)...')
+    failed_plots = plotter.join()
+    tprint('Done. ' + str(count - len(failed_plots)) + ' of ' + str(count) + ' plot(s) rendered.')
+    return not failed_plots
+
+
+def parser_fingerprint():
+    '''
+    A hash of the parsing code, so that changing it invalidates the reprocess cache.
+    '''
+    parsers = [is_iperf_stamp, read_iperf_csv, iperf3_reports, read_iperf3_json, iperf_format, read_iperf,
+               get_iperf_data_single, read_mpstat, read_cpustat, get_mpstat_data_single,
+               rate_ci, t_quantile_975, lttb_indices, export_plot_data, export_heatmap, export_mpstat_cores,
+               process_mpstat, read_counters, get_counters_data_single, process_counters, read_iperf3_sender,
+               process_sender, reprocess_cell]
+    return sha256(''.join(getsource(f) for f in parsers).encode()).hexdigest()
+
+
+def file_hash(filename):
+    h = sha256()
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def infer_intervals(iperf_out, protocol):
+    '''
+    The number and the length of the intervals in a raw Iperf output, for archives that do
+    not record them. Each connection reports every interval, and (in Iperf 2) its total at the end.
+    '''
+    iperf_data = read_iperf(iperf_out, protocol, np.inf)
+    conns, conn_count = np.unique(iperf_data[:,1], return_counts = True)
+    if not conns.shape[0]:
+        return 1, report_interval
+
+    totals = 0 if iperf_format(iperf_out) == 'json' else 1
+    lengths, length_count = np.unique(np.round(iperf_data[:,3], 3), return_counts = True)
+    return max(int(np.median(conn_count)) - totals, 1), float(lengths[np.argmax(length_count)])
+
+
+def reprocess_cell(job):
+    '''
+    Parse the raw files of one test, and export the processed data.
+    Runs in a worker process. Returns the summary numbers of the test.
+    '''
+    init_name, protocol, streams, repetitions, interval, cpu_tags, counter_tags = job
+    result = {'cpu': {}, 'counters': {}}
+    for tag in counter_tags:
+        try:
+            result['counters'][tag] = process_counters(init_name, tag)
+        except ValueError as err:
+            tprint('\033[93mWARNING:\033[0m ' + basename(init_name) + ': ' + err.args[0])
+
+    for tag in cpu_tags:
+        try:
+            mpstat_array, tot_mpstat_mean, tot_mpstat_stdev, mpstat_plot_file = process_mpstat(init_name, tag)
+        except ValueError as err:
+            if not tag:
+                raise
+
+            tprint('\033[93mWARNING:\033[0m ' + basename(init_name) + ': ' + err.args[0])
+            continue
+
+        result['cpu'][tag] = {'summary': [tot_mpstat_mean, tot_mpstat_stdev], 'plot': mpstat_plot_file}
+
+    try:
+        (iperf_array, tot_iperf_mean, tot_iperf_stdev, server_fault) =\
+        get_iperf_data_single(init_name + '_iperf.dat', protocol, streams, repetitions, interval)
+    except ValueError as err:
+        result['error'] = err.args[0]
+        return result
+
+    export_single_data(iperf_array, init_name + '_iperf_processed.dat')
+    result['sender'] = process_sender(init_name)
+    result.update({'mean': tot_iperf_mean, 'stdev': tot_iperf_stdev, 'server_fault': server_fault,
+                   'duration': iperf_array.shape[0] * interval, 'ci': rate_ci(iperf_array[:,1]),
+                   'iperf_plot': export_plot_data(iperf_array, init_name + '_iperf_processed.dat',
+                                                  init_name + '_iperf_plot.dat')})
+    return result
+
+
+def read_html_info(html_name):
+    '''
+    The title, the client names and the TCP window of an existing report,
+    so that a reprocessed report looks like the original. Defaults to the configuration.
+    '''
+    info = [title, cl1_pretty_name, cl2_pretty_name, tcp_win_size]
+    if isfile(html_name):
+        with open(html_name) as inputfile:
+            content = inputfile.read()
+
+        names = re.search(r'<title>Iperf (.*) &#8596; (.*) Bandwidth ', content)
+        header = re.search(r'<h3>(.*) \[(?:TCP|UDP), \d+ st\.(?:, w=(.*))?\]</h3>', content)
+        if names:
+            info[1:3] = names.groups()
+
+        if header:
+            info[0], info[3] = header.groups()
+
+    return info
+
+
+def reprocess(out_dirs):
+    '''
+    Regenerate the processed data, the plots and the html pages of existing NetMeter
+    output directories from their raw data. The parsing results are cached per test,
+    keyed on the raw files, the parser settings and the parsing code, so that only
+    the changed tests are parsed again. The parsing is spread over all the cores.
+    '''
+    raw_pattern = re.compile(r'^((TCP|UDP)_(\d+)_st_(.+))_(one2two|two2one)_(\d+)B_iperf\.dat$')
+    fingerprint = parser_fingerprint()
+    campaigns = []
+    for d in out_dirs:
+        for (path, subdirs, files) in walk(d):
+            if basename(path) != 'raw-data':
+                continue
+
+            groups = {}
+            for f in files:
+                m = raw_pattern.match(f)
+                if m:
+                    common_filename, protocol, streams, timestamp, direction, size = m.groups()
+                    groups.setdefault((common_filename, protocol, int(streams), timestamp), []).append(
+                                      (direction, int(size)))
+
+            campaigns += [(path,) + k + (sorted(v),) for (k, v) in groups.items()]
+
+    jobs = {}
+    caches = {}
+    for (raw_dir, common_filename, protocol, streams, timestamp, cells) in campaigns:
+        manifest = Campaign(dirname(dirname(raw_dir)), timestamp).cells
+        cache_name = join(raw_dir, common_filename + '_reprocess_cache.json')
+        cache = {}
+        if isfile(cache_name):
+            with open(cache_name) as inputfile:
+                cache = json.load(inputfile)
+
+        caches[cache_name] = cache
+        for (direction, size) in cells:
+            init_name = join(raw_dir, common_filename + '_' + direction + '_' + format(size, '05d') + 'B')
+            cell = manifest.get(Campaign.key(streams, protocol, direction, size), {})
+            repetitions, interval = cell.get('repetitions'), cell.get('interval')
+            if not (repetitions and interval):
+                inferred = infer_intervals(init_name + '_iperf.dat', protocol)
+                repetitions, interval = repetitions or inferred[0], interval or inferred[1]
+
+            cpu_tags = [t for t in ['', '_cl1', '_cl2'] if cpu_raw_file(init_name, t)]
+            counter_tags = [t for t in ['_cl1', '_cl2'] if isfile(init_name + '_counters' + t + '.txt')]
+            raw_files = ([init_name + '_iperf.dat'] + [cpu_raw_file(init_name, t) for t in cpu_tags] +
+                         [init_name + '_counters' + t + '.txt' for t in counter_tags] +
+                         [f for f in [init_name + '_iperf_client.out'] if isfile(f)])
+            settings = json.dumps([protocol, streams, repetitions, interval, plot_max_points, fingerprint])
+            key = sha256((''.join(file_hash(f) for f in raw_files) + settings).encode()).hexdigest()
+            cached = cache.get(basename(init_name))
+            if (cached and cached['key'] == key and
+                ('error' in cached['result'] or isfile(init_name + '_iperf_processed.dat'))):
+                continue
+
+            cache[basename(init_name)] = {'key': key, 'completed': cell.get('completed', True)}
+            jobs[init_name] = (cache_name, (init_name, protocol, streams, repetitions, interval, cpu_tags,
+                                             counter_tags))
+
+    tprint('Parsing ' + str(len(jobs)) + ' test(s) (the others did not change)...')
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(reprocess_cell, [j for (c, j) in jobs.values()])
+        for (init_name, result) in zip(jobs, results):
+            caches[jobs[init_name][0]][basename(init_name)]['result'] = result
+
+    plotter = PlotQueue(gnuplot_bin, gnuplot_workers, gnuplot_batch)
+    for (raw_dir, common_filename, protocol, streams, timestamp, cells) in campaigns:
+        print('Reprocessing ' + common_filename + '...')
+        cache_name = join(raw_dir, common_filename + '_reprocess_cache.json')
+        cache = caches[cache_name]
+        top_dir = dirname(raw_dir)
+        store = ResultStore(join(dirname(top_dir), store_name))
+        dir_time = join(raw_dir, common_filename)
+        html_name = join(top_dir, common_filename + '.html')
+        test_title, cl1_name, cl2_name, tcpwin = read_html_info(html_name)
+        print_unit = 'Buffer' if protocol == 'TCP' else 'Datagram'
+        cpu_measured = False
+        images = {'one2two': [], 'two2one': []}
+        all_failed = {}
+        for direction in ['one2two', 'two2one']:
+            iperf_tot = []
+            mpstat_tot = {}
+            for size in [s for (d, s) in cells if d == direction]:
+                init_name = dir_time + '_' + direction + '_' + format(size, '05d') + 'B'
+                cached = cache[basename(init_name)]
+                result = cached['result']
+                for tag in sorted(result['cpu']):
+                    cpu_measured = True
+                    mpstat_tot.setdefault(tag, []).append([size] + result['cpu'][tag]['summary'])
+
+                if 'error' in result:
+                    tprint('\033[91mERROR:\033[0m ' + basename(init_name) + ': ' + result['error'])
+                    images[direction].append(get_round_size_name(size, gap = True))
+                    iperf_tot.append([ -1, size, 0, 0, 0, 0, 0 ])
+                    store.add_test(basename(top_dir), timestamp, protocol, streams, direction, tcpwin,
+                                   iperf_tot[-1])
+                    continue
+
+                if not [l for l in iperf_tot if l[0] >= 0]:
+                    # The units are fixed by the first measurement
+                    _, rate_units, rate_factor = get_size_units_factor(result['mean'], rate=True)
+
+                write_gp(init_name + '.plt', result['iperf_plot'],
+                         [(result['cpu'][tag]['plot'], tag_host_name(tag, cl1_name, cl2_name))
+                          for tag in sorted(result['cpu'])],
+                         basename(init_name + '.png'), result['mean'], protocol, streams, print_unit,
+                         cl1_name, cl2_name, plot_type = 'singlesize', direction = direction,
+                         finished = cached['completed'], server_fault = result['server_fault'],
+                         packet_size = size, tcpwin = tcpwin)
+                plotter.render(basename(init_name + '.plt'), raw_dir)
+                size_images = [join('raw-data', basename(init_name + '.png'))]
+                for tag in sorted(result['cpu']):
+                    cores_name = init_name + '_cores' + tag
+                    write_cores_gp(cores_name + '.plt', basename(cores_name + '_busy.bin'),
+                                   basename(cores_name + '_irq.bin'), basename(cores_name + '.png'),
+                                   protocol, streams, print_unit, cl1_name, cl2_name, direction, size, tcpwin,
+                                   tag_host_name(tag, cl1_name, cl2_name))
+                    plotter.render(basename(cores_name + '.plt'), raw_dir)
+                    size_images.append(join('raw-data', basename(cores_name + '.png')))
+
+                if plot_counters and result['counters']:
+                    write_counters_gp(init_name + '_counters.plt',
+                                      [(result['counters'][tag], tag_host_name(tag, cl1_name, cl2_name))
+                                       for tag in sorted(result['counters'])],
+                                      basename(init_name + '_counters.png'), protocol, streams, print_unit,
+                                      cl1_name, cl2_name, direction, size, tcpwin)
+                    plotter.render(basename(init_name + '_counters.plt'), raw_dir)
+                    size_images.append(join('raw-data', basename(init_name + '_counters.png')))
+
+                images[direction].append(size_images if len(size_images) > 1 else size_images[0])
+
+                iperf_tot.append([ yes_and_no(cached['completed'], result['server_fault']), size,
+                                  result['mean'], result['stdev'], result['mean'] / float(rate_factor),
+                                  result['duration'], result['ci'] ])
+                primary = primary_cpu_tag(result['cpu'], direction)
+                store.add_test(basename(top_dir), timestamp, protocol, streams, direction, tcpwin,
+                               iperf_tot[-1], mpstat_tot[primary][-1] if primary != None else None,
+                               np.loadtxt(init_name + '_iperf_processed.dat', ndmin = 2),
+                               np.loadtxt(init_name + '_mpstat' + primary + '_processed.dat', ndmin = 2)
+                               if primary != None else None)
+
+            all_failed[direction] = not [l for l in iperf_tot if l[0] >= 0]
+            if not all_failed[direction]:
+                export_summary(dir_time, direction, iperf_tot, mpstat_tot if mpstat_tot else None,
+                               protocol, streams, print_unit, rate_units, cl1_name, cl2_name,
+                               tcpwin, plotter)
+
+        gen_html(test_title,
+                 join('raw-data', common_filename + '_one2two_summary.png'),
+                 join('raw-data', common_filename + '_two2one_summary.png'),
+                 images['one2two'], images['two2one'], html_name, protocol, streams,
+                 all_failed['one2two'], all_failed['two2one'], print_unit, cpu_measured,
+                 cl1_name, cl2_name, tcpwin)
+        store.close()
+        with open(cache_name, 'w') as outfile:
+            json.dump(cache, outfile, indent = 1)
+
+    tprint('Rendering the plots...')
+    failed_plots = plotter.join()
+    tprint('Done. ' + str(len(campaigns)) + ' report(s) regenerated.')
+    return not failed_plots
 
 
 class Multitest(object):
     def __init__(self, cl1_conn, cl2_conn, cl1_test_ip, cl2_test_ip, runtime,
-                 p_sizes, timestamp, test_title, tcpwin, export_dir):
+                 p_sizes, timestamp, test_title, tcpwin, export_dir, campaign):
         self.cl1_conn    = cl1_conn
         self.cl2_conn    = cl2_conn
         self.cl1_test_ip = cl1_test_ip
@@ -978,13 +3291,14 @@ class Multitest(object):
         self.test_title  = test_title
         self.tcpwin      = tcpwin
         self.export_dir  = export_dir
+        self.campaign    = campaign
 
     def run_tests_for_protocols(self, streams, proto_list):
         for p in proto_list:
             run_tests(self.cl1_conn, self.cl2_conn, self.cl1_test_ip,
                       self.cl2_test_ip, self.runtime, self.p_sizes, streams,
                       self.timestamp, self.test_title, p, self.tcpwin,
-                      self.export_dir)
+                      self.export_dir, self.campaign)
 
     def run_tests_for_streams(self, stream_list, proto_list):
         for s in stream_list:
@@ -1000,13 +3314,53 @@ class Multitest(object):
 if __name__ == "__main__":
     # Interrupt handling
     signal.signal(signal.SIGINT, interrupt_exit)
+    if len(sys.argv) > 2 and sys.argv[1] == '--replot':
+        sys.exit(0 if replot(sys.argv[2:]) else 1)
+    elif len(sys.argv) > 2 and sys.argv[1] == '--reprocess':
+        sys.exit(0 if reprocess(sys.argv[2:]) else 1)
+    elif len(sys.argv) == 3 and sys.argv[1] == '--resume':
+        # Continue an interrupted campaign: same directory and timestamp, only the missing tests.
+        export_dir = sys.argv[2]
+        rundate = find_campaign(export_dir)
+        tprint('\033[92mResuming the campaign of ' + rundate + '.\033[0m')
+    elif len(sys.argv) == 3 and sys.argv[1] == '--timing':
+        # The phase timing summary of the latest campaign
+        print(timing_summary(join(sys.argv[2], find_campaign(sys.argv[2]) + '_timing.log')))
+        sys.exit(0)
+    elif len(sys.argv) > 1:
+        print('Usage: ' + sys.argv[0] + ' [--replot <OUTPUT DIR>... | --reprocess <OUTPUT DIR>... |'
+              ' --resume <EXPORT DIR> | --timing <EXPORT DIR>]')
+        sys.exit(1)
+
+    if iperf == None:
+        print('iperf_backend must be either "iperf2" or "iperf3". Exiting.')
+        sys.exit(1)
+
+    if set(protocols) & set(rr_protocols) and 'winexe' in [basename(access_method_cl1), basename(access_method_cl2)]:
+        print('The request/response tests (' + ', '.join(rr_protocols) + ') need Python on the clients,'
+              ' and can not run on winexe clients. Exiting.')
+        sys.exit(1)
+
+    if 'simulate' in [access_method_cl1, access_method_cl2] and access_method_cl1 != access_method_cl2:
+        # The real client would have its waits compressed as well, and its tests cut short
+        print('\033[91mBoth the clients must use the simulate access method.\033[0m Exiting.')
+        sys.exit(1)
+
+    if time_factor != 1:
+        tprint('\033[93mSimulated clients:\033[0m the test times are compressed by ' + format(sim_time_factor, 'g') + '.')
+
     # Getting connections
-    cl1_conn = Connect(access_method_cl1, cl1_conn_ip, 'cl1', cl1_iperf, ssh_port_cl1, creds_cl1)
-    cl2_conn = Connect(access_method_cl2, cl2_conn_ip, 'cl2', cl2_iperf, ssh_port_cl2, creds_cl2)
+    cl1_conn = Connect(access_method_cl1, cl1_conn_ip, 'cl1', cl1_iperf, ssh_port_cl1, creds_cl1, cl1_python)
+    cl2_conn = Connect(access_method_cl2, cl2_conn_ip, 'cl2', cl2_iperf, ssh_port_cl2, creds_cl2, cl2_python)
+    if 'netns' in [cl1_conn.conn_type, cl2_conn.conn_type]:
+        setup_netns(cl1_conn, cl2_conn, cl1_test_ip, cl2_test_ip)
+
+    campaign = Campaign(export_dir, rundate)
+    phase_timer.open(export_dir, rundate)
     # Write message
     if (len(protocols) > 1) or (len(streams) > 1):
-        total_time = str(timedelta(seconds = (2 * len(test_range) * (run_duration + 32) + 20) *
-                         len(protocols) * len(streams)))
+        total_time = phase_timer.eta(run_duration, 2 * len(test_range) * len(protocols) * len(streams) -
+                                     len([c for c in campaign.cells.values() if c['status'] != 'failed']))
         tprint('\033[92mStarting tests for protocols: ' + ', '.join(protocols) + '.\033[0m')
         tprint('\033[92mUsing ' + ','.join(str(s) for s in streams) + ' stream(s).\033[0m')
         tprint('\033[92mExpected total run time: \033[0m' + '\033[91m' + total_time + '\033[0m')
@@ -1014,10 +3368,17 @@ if __name__ == "__main__":
     # Run tests
     testinsts = Multitest(cl1_conn, cl2_conn, cl1_test_ip, cl2_test_ip,
                           run_duration, test_range, rundate, title,
-                          tcp_win_size, export_dir)
+                          tcp_win_size, export_dir, campaign)
     testinsts.run_tests_for_streams(streams, protocols)
+    print(timing_summary(phase_timer.logname))
     # Shut down the clients if needed.
     # IF ONE OF THE CLIENTS IS LOCAL, IT WILL NOT SHUT DOWN.
     if shutdown:
         cl1_conn.shutdown()
         cl2_conn.shutdown()
+    else:
+        cl1_conn.close_master()
+        cl2_conn.close_master()
+
+    if cl1_conn.conn_type == 'netns':
+        remove_netns(cl1_conn, cl2_conn)
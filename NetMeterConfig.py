@@ -32,24 +32,146 @@ cl2_test_ip = '192.168.100.22'
 cl1_iperf = r'iperf'
 cl2_iperf = r'C:\iperf\iperf.exe'
 
+# The Iperf version of the clients: 'iperf2' (the "-y C" reports) or 'iperf3' (JSON reports,
+# with the retransmits, the RTT and the congestion window of the TCP senders too). The paths
+# above must point to executables of this version. [str]
+# Example: 'iperf2'
+iperf_backend = 'iperf2'
+
+# Read the reports of iperf3 as they are written (--json-stream, iperf3 3.17 or later), or
+# only at the end of each test (--json, older versions; adaptive_duration can not stop the
+# tests early then). [bool]
+# Example: True
+iperf3_json_stream = True
+
+# Paths to the Python 3 interpreters on the clients, for the request/response tests (see
+# protocols). NM_rr.py is sent to them over the standard input, so nothing has to be installed
+# on the clients but Python. Not needed for the other tests. [str]
+# Example: '/usr/bin/python3'
+cl1_python = 'python3'
+cl2_python = 'python3'
+
 # Path to the gnuplot executable on the local machine. [str]
 # Example: 'gnuplot'
 gnuplot_bin = 'gnuplot'
 
+# The maximal number of gnuplot processes rendering in the background, while the
+# next tests run. [int]
+# Example: 4
+gnuplot_workers = 4
+
+# Keep one gnuplot process per worker and feed it all the scripts, instead of
+# starting gnuplot for every plot. The .plt scripts are still saved. [bool]
+# Example: True
+gnuplot_batch = True
+
 # A list of packet sizes to test (preferably as powers of 2). [iterable]
 # Example: [2**x for x in range(5,17)]  (For sizes of 32B to 64KB)
 test_range = [2**x for x in range(5,17)]
 
+# Adaptive size sweep: after the sizes of test_range (the coarse grid), keep adding sizes
+# between neighbouring sizes whose bandwidths differ by more than sweep_threshold
+# (relatively), the biggest difference first, while the direction fits in
+# sweep_time_budget seconds. [bool]
+# Example: False
+adaptive_sweep = False
+
+# The relative bandwidth difference between neighbouring sizes that is refined. [float]
+# Example: 0.2
+sweep_threshold = 0.2
+
+# The time budget of an adaptive sweep in one direction, in seconds. [int]
+# Example: 7200
+sweep_time_budget = 7200
+
 # The duration of a single run, in seconds. Must be at least 20, preferable at least 120. [int]
 # Example: 300
 run_duration = 300
 
+# The interval of the Iperf reports, in seconds (at least 0.1). Short intervals show the bursts
+# and the stalls that long averages hide. The CPU usage is sampled every report_interval seconds
+# too (rounded, and not more often than every second, where mpstat samples it). [float]
+# Example: 10
+report_interval = 10
+
+# The maximal number of points in a single size plot. Longer series (from short report intervals)
+# are downsampled for the plot only, in a way that preserves the peaks and the dips
+# (Largest-Triangle-Three-Buckets). The processed data files keep all the points. [int]
+# Example: 2000
+plot_max_points = 2000
+
+# Readiness timeouts, in seconds. Instead of waiting fixed delays, NetMeter polls until the Iperf
+# server listens (server_start), until stopped Iperf instances are gone (server_stop), until
+# the client finishes after the run time (client_finish) and until the test interfaces are
+# quiet before the next size (nic_quiet). These are the maximal waits. [int]
+# Example: 30
+server_start_timeout = 30
+server_stop_timeout = 30
+client_finish_timeout = 20
+nic_quiet_timeout = 30
+
+# Keep one Iperf server running for all the sizes of a direction, instead of restarting
+# it for every size. Its output is split into the usual per-size files. [bool]
+# Example: False
+persistent_server = False
+
+# Traffic rate on a test interface (in b/s, received and transmitted) below which
+# it is considered quiet. Checked on Linux clients only. [int]
+# Example: 1000000
+nic_quiet_rate = 1000000
+
+# Measure the CPU usage also on the ssh clients, not only on the local machine. mpstat (from the
+# sysstat package) runs on each of them for the whole test, and its output comes back through the
+# ssh connection. Clients without mpstat are skipped, with a warning. [bool]
+# Example: True
+remote_cpu = True
+
+# Sample the CPU usage of the local machine in NetMeter itself, from /proc/stat, instead of running
+# mpstat: sysstat is not needed on the local machine, and the sampling follows report_interval
+# also below a second. The ssh clients still use mpstat. [bool]
+# Example: True
+cpu_sampler = True
+
+# With cpu_sampler, record also the per-core softirq counters (/proc/softirqs: NET_RX, NET_TX...). [bool]
+# Example: False
+cpu_softirqs = False
+
+# Sample the counters of the test interfaces (/proc/net/dev), the TCP and UDP counters (/proc/net/snmp)
+# and the interrupts of the test interfaces (/proc/interrupts) on the Linux clients, every
+# report_interval seconds during each test, to tell drops, retransmits and interrupt imbalance
+# apart when the bandwidth drops. [bool]
+# Example: True
+collect_counters = True
+
+# Plot the counters of each test (drops, errors, retransmits, interrupt rate and imbalance) under
+# its bandwidth plot. [bool]
+# Example: False
+plot_counters = False
+
+# Adaptive run duration: stop each test as soon as the 95% confidence interval of its mean
+# bandwidth (over the report_interval intervals) is narrower than ci_target (relative half-width),
+# but not before adaptive_min_duration seconds. run_duration is then the maximal duration. [bool]
+# Example: False
+adaptive_duration = False
+
+# The target relative half-width of the confidence interval for the adaptive duration. [float]
+# Example: 0.02  (+-2%)
+ci_target = 0.02
+
+# The minimal duration of an adaptive run, in seconds. [int]
+# Example: 60
+adaptive_min_duration = 60
+
 # The desired numbers of streams. [iterable]
 # Example: [1, 4]
 streams = [1, 4]
 
 # The desired protocol(s). [iterable]
-# The value MUST be one of 3: ['TCP'] | ['UDP'] | ['TCP', 'UDP']
+# 'TCP' and 'UDP' for the bandwidth tests (Iperf), 'TCP_RR' and 'UDP_RR' for the request/response
+# latency tests (NM_rr.py, on Linux clients only): each stream sends a request of the tested size,
+# waits for a response of the same size, and so on. They report the transaction rate and the
+# p50, p99 and p99.9 latencies.
+# Example: ['TCP', 'UDP'] or ['TCP', 'TCP_RR']
 protocols = ['TCP', 'UDP']
 
 # The desired TCP window size. [str or None].
@@ -57,18 +179,48 @@ protocols = ['TCP', 'UDP']
 tcp_win_size = None
 
 # Remote access method path: 'ssh' (for Linux), 'winexe' (for Windows),
-# or 'local' (to run on one of the clients). [str]
+# 'local' (to run on one of the clients), 'simulate' (to emulate the client on the
+# local machine, for dry runs - set both clients to 'simulate'), or 'netns' (a network
+# namespace of the local machine - set both clients to 'netns'). [str]
 # Note: for ssh access, an ssh key is required! The key needs to be unencrypted.
 # If not present, it will be generated (if using OpenSSH).
-# Examples: 'ssh' or 'winexe' or '/home/user/bin/winexe' or 'local'
+# Examples: 'ssh' or 'winexe' or '/home/user/bin/winexe' or 'local' or 'simulate' or 'netns'
 access_method_cl1 = 'ssh'
 access_method_cl2 = 'winexe'
 
+# The time compression of simulated clients: the emulated tests, and all the waits
+# for them, take this fraction of the real time. [float]
+# Example: 0.01
+sim_time_factor = 0.01
+
+# The link between the clients of the 'netns' access method: two network namespaces of the
+# local machine (NetMeter_cl1 and NetMeter_cl2), with the test IPs (/24) on the link, for
+# a fully local testbed. 'veth' for a veth pair, or the names of two interfaces of the local
+# machine to move into the namespaces (e.g. two ports cabled back to back). [str or list]
+# Examples: 'veth', ['enp1s0f0', 'enp1s0f1']
+netns_link = 'veth'
+
+# More settings of the link interfaces ("ip link set <dev> ..."), and a qdisc for them
+# ("tc qdisc add dev <dev> root ..."), or '' for none. [str]
+# Examples: 'mtu 9000', 'netem delay 100us'
+netns_link_opts = ''
+netns_qdisc = ''
+
+# The CPUs to pin the processes of each netns client to (taskset -c), or '' to not pin them. [str]
+# Example: '0-3'
+netns_cpus_cl1 = ''
+netns_cpus_cl2 = ''
+
 # Remote access port (needed only for ssh access). [str]
 # Example: '22'
 ssh_port_cl1 = '22'
 ssh_port_cl2 = '22'
 
+# Send all the ssh commands to a client over one persistent master connection
+# (OpenSSH ControlMaster), instead of a new connection for each command. [bool]
+# Example: True
+ssh_multiplexing = True
+
 # A path to the credentials file for remote access. [str]
 # This file should contain two or three lines:
 #    username=<USERNAME> (for Windows clients it should be "Administrator", for Linux clients